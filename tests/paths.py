@@ -74,6 +74,9 @@ channel_montage_file = EXPORTED_PATH / 'channel_montage.json'
 channel_montage_reref_file = EXPORTED_PATH / 'channel_montage_reref.json'
 fieldtrip_file = EXPORTED_PATH / 'fieldtrip.mat'
 wonambi_file = EXPORTED_PATH / 'exported.won'
+segments_file = EXPORTED_PATH / 'segments.won'
+interval_file = EXPORTED_PATH / 'interval.won'
+interval_annot_file = EXPORTED_PATH / 'interval_annot.xml'
 brainvision_file = EXPORTED_PATH / 'brainvision.vhdr'
 svg_file = EXPORTED_PATH / 'graphics_svg'
 bids_dir = EXPORTED_PATH / 'bids'
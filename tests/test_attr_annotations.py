@@ -6,6 +6,7 @@ from wonambi.attr import (Annotations,
                           create_empty_annotations,
                           )
 from wonambi.attr.annotations import create_annotation
+from wonambi.detect import match_events
 from wonambi.utils.exceptions import UnrecognizedFormat
 
 
@@ -113,6 +114,87 @@ def test_events():
     assert len(annot.get_events()) == 0
 
 
+def test_lazy_raters():
+    d = Dataset(ns2_file)
+    create_empty_annotations(annot_file, d)
+
+    annot = Annotations(annot_file)
+    annot.add_rater('test')
+    annot.add_event('spindle', (1, 2), chan=('FP1', ))
+    annot.add_rater('test_2')
+    annot.add_event('spindle', (3, 4))
+    annot.add_event('slowwave', (5, 6))
+
+    annot = Annotations(annot_file, rater_name='test_2')
+    assert len(annot._lazy_raters) == 1
+    assert len(annot.get_events()) == 2
+    assert len(annot.get_events(name='spindle', time=(0, 3.5))) == 1
+
+    annot.get_rater('test')
+    assert len(annot._lazy_raters) == 0
+    assert annot.get_events()[0]['chan'] == ['FP1']
+
+    annot = Annotations(annot_file)
+    annot.set_stage_for_epoch(510, 'REM')
+    annot = Annotations(annot_file, rater_name='test_2')
+    assert len(annot.get_events()) == 2
+
+
+def test_import_events():
+    d = Dataset(ns2_file)
+    create_empty_annotations(annot_file, d)
+
+    annot = Annotations(annot_file)
+    annot.add_rater('test')
+    annot.add_event('spindle', (1, 2), chan=('FP1', ))
+    annot.add_event('slowwave', (3.5, 4.25))
+    annot.export_events(str(annot_export_file))
+
+    annot.add_rater('imported')
+    annot.import_events(str(annot_export_file), source='wonambi')
+    events = annot.get_events()
+    assert len(events) == 2
+    assert events[0]['chan'] == ['FP1']
+    assert events[1]['end'] == 4.25
+
+
+def test_agreement():
+    d = Dataset(ns2_file)
+    create_empty_annotations(annot_file, d)
+
+    annot = Annotations(annot_file)
+    annot.add_rater('test')
+    annot.set_stage_for_epoch(510, 'REM')
+    annot.add_event('spindle', (1, 2), chan=('FP1', ))
+    annot.add_event('spindle', (10, 11), chan=('FP1', ))
+    annot.add_rater('test_2')
+    annot.set_stage_for_epoch(540, 'REM')
+    annot.add_event('spindle', (1.1, 2), chan=('FP1', ))
+
+    stages = annot.stage_agreement()[('test', 'test_2')]
+    assert stages['n_epochs'] == 50
+    assert stages['agreement'] == 48 / 50
+    assert stages['confusion'][1, 0] == 1
+
+    stages['confusion'][1, 0] = 10  # does not change the cache
+    annot.set_stage_for_epoch(540, 'Unknown', save=False)
+    stages = annot.stage_agreement()[('test', 'test_2')]
+    assert stages['agreement'] == 49 / 50
+    assert stages['confusion'][1, 0] == 0
+    assert len(annot._agreement) == 1  # the old agreement was removed
+
+    events = annot.event_agreement()[('test', 'test_2', 'spindle', 'FP1')]
+    assert events['n_tp'] == 1
+
+    annot.get_rater('test')
+    detection = annot.get_events(name='spindle')
+    annot.get_rater('test_2')
+    standard = annot.get_events(name='spindle')
+    match = match_events(detection, standard, 0.5)
+    assert events['n_fp'] == match.n_fp
+    assert events['f1score'] == match.f1score
+
+
 def test_epochs():
     d = Dataset(ns2_file)
     create_empty_annotations(annot_file, d)
@@ -140,6 +222,13 @@ def test_get_cycles():
     assert len(cycles) == 3
     assert cycles[2] == (570, 600, 3)
 
+    annot.add_event('spindle', (545, 546), chan=('FP1', ))
+    annot.add_event('spindle', (610, 611), chan=('FP1', ))
+    events = annot.get_events(cycle=[2])
+    assert len(events) == 1
+    assert events[0]['cycle'] == 2
+    assert len(annot.get_events(cycle=[])) == 2  # no selection on cycles
+
     annot.remove_cycle_mrkr(510)
     annot.clear_cycles()
 
@@ -1,8 +1,10 @@
 from pickle import load, dump
 from tempfile import NamedTemporaryFile
+from numpy import isnan, save
+from numpy import load as load_npy
 from numpy.testing import assert_array_equal
 
-from wonambi.trans import math
+from wonambi.trans import filter_, frequency, math
 from wonambi.utils import create_data
 
 
@@ -33,3 +35,53 @@ def test_copy_axis():
 
     output = data._copy(axis=False)
     assert len(data.axis) == len(output.axis)
+
+
+def test_call_view():
+    data = create_data(n_trial=2)
+    chans = data.axis['chan'][0]
+
+    x = data(trial=0, chan=chans[1:4], copy=False)
+    assert x.base is data.data[0]
+    assert_array_equal(x, data.data[0][1:4, :])
+
+    x = data(trial=0, chan=chans[2])
+    assert x.shape == data.data[0].shape[1:]
+    assert x.base is None
+    assert_array_equal(x, data.data[0][2, :])
+
+    # not contiguous or missing values, filled with NaN
+    x = data(trial=1, chan=[chans[3], chans[1], 'XXX'], copy=False)
+    assert_array_equal(x[:2, :], data.data[1][[3, 1], :])
+    assert isnan(x[2, :]).all()
+
+
+def test_pack():
+    data = create_data(n_trial=5)
+    trials = [x.copy() for x in data.data]
+
+    data.pack()
+    x = data.trials_array()
+    assert x.shape == (5, ) + trials[0].shape
+    assert x.base is data.data[0].base
+    for one_packed, one_trial in zip(x, trials):
+        assert_array_equal(one_packed, one_trial)
+
+    data.data[2] = trials[2]  # not in the buffer anymore
+    assert data.trials_array().base is None
+
+
+def test_trials_memmap(tmp_path):
+    data = create_data(n_trial=2)
+    trials = [x.copy() for x in data.data]
+    for i, one_trial in enumerate(trials):
+        save(tmp_path / f'trial{i}.npy', one_trial)
+        data.data[i] = load_npy(tmp_path / f'trial{i}.npy', mmap_mode='r')
+
+    assert data.trials_array().base is None
+    data1 = math(data, operator_name='mean', axis='time')
+    for i, one_trial in enumerate(trials):
+        assert_array_equal(data1.data[i], one_trial.mean(axis=1))
+
+    filter_(data, low_cut=1, high_cut=10)
+    frequency(data)
@@ -27,9 +27,26 @@ def test_agreement_consensus():
             {'start': 39.0, 'end': 40.0, 'chan': 'Cz'},
             {'start': 102.0, 'end': 105.69921875, 'chan': 'Cz'}]
 
+def test_agreement_consensus_per_chan():
+    rater1_fz = [dict(evt, chan='Fz') for evt in rater1]
+    rater2_fz = [dict(evt, chan='Fz', start=evt['start'] + 1) 
+                 for evt in rater2]
+    cons = consensus((rater1 + rater1_fz, rater2 + rater2_fz), 1, 512, 
+                     min_duration=0.5, per_chan=True)
+    
+    cons_cz = consensus((rater1, rater2), 1, 512, min_duration=0.5)
+    cons_fz = consensus((rater1_fz, rater2_fz), 1, 512, min_duration=0.5)
+    assert cons(lambda x: x['chan'] == 'Cz').events == cons_cz.events
+    assert cons(lambda x: x['chan'] == 'Fz').events == cons_fz.events
+    
 def test_agreement_match_events():
     match = match_events(rater1, rater2, 0.5)
     
     assert match.precision == 0.5
     assert match.recall == 0.5714285714285714
-    assert match.f1score == 0.5333333333333333
\ No newline at end of file
+    assert match.f1score == 0.5333333333333333
+    
+    assert match.tp.shape == (7, 6)
+    det, std = match.tp.nonzero()
+    assert list(det) == [0, 1, 3, 5]
+    assert list(std) == [0, 1, 4, 5]
\ No newline at end of file
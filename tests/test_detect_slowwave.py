@@ -1,7 +1,12 @@
+from numpy import arange, asarray, diff, pi, round, sign, sin, where
+from numpy.random import default_rng
 from pytest import approx
 
 from wonambi import Dataset
-from wonambi.detect.slowwave import DetectSlowWave
+from wonambi.detect.slowwave import (DetectSlowWave, detect_events, 
+                                     find_intervals, find_peaks_in_slowwwave,
+                                     find_zero_crossings, make_slow_waves, 
+                                     _add_halfwave)
 
 from .paths import psg_file
 
@@ -52,3 +57,60 @@ def test_detect_slowwave_to_data():
 
     sw_ptp = sw.to_data('ptp')
     assert approx(sw_ptp(0)[1]) == 63.0
+
+
+def _find_peaks_loop(dat, events):
+    """Reference implementation of find_peaks_in_slowwwave, one event at
+    the time"""
+    out = []
+    for beg, end in events:
+        ev_dat = dat[beg:end]
+        neg_to_pos = where(diff(sign(ev_dat)) > 0)[0]
+        if len(neg_to_pos):
+            out.append([beg, beg + ev_dat.argmin(), beg + neg_to_pos[0],
+                        beg + ev_dat.argmax(), end])
+    return asarray(out, dtype='int64').reshape(-1, 5)
+
+
+def _add_halfwave_loop(dat, events, window, min_ptp):
+    """Reference implementation of _add_halfwave, one event at the time"""
+    out = []
+    for beg, trough, end in events:
+        zero_crossings = where(diff(sign(dat[end:beg + window])))[0]
+        if not zero_crossings.any():
+            continue
+        zero = end + zero_crossings[0] + 1
+        peak = end + dat[end:zero].argmin()
+        if abs(dat[trough] - dat[peak]) < min_ptp:
+            continue
+        out.append([beg, trough, end, peak, zero])
+    return asarray(out, dtype='int64').reshape(-1, 5)
+
+
+def test_detect_slowwave_candidates():
+    s_freq = 100
+    rng = default_rng(0)
+    time = arange(20000) / s_freq
+    dat = (50 * sin(2 * pi * time * rng.uniform(0.5, 2, 20000).cumsum() / 
+                    20000) + 20 * rng.standard_normal(20000))
+    dat = round(dat)  # with ties and exact zeros
+
+    idx_zx = find_zero_crossings(dat, xtype='pos_to_neg')
+    events = find_intervals(idx_zx, s_freq, (0.05, 10))
+    peaks = find_peaks_in_slowwwave(dat, events)
+    assert len(peaks) > 10
+    assert (peaks == _find_peaks_loop(dat, events)).all()
+
+    slow_waves = make_slow_waves(peaks, dat, time, s_freq)
+    assert len(slow_waves) == len(peaks)
+    assert slow_waves[0]['trough_val'] == dat[peaks[0, 1]]
+    assert slow_waves[-1]['end'] == (peaks[-1, 4] - 1) / s_freq
+
+    detsw = DetectSlowWave()
+    detsw.duration = (0.5, 2)
+    detsw.min_ptp = 5
+    troughs = detect_events(dat, 'above_thresh', value=0.)
+    halfwaves = _add_halfwave(dat, troughs, s_freq, detsw)
+    assert len(halfwaves) > 10
+    assert (halfwaves == _add_halfwave_loop(
+        dat, troughs, 2 * s_freq, detsw.min_ptp)).all()
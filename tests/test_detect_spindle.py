@@ -1,7 +1,18 @@
+from numpy import (arange, array, diff, isfinite, isnan, logical_and, mean, 
+                   percentile, ptp, sqrt, square, std, zeros)
+from numpy.random import seed, random
+from scipy.signal import periodogram
+from numpy.testing import assert_allclose, assert_array_equal
 from pytest import approx, raises
 
 from wonambi import Dataset
-from wonambi.detect.spindle import DetectSpindle
+from wonambi.detect import TransformCache, detect_multiple, detect_stream
+from wonambi.detect.agreement import match_events
+from wonambi.detect.spindle import (DetectSpindle, StreamThresholds, 
+                                    define_threshold, make_spindles, 
+                                    power_in_band, spindle_columns, 
+                                    transform_signal)
+from wonambi.utils import create_data
 
 from .paths import psg_file
 
@@ -92,6 +103,112 @@ def test_merge_close():
     sp = detsp(data)
     assert len(sp.events) == 4
 
+def test_detect_spindle_n_jobs():
+    seed(0)
+    data_sim = create_data(n_chan=3, time=(0, 60), amplitude=20)
+    detsp = DetectSpindle(method='Nir2011')
+
+    sp = detsp(data_sim)
+    sp_parallel = detsp(data_sim, n_jobs=2)
+    assert len(sp.events) > 0
+    assert sp.events == sp_parallel.events
+    assert (sp.density == sp_parallel.density).all()
+
+    data_sim.data[0] = data_sim.data[0].astype('float32')
+    sp = detsp(data_sim)
+    sp_parallel = detsp(data_sim, n_jobs=2)
+    assert sp.events == sp_parallel.events
+
+def test_detect_spindle_stream():
+    detsp = DetectSpindle(merge=True)
+    options = dict(vars(detsp))
+    chan = ['EEG Fpz-Cz', 'EEG Pz-Oz']
+    whole = d.read_data(chan=chan, begtime=35400, endtime=36000)
+    sp_whole = detsp(whole)
+
+    sp = detect_stream(detsp, d, chan, chunk_dur=120, overlap=20, 
+                       begtime=35400, endtime=36000)
+    assert vars(detsp) == options  # the options are not modified
+
+    # the thresholds are the same, but the transforms on each chunk are not 
+    # identical to those on the whole signal: 95% of the events should match
+    for one_chan in chan:
+        streamed = [x for x in sp.events if x['chan'] == one_chan]
+        standard = [x for x in sp_whole.events if x['chan'] == one_chan]
+        match = match_events(streamed, standard, 0.5)
+        assert match.precision >= 0.95
+        assert match.recall >= 0.95
+
+    with raises(ValueError):
+        detect_stream(detsp, d, chan, begtime=36000, endtime=36000)
+    with raises(ValueError):
+        detsp(whole, stream=StreamThresholds())  # only one channel
+
+
+def test_detect_spindle_stream_thresholds():
+    seed(0)
+    dat = random(10000)
+    time = arange(10000) / 100
+    idx = arange(0, 10000, 7)
+
+    thresh = StreamThresholds()
+    for i_pass in range(2):
+        for beg, end in ((0, 4000), (4000, 10000)):
+            read_beg, read_end = max(beg - 500, 0), min(end + 500, 10000)
+            n_read = read_end - read_beg
+            thresh.new_chunk((beg - read_beg) / n_read, 
+                             (end - read_beg) / n_read, time[beg], 
+                             time[end - 1] + 0.01)
+            chunk = dat[read_beg:read_end]
+            define_threshold(chunk, 100, 'mean+std', 2, stream=thresh)
+            define_threshold(chunk, 100, 'percentile', 90, stream=thresh)
+            evt = idx[(idx >= read_beg) & (idx < read_end)]
+            define_threshold(dat[evt], 100, 'mean', 1, stream=thresh, 
+                             time=time[evt])
+        assert thresh.compute() == (i_pass == 0)
+
+    assert thresh.values[0] == approx(mean(dat) + 2 * std(dat))
+    assert thresh.values[1] == approx(percentile(dat, 90), abs=1e-4)
+    assert thresh.values[2] == approx(mean(dat[idx]))
+
+
+def test_detect_spindle_multiple():
+    seed(0)
+    data_sim = create_data(n_chan=2, time=(0, 60), amplitude=20)
+    detectors = [DetectSpindle(method='Nir2011'), 
+                 DetectSpindle(method='Nir2011'), 
+                 DetectSpindle(method='Moelle2011')]
+    detectors[1].det_thresh = 2
+
+    sp = [detsp(data_sim) for detsp in detectors]
+    sp_multiple = detect_multiple(detectors, data_sim)
+    for one_sp, one_multiple in zip(sp, sp_multiple):
+        assert ([(x['start'], x['end'], x['chan']) for x in one_sp.events] ==
+                [(x['start'], x['end'], x['chan']) 
+                 for x in one_multiple.events])
+        assert (one_sp.density == one_multiple.density).all()
+
+def test_transform_cache():
+    seed(0)
+    dat = random(1000)
+    opt = {'freq': (10, 16), 'order': 4}
+    with TransformCache() as cache:
+        out1 = transform_signal(dat, 256, 'butter', opt)
+        out2 = transform_signal(dat.copy(), 256, 'butter', opt)
+        transform_signal(out2, 256, 'abs')
+        out1[:] = 0
+
+        assert cache.n_hits == 1
+        assert cache.n_misses == 2
+
+        # signals modified in place are not confused with the cached ones
+        out2 *= 2
+        transform_signal(out2, 256, 'abs')
+        out3 = transform_signal(transform_signal(dat, 256, 'butter', opt),
+                                256, 'abs')
+        assert cache.n_misses == 3
+    assert_array_equal(out3, abs(transform_signal(dat, 256, 'butter', opt)))
+
 def test_detect_spindle_to_data():
     detsp = DetectSpindle()
     sp = detsp(data)
@@ -101,3 +218,116 @@ def test_detect_spindle_to_data():
 
     sp_freq = sp.to_data('peak_freq')
     assert approx(sp_freq(0)[0]) == 14.151831564532694
+
+
+def _moving_loop(dat, s_freq, method, dur, step, dat2=None, pcl_range=None):
+    """Reference implementation of the moving_* methods, one window at a time.
+    """
+    halfdur = dur / 2
+    total_dur = len(dat) / s_freq
+    last = len(dat) - 1
+    if pcl_range is not None:
+        lo = percentile(dat, pcl_range[0])
+        hi = percentile(dat, pcl_range[1])
+
+    out = zeros(int(total_dur / step))
+    for i, j in enumerate(arange(0, total_dur, step)[:-1]):
+        beg = max(0, int((j - halfdur) * s_freq))
+        end = min(last, int((j + halfdur) * s_freq))
+        win = dat[beg:end]
+        if method == 'moving_covar':
+            win2 = dat2[beg:end]
+            out[i] = mean((win - mean(win)) * (win2 - mean(win2)))
+        elif method == 'moving_sd':
+            out[i] = std(win)
+        elif method == 'moving_zscore':
+            stddat = win
+            if pcl_range is not None:
+                stddat = win[logical_and(win > lo, win < hi)]
+            out[i] = (dat[i] - mean(win)) / std(stddat)
+        else:
+            out[i] = mean(square(win))
+    return out
+
+
+def test_transform_signal_moving():
+    seed(0)
+    s_freq = 200.5
+    dat = random(int(s_freq * 30)) * 40 + 300
+    dat[1000:1500] = 3
+    dat2 = random(len(dat)) * 10 - 40
+
+    for method in ('moving_ms', 'moving_sd', 'moving_covar', 'moving_zscore'):
+        for step in (None, 0.1):
+            for dur in (0.2, 1):
+                opt = {'dur': dur, 'step': step, 'pcl_range': None}
+                out = transform_signal(dat, s_freq, method, opt, dat2=dat2)
+                ref = _moving_loop(dat, s_freq, method, dur,
+                                   1 / s_freq if step is None else step,
+                                   dat2=dat2)
+                assert_array_equal(isfinite(out), isfinite(ref))
+                good = isfinite(ref)
+                assert_allclose(out[good], ref[good], rtol=1e-8, atol=1e-8)
+
+    opt = {'dur': 2, 'step': None, 'pcl_range': (10, 90)}
+    out = transform_signal(dat, s_freq, 'moving_zscore', opt)
+    ref = _moving_loop(dat, s_freq, 'moving_zscore', 2, 1 / s_freq,
+                       pcl_range=(10, 90))
+    assert_array_equal(isfinite(out), isfinite(ref))
+    assert_allclose(out[isfinite(ref)], ref[isfinite(ref)], rtol=1e-8)
+
+    opt = {'dur': 0.3, 'step': None}
+    out = transform_signal(dat, s_freq, 'moving_rms', opt)
+    ref = _moving_loop(dat, s_freq, 'moving_ms', 0.3, 1 / s_freq)
+    assert_allclose(out, ref ** .5)
+
+
+def test_transform_signal_moving_power_ratio():
+    seed(0)
+    s_freq = 256
+    dat = random(s_freq * 20)
+    opt = {'dur': 0.3, 'step': 0.1, 'freq_narrow': (11, 16),
+           'freq_broad': (4.5, 30), 'fft_dur': 2}
+    out = transform_signal(dat, s_freq, 'moving_power_ratio', opt)
+    assert out.shape == (200, )
+
+    for i, j in enumerate(arange(0, 20, 0.1)[:-1]):
+        beg = max(0, int((j - 0.15) * s_freq))
+        end = min(len(dat) - 1, int((j + 0.15) * s_freq))
+        sf, psd = periodogram(dat[beg:end], s_freq, 'hann', nfft=512,
+                              detrend='constant')
+        assert out[i] == approx(sum(psd[22:32]) / sum(psd[9:60]))
+
+
+def test_spindle_events_batched():
+    seed(0)
+    s_freq = 256
+    dat = random(s_freq * 60)
+    time = arange(len(dat)) / s_freq
+    events = array([[-10, 20, 100],
+                    [100, 150, 300],
+                    [400, 500, 600],
+                    [1000, 1100, 1300],
+                    [14000, 14500, len(dat)]])
+
+    pw = power_in_band(events, dat, s_freq, (11, 16))
+    assert isnan(pw[0])
+    assert isnan(pw[-1])
+    for i in range(1, 4):
+        sf, Pxx = periodogram(diff(dat)[events[i, 0]:events[i, 2]], s_freq)
+        b0 = abs(sf - 11).argmin()
+        b1 = abs(sf - 16).argmin()
+        assert pw[i] == approx(mean(Pxx[b0:b1]))
+
+    events = events[1:-1]
+    peaks = array([12., 13., 14.])
+    spindles = make_spindles(events, peaks, pw[1:-1], dat, dat, time, s_freq)
+    cols = spindle_columns(events, peaks, pw[1:-1], dat, dat, time, s_freq)
+    assert len(spindles) == 3
+    assert spindles[1]['start'] == time[400]
+    assert spindles[1]['end'] == time[599]
+    assert spindles[1]['rms_orig'] == approx(sqrt(mean(square(dat[400:600]))))
+    assert spindles[1]['ptp_det'] == approx(ptp(dat[400:600]))
+    assert_allclose(cols['auc_det'], [sum(dat[100:300]) / s_freq, 
+                                      sum(dat[400:600]) / s_freq,
+                                      sum(dat[1000:1300]) / s_freq])
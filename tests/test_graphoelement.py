@@ -0,0 +1,97 @@
+from copy import deepcopy
+from pickle import dumps, loads
+
+from numpy import isnan
+from pytest import raises
+
+from wonambi.detect import merge_close
+from wonambi.graphoelement import Events, Graphoelement, Spindles
+
+
+events = [
+    {'start': 3, 'end': 9, 'chan': 'Cz', 'peak_val': 1.},
+    {'start': 8, 'end': 10, 'chan': 'Fz', 'peak_val': 2.},
+    {'start': 20, 'end': 25, 'chan': 'Cz', 'peak_val': 3.},
+    {'start': 30, 'end': 40, 'chan': 'Cz', 'peak_val': 4.},
+    ]
+
+
+def test_graphoelement_events():
+    evt = Events(events)
+    assert len(evt) == 4
+    assert evt == events
+    assert evt[1] == events[1]
+    assert evt[-1] == events[-1]
+    assert list(evt) == events
+    assert evt[1:3] == events[1:3]
+    assert evt.select(evt.columns['start'] > 10) == events[2:]
+    assert evt.columns['start'].dtype.kind in 'iu'
+
+    with raises(IndexError):
+        evt[4]
+
+    evt[0]['start'] = 100  # changes the events
+    assert evt[0]['start'] == 100
+    assert evt.columns['start'].dtype.kind in 'iu'
+
+    for one_evt in evt:
+        one_evt['chan'] = 'Oz'
+    assert list(evt.columns['chan']) == ['Oz', ] * 4
+
+    evt[1]['peak_val'] = 'high'
+    del evt[2]['peak_val']
+    assert evt[0]['peak_val'] == 1.
+    assert evt[1]['peak_val'] == 'high'
+    assert 'peak_val' not in evt[2]
+    assert events[0]['start'] == 3
+
+
+def test_graphoelement_events_keys():
+    evt = Events([{'start': 1, 'chan': ['Cz', 'Fz']},
+                  {'start': 0, 'chan': ['Cz'], 'name': 'spindle'}])
+    assert evt[0] == {'start': 1, 'chan': ['Cz', 'Fz']}
+    assert evt.sort('start')[0] == {'start': 0, 'chan': ['Cz'],
+                                    'name': 'spindle'}
+
+    evt.extend([{'start': 2, 'end': 3, 'chan': ['Oz']}])
+    assert len(evt) == 3
+    assert evt[2] == {'start': 2, 'end': 3, 'chan': ['Oz']}
+    assert loads(dumps(evt)) == evt
+    assert deepcopy(evt) == evt
+
+
+def test_graphoelement_select():
+    grapho = Graphoelement()
+    grapho.chan_name = ['Cz', 'Fz']
+    grapho.events = events
+
+    selected = grapho(lambda x: x['chan'] == 'Cz')
+    assert len(selected) == 3
+    assert len(grapho) == 4
+
+    assert list(grapho.to_data('count').data[0]) == [3, 1]
+    assert list(grapho.to_data('peak_val').data[0]) == [8 / 3, 2]
+
+    assert len(Spindles()) == 1
+
+    sp = Spindles()
+    sp.chan_name = ['Cz']
+    sp.events = []
+    assert isnan(sp.to_data('peak_freq').data[0][0])
+    assert sp.to_data('count').data[0][0] == 0
+
+
+def test_graphoelement_merge_close():
+    merged = merge_close(events, 1)
+    assert merged == [
+        {'start': 3, 'end': 10, 'chan': 'Cz', 'peak_val': 1.},
+        {'start': 20, 'end': 25, 'chan': 'Cz', 'peak_val': 3.},
+        {'start': 30, 'end': 40, 'chan': 'Cz', 'peak_val': 4.},
+        ]
+
+    merged = merge_close(Events(events), 5.5)
+    assert isinstance(merged, Events)
+    assert merged == [
+        {'start': 3, 'end': 10, 'chan': 'Cz', 'peak_val': 1.},
+        {'start': 20, 'end': 40, 'chan': 'Cz', 'peak_val': 3.},
+        ]
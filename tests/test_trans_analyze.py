@@ -0,0 +1,62 @@
+from numpy import amin, sqrt
+from numpy.testing import assert_allclose, assert_array_equal
+
+from wonambi.trans.analyze import (PARAM_KEYS, event_params,
+                                   event_params_table)
+from wonambi.trans.frequency import band_power
+from wonambi.trans.peaks import get_slopes
+from wonambi.utils import create_data
+
+
+segments = [{'data': create_data(n_chan=2, time=(i, i + dur), signal='sine',
+                                 sine_freq=1.5, amplitude=50)}
+            for i, dur in enumerate((1, 1.5, 1, 2))]
+for seg in segments:
+    seg['data'].data[0] = seg['data'].data[0] + create_data(
+        n_chan=2, time=seg['data'].axis['time'][0]).data[0]
+
+slopes = {'avg_slope': True, 'max_slope': True, 'prep': False,
+          'invert': False}
+
+
+def test_event_params_table():
+    table = event_params_table(segments, 'all', band=(1, 4), slopes=slopes)
+    assert_array_equal(table['segment'], [0, 0, 1, 1, 2, 2, 3, 3])
+
+    for row, (i, chan) in enumerate(zip(table['segment'], table['chan'])):
+        dat = segments[i]['data']
+        x = dat(chan=chan)[0]
+
+        assert table['start'][row] == dat.axis['time'][0][0]
+        assert_allclose(table['dur'][row], len(x) / dat.s_freq)
+        assert_allclose(table['minamp'][row], amin(x))
+        assert_allclose(table['rms'][row], sqrt((x ** 2).mean()), rtol=1e-5)
+
+        power, peakf = band_power(dat, (1, 4), scaling='energy')
+        assert_allclose(table['energy'][row], power[chan])
+        assert table['peakef'][row] == peakf[chan]
+
+        avg_slope, max_slope = get_slopes(x, dat.s_freq)
+        assert_allclose(table['avg_slope'][row], avg_slope)
+        assert_allclose(table['max_slope'][row], max_slope, atol=1e-8)
+
+
+def test_event_params():
+    out = event_params(segments, 'all', band=(1, 4), slopes=slopes)
+    assert len(out) == len(segments)
+
+    dat = segments[1]['data']
+    assert list(out[1]['maxamp'].axis) == ['chan']
+    assert_array_equal(out[1]['maxamp'].axis['chan'][0], dat.axis['chan'][0])
+    assert_allclose(out[1]['maxamp'].data[0], dat.data[0].max(axis=1))
+    assert set(out[1]['slope']) == set(dat.axis['chan'][0])
+
+    assert event_params(segments, {k: 0 for k in PARAM_KEYS}) == []
+
+
+def test_event_params_empty():
+    assert event_params([], 'all') == []
+    assert event_params([], 'all', band=(1, 4), slopes=slopes) == []
+
+    table = event_params_table([], 'all', band=(1, 4), slopes=slopes)
+    assert len(table['segment']) == 0
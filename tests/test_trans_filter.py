@@ -1,8 +1,12 @@
+from numpy import arange, concatenate
 from numpy.random import seed
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from pytest import raises
+from scipy.signal import sosfilt, sosfilt_zi
 
 from wonambi.utils import create_data
-from wonambi.trans import filter_, frequency, convolve
+from wonambi.trans import filter_, frequency, convolve, select, StreamFilter
+from wonambi.trans.cache import FILTERS
 
 
 seed(0)
@@ -29,6 +33,26 @@ def test_filter():
     filter_(data, low_cut=100)
 
 
+def test_filter_trials():
+    data_trials = create_data(n_trial=3)
+    filt = filter_(data_trials, low_cut=10, high_cut=100)
+    assert filt.data[0].base is filt.data[2].base
+
+    filt_threads = filter_(data_trials, low_cut=10, high_cut=100, n_jobs=2)
+    for i in range(3):
+        one_trial = filter_(select(data_trials, trial=[i]), low_cut=10,
+                            high_cut=100)
+        assert_array_almost_equal(filt.data[i], one_trial.data[0])
+        assert_array_almost_equal(filt.data[i], filt_threads.data[i])
+
+
+def test_filter_cache():
+    n_hits = FILTERS.n_hits
+    filter_(data, low_cut=12, high_cut=15)
+    filter_(data, low_cut=12, high_cut=15)
+    assert FILTERS.n_hits == n_hits + 1
+
+
 def test_filter_notch():
     filt = filter_(data, ftype='notch')
 
@@ -38,6 +62,49 @@ def test_filter_notch():
     assert (freq_data(trial=0, freq=50) > freq_filt(trial=0, freq=50)).all()
 
 
+def _chunks(data, edges=(0, 0.5, 0.51, 3, 7.2, 10)):
+    for beg, end in zip(edges[:-1], edges[1:]):
+        yield select(data, time=(beg, end))
+
+
+def test_filter_stream_causal():
+    data_long = create_data(n_trial=1, time=(0, 10))
+    filt = StreamFilter(data_long.s_freq, low_cut=1, high_cut=30)
+
+    x = concatenate([filt(chunk).data[0] for chunk in _chunks(data_long)],
+                    axis=1)
+    assert filt.flush() is None
+
+    dat = data_long.data[0]
+    zi = sosfilt_zi(filt.sos)[:, None, :] * dat[None, :, :1]
+    assert_array_almost_equal(x, sosfilt(filt.sos, dat, zi=zi)[0])
+
+
+def test_filter_stream_zero_phase():
+    data_long = create_data(n_trial=1, time=(0, 10))
+    filt = StreamFilter(data_long.s_freq, low_cut=1, high_cut=30,
+                        zero_phase=True)
+    filtered = [filt(chunk) for chunk in _chunks(data_long)]
+    filtered.append(filt.flush())
+    assert filtered[0].number_of('time')[0] == 0  # shorter than the delay
+
+    x = concatenate([one.data[0] for one in filtered], axis=1)
+    time = concatenate([one.axis['time'][0] for one in filtered])
+    assert_array_equal(time, data_long.axis['time'][0])
+
+    whole = filter_(data_long, low_cut=1, high_cut=30).data[0]
+    n_pad = int(filt.delay * data_long.s_freq)
+    middle = arange(n_pad, x.shape[1] - n_pad)
+    assert_array_almost_equal(x[:, middle], whole[:, middle], decimal=3)
+
+    with raises(ValueError):
+        StreamFilter.from_transform(data_long.s_freq, 'morlet', {})
+    filt = StreamFilter.from_transform(data_long.s_freq, 'double_butter',
+                                       {'freq': (1, 30), 'order': 3},
+                                       padding=1)
+    assert filt.delay == 1
+
+
 # =============================================================================
 # def test_convolve():
 #     convolve(data, 'hann')
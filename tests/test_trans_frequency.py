@@ -1,11 +1,16 @@
+from importlib import import_module
+
 from wonambi.utils import create_data
 from numpy import arange, pi, sqrt, cos, sum
 from scipy.signal.spectral import _spectral_helper
 from numpy.random import seed
 from numpy.testing import assert_array_equal, assert_array_almost_equal, assert_almost_equal
 
-from wonambi.trans.frequency import _fft
-from wonambi.trans import frequency, math, timefrequency
+from scipy.signal import fftconvolve
+from wonambi.trans.cache import TAPERS
+from wonambi.trans.frequency import (_create_morlet, _create_tapers, _fft,
+                                     _group_trials)
+from wonambi.trans import frequency, math, select, timefrequency
 
 
 CORRECTION_FACTOR = 2 / 3
@@ -46,6 +51,57 @@ def test_trans_frequency():
     assert 4.7 ** 2 < (p_freq.data[0][0] / p_freq.data[0][1]) < (5.45 ** 2)
 
 
+def test_trans_frequency_trials():
+    seed(0)
+    data = create_data(n_trial=5, n_chan=2, s_freq=s_freq, time=(0, dur))
+    data.data[3] = data.data[3][:, :300]
+    data.axis['time'][3] = data.axis['time'][3][:300]
+
+    freq = frequency(data, taper='dpss', duration=1)
+    assert freq.data[3].shape == (2, s_freq // 2 + 1)
+    assert freq.data[0].base is freq.data[4].base
+    assert freq.data[0].base.shape == (4, 2, s_freq // 2 + 1)
+
+    trials, batches = _group_trials(data, max_trials=3)[0]
+    assert trials == [0, 1, 2, 4]
+    assert batches == [[0, 1, 2], [4]]
+
+    freq1 = frequency(select(data, trial=[0, 1, 2, 4]), taper='dpss')
+    assert freq1.trials_array().base is freq1.data[0].base
+
+    for i in range(data.number_of('trial')):
+        one_trial = frequency(select(data, trial=[i]), taper='dpss',
+                              duration=1)
+        assert_array_almost_equal(freq.data[i], one_trial.data[0])
+
+
+def test_trans_frequency_tapers_cache(tmp_path, monkeypatch):
+    tapers = _create_tapers('dpss', 512, s_freq, 'power', NW=3)
+    assert tapers.shape == (5, 512)
+    assert not tapers.flags.writeable
+    assert _create_tapers('dpss', 512, s_freq, 'power', NW=3) is tapers
+
+    TAPERS.directory = tmp_path / 'tapers'
+    try:
+        TAPERS.clear()
+        tapers = _create_tapers('dpss', 300, s_freq, 'power', NW=2)
+        assert len(list(TAPERS.directory.glob('dpss_*.npy'))) == 1
+
+        # the second time, the tapers are read from disk, not computed
+        TAPERS.clear()
+        monkeypatch.setattr(import_module('wonambi.trans.frequency'), '_dpss',
+                            _not_computed)
+        assert_array_equal(tapers, _create_tapers('dpss', 300, s_freq, 
+                                                  'power', NW=2))
+    finally:
+        TAPERS.directory = None
+        TAPERS.clear()
+
+
+def _not_computed(*args):
+    raise AssertionError('tapers should be read from disk')
+
+
 def test_trans_frequency_complex():
     seed(0)
     data = create_data(n_trial=1, n_chan=2, s_freq=s_freq, time=(0, dur))
@@ -80,6 +136,25 @@ def test_trans_timefrequency_stft():
     assert timefreq.data[0].shape == (data.number_of('chan')[0], 3, s_freq, NW * 2 - 1)
 
 
+def test_trans_timefrequency_morlet():
+    seed(0)
+    data = create_data(n_trial=2, n_chan=2, s_freq=s_freq, time=(0, dur))
+    foi = arange(2, 30, 4)
+    timefreq = timefrequency(data, method='morlet', foi=foi)
+    assert timefreq.list_of_axes == ('chan', 'time', 'freq')
+    assert timefreq.data[1].shape == (2, dur * s_freq, len(foi))
+
+    wavelets = _create_morlet({'foi': foi, 'normalization': 'area'}, s_freq)
+    for i_chan in range(2):
+        for i_freq, wavelet in enumerate(wavelets):
+            tf = fftconvolve(data.data[1][i_chan], wavelet, 'same')
+            assert_array_almost_equal(timefreq.data[1][i_chan, :, i_freq], tf)
+
+    power = timefrequency(data, method='morlet', foi=foi, output='power', 
+                          n_jobs=1)
+    assert_array_almost_equal(power.data[0], abs(timefreq.data[0]) ** 2)
+
+
 seed(0)
 data = create_data(n_trial=1, n_chan=2, s_freq=s_freq, time=(0, dur), amplitude=10)
 x = data(trial=0, chan='chan00')
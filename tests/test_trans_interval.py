@@ -0,0 +1,93 @@
+from numpy import array
+from numpy.random import randint, seed
+from numpy.testing import assert_array_equal
+
+from wonambi import Dataset
+from wonambi.attr import Annotations
+from wonambi.attr.annotations import create_empty_annotations
+from wonambi.ioeeg import write_wonambi
+from wonambi.trans import remove_artf_evts
+from wonambi.trans.reject import _remove_artf_sequential
+from wonambi.trans.interval import as_intervals, difference, find_gaps, union
+from wonambi.utils import create_data
+
+from .paths import interval_file, interval_annot_file
+
+
+def test_interval_union():
+    merged = union(as_intervals([(5, 8), (0, 2), (2, 3), (6, 7), (10, 11)]))
+    assert_array_equal(merged, [[0, 3], [5, 8], [10, 11]])
+
+    assert union(as_intervals([])).shape == (0, 2)
+
+
+def test_interval_difference():
+    intervals = as_intervals([(0, 10), (20, 30), (40, 50)])
+    parts, idx = difference(intervals, as_intervals([(2, 3), (3, 4), (8, 22),
+                                                     (45, 60)]))
+    assert_array_equal(parts, [[0, 2], [4, 8], [22, 30], [40, 45]])
+    assert_array_equal(idx, [0, 0, 1, 2])
+
+    parts, idx = difference(intervals, as_intervals([(2, 3), (8, 22)]),
+                            min_dur=3)
+    assert_array_equal(parts, [[3, 8], [22, 30], [40, 50]])
+    assert_array_equal(idx, [0, 1, 2])
+
+
+def test_interval_find_gaps():
+    gaps = find_gaps(as_intervals([(0, 1), (1.005, 2), (3, 4), (4, 5)]))
+    assert_array_equal(gaps, [True, False, True, False])
+
+
+def test_interval_remove_artf_evts():
+    write_wonambi(create_data(time=(0, 100)), interval_file)
+    create_empty_annotations(interval_annot_file, Dataset(interval_file))
+    annot = Annotations(interval_annot_file)
+    annot.add_rater('test')
+    annot.add_events([{'start': 12, 'end': 15}, {'start': 14, 'end': 16},
+                      {'start': 40, 'end': 41},
+                      {'start': 58, 'end': 70}], name='Artefact', chan='')
+
+    times = [(0, 30), (30, 60), (60, 90)]
+    new_times = remove_artf_evts(times, annot, min_dur=1)
+    assert new_times == [(0, 12), (16, 30), (30, 40), (41, 58), (70, 90)]
+    assert type(new_times[0][0]) is int
+
+    assert remove_artf_evts(times, annot, name='Arousal') == times
+
+
+class _Artefacts:
+    """Annotations with only the artefacts, with the times as given."""
+    def __init__(self, events):
+        self.events = events
+
+    def get_events(self, name=None, time=None, chan=None):
+        return [dict(x) for x in self.events if x['name'] == name and
+                time[0] <= x['end'] and time[1] >= x['start']]
+
+
+def test_interval_remove_artf_evts_types():
+    seed(0)
+    for i in range(500):
+        events = []
+        for j in range(randint(1, 6)):
+            start = randint(0, 60)
+            events.append({'name': 'Artefact',
+                           'start': (int, float)[j % 2](start),
+                           'end': (int, float)[j % 2](start + randint(0, 10))})
+        if i % 2:
+            events.append(dict(events[0], start=float(events[0]['start'])))
+        annot = _Artefacts(events)
+
+        times = [(0, 20), (20, 35.), (38., 50)]
+        min_dur = (0.1, 1, 2)[i % 3]
+        new_times = remove_artf_evts(times, annot, min_dur=min_dur)
+
+        artefact = sorted(annot.get_events('Artefact', (0, 50)),
+                          key=lambda x: x['start'])
+        expected = times
+        if artefact:
+            expected = _remove_artf_sequential(times, artefact, min_dur)
+        assert new_times == expected
+        assert ([tuple(type(t) for t in x) for x in new_times] ==
+                [tuple(type(t) for t in x) for x in expected])
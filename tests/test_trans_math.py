@@ -1,4 +1,6 @@
-from numpy import power, mean, nanmax, std
+from copy import deepcopy
+
+from numpy import corrcoef, power, mean, nanmax, ravel, std, transpose
 from numpy.testing import assert_array_equal
 from pytest import raises
 
@@ -97,3 +99,29 @@ def test_math_diff():
     dat = data(trial=0, chan='chan01')[2] - data(trial=0, chan='chan01')[1]
     dat1 = data1(trial=0, chan='chan01')[2]
     assert dat == dat1
+
+
+def test_math_packed():
+    data_packed = deepcopy(data)
+    data_packed.pack()
+
+    for operator_name in ('square', ('square', 'mean'), 'diff'):
+        data1 = math(data, operator_name=operator_name, axis='time')
+        data2 = math(data_packed, operator_name=operator_name, axis='time')
+        assert data2.data[0].base is data2.data[9].base
+        for x1, x2 in zip(data1.data, data2.data):
+            assert_array_equal(x1, x2)
+
+    # functions which depend on the shape are run on each trial
+    for operator in (transpose, ravel, corrcoef):
+        data1 = math(data, operator=operator)
+        data2 = math(data_packed, operator=operator)
+        for x1, x2 in zip(data1.data, data2.data):
+            assert_array_equal(x1, x2)
+
+    errors = []
+    for one_data in (data, data_packed):
+        with raises(ValueError) as err:
+            math(one_data, operator_name=('mean', 'std'), axis='time')
+        errors.append(str(err.value))
+    assert errors[0] == errors[1]
@@ -1,16 +1,18 @@
-from numpy import arange
+from numpy import arange, hstack, linspace
 from numpy.random import seed
 from numpy.testing import assert_array_equal, assert_array_almost_equal
 from pytest import approx, raises
 
 from wonambi import Dataset
 from wonambi.attr import Annotations
+from wonambi.ioeeg import write_wonambi
 from wonambi.utils import create_data
 from wonambi.trans import select, resample, frequency, get_times, fetch
-from wonambi.trans.select import _create_subepochs
+from wonambi.trans.select import Segments, _create_subepochs
 
 from .paths import (annot_psg_path,
                     gui_file,
+                    segments_file,
                     )
 
 seed(0)
@@ -119,6 +121,22 @@ def test_select_interval_not_in_data():
     assert data1.data[-1].shape[1] == 0
 
 
+def test_select_interval_view():
+    data1 = select(data, time=(0.2, 0.5), chan=['chan01', 'chan02'])
+    assert data1.data[0].base is None  # copy by default
+    assert data1.axis['time'][0].base is None
+
+    data1 = select(data, time=(0.2, 0.5), chan=['chan01', 'chan02'],
+                   copy=False)
+    assert data1.data[0].base is data.data[0]
+    assert_array_equal(data1.axis['time'][0],
+                       data.axis['time'][0][(data.axis['time'][0] >= 0.2) &
+                                            (data.axis['time'][0] < 0.5)])
+
+    data2 = select(data, time=data.axis['time'][0] < 0.5)
+    assert_array_equal(data2.data[0], data1.data[0].base[:, :128])
+
+
 def test_select_oneside_interval_0():
     data1 = select(data, time=(None, 0.5))
 
@@ -161,6 +179,30 @@ def test_resample():
     assert_array_almost_equal(sum(freq.data[0][0, :]),
                               sum(freq1.data[0][0, :]),
                               4)
+
+
+def test_resample_poly():
+    data = create_data(n_trial=1, s_freq=1000, time=(0, 10))
+
+    data1 = resample(data, s_freq=256, method='poly')
+    data2 = resample(data, s_freq=256, method='poly', max_size=1000)
+    assert data1.number_of('time')[0] == 2560
+    assert_array_almost_equal(data1.data[0], data2.data[0])
+    assert_array_almost_equal(data1.axis['time'][0], arange(2560) / 256)
+
+    data.data[0] = data.data[0].astype('float32')
+    data1 = resample(data, s_freq=256, method='poly')
+    data2 = resample(data, s_freq=256, method='poly', max_size=1000)
+    assert data1.data[0].dtype == data2.data[0].dtype == 'float32'
+
+    data3 = resample(data, s_freq=250, method='poly')  # decimation
+    assert data3.data[0].shape == (8, 2500)
+
+    data4 = resample(data, s_freq=256)
+    assert data4.data[0].shape == (8, 2560)
+    assert_array_almost_equal(data4.axis['time'][0], 
+                              linspace(0, 10, 2560))
+
     
 def test_get_times():
     annot = Annotations(str(annot_psg_path))
@@ -187,3 +229,28 @@ def test_fetch():
     seg.read_data(['EEG Fpz-Cz'], ref_chan=['EEG Pz-Oz'])
     assert seg[0]['data']()[0][0].shape == (297000,)
     assert approx(seg[0]['data']()[0][0][100]) == -4.3201466  
+
+
+def test_segments_read_data():
+    write_wonambi(create_data(time=(0, 20)), segments_file)
+    dset = Dataset(segments_file)
+
+    times = [[(1, 2), (2, 3.5)], [(3, 4)], [(10, 11), (5, 6), (7, 8)]]
+    for n_jobs, max_size in ((1, 2 ** 24), (2, 1000)):
+        seg = Segments(dset)
+        seg.segments = [{'times': t, 'chan': '', 'stage': None, 'cycle': None,
+                         'name': None} for t in times]
+        seg.read_data(['chan01', 'chan02'], ref_chan=['chan03'],
+                      n_jobs=n_jobs, max_size=max_size)
+
+        for one_seg, one_times in zip(seg, times):
+            dat = [dset.read_data(['chan01', 'chan03'], begtime=t0,
+                                  endtime=t1) for t0, t1 in one_times]
+            assert_array_equal(one_seg['data'].axis['time'][0],
+                               hstack([x.axis['time'][0] for x in dat]))
+            assert_array_almost_equal(
+                one_seg['data'](chan='chan01')[0],
+                hstack([x.data[0][0] - x.data[0][1] for x in dat]),
+                decimal=5)
+        assert seg[0]['n_stitch'] == 0
+        assert seg[2]['n_stitch'] == 1
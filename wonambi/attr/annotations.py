@@ -1,20 +1,25 @@
 """Module to keep track of the user-made annotations and sleep scoring.
 """
 from logging import getLogger
-from bisect import bisect_left
-from itertools import groupby
+from itertools import combinations, groupby
 from csv import reader, writer
+from copy import deepcopy
 from json import dump
 from datetime import datetime, timedelta
-from numpy import (allclose, arange, around, asarray, clip, diff, isnan,
-                   logical_and, modf, nan)
+from functools import partial
+from multiprocessing import Pool
+from numpy import (allclose, arange, argsort, around, asarray, bincount, clip,
+                   concatenate, cumsum, datetime64, diff, empty, flatnonzero,
+                   intersect1d, isin, isnan, logical_and, modf, nan, ones,
+                   searchsorted, split, timedelta64, trace, unique, where)
 from math import ceil, inf
 from os.path import basename, splitext
 from pathlib import Path
-from re import search, sub
+from re import DOTALL, finditer, search, sub
 from scipy.io import loadmat
-from xml.etree.ElementTree import Element, SubElement, tostring, parse
+from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
 from xml.dom.minidom import parseString
+from xml.sax.saxutils import unescape
 
 try:
     from PyQt5.QtCore import Qt
@@ -29,6 +34,11 @@ from ..utils.exceptions import UnrecognizedFormat
 
 lg = getLogger(__name__)
 VERSION = '5'
+# last format which could parse a datetime, for each list of formats
+_LAST_DATETIME_FMT = {}
+# one rater in the xml text, either empty or with its subtree
+RATER_PATTERN = (r'(?P<tag><rater\b[^>]*>)'
+                 r'(?:(?<=/>)|(?P<body>.*?)</rater\s*>)')
 DOMINO_STAGE_KEY = {'N1': 'NREM1',
                     'N2': 'NREM2',
                     'N3': 'NREM3',
@@ -339,24 +349,132 @@ class Annotations():
     def __init__(self, xml_file, rater_name=None):
 
         self.xml_file = xml_file
-        self.root = self.load()
+        self._lazy_raters = {}
+        self._columns = {}
+        self._agreement = {}
+        self._generation = {}
+        self.root = self.load(rater_name)
         if rater_name is None:
             self.rater = self.root.find('rater')
         else:
             self.get_rater(rater_name)
 
-    def load(self):
-        """Load xml from file."""
+    def load(self, rater_name=None):
+        """Load xml from file.
+
+        Parameters
+        ----------
+        rater_name : str, optional
+            rater to read in full (if None, the first rater)
+
+        Returns
+        -------
+        instance of Element
+            root of the xml tree
+
+        Notes
+        -----
+        The file is read only once. The other raters are kept as empty
+        placeholders (with only their attributes) and their xml text is parsed
+        when get_rater switches to them or before saving.
+        """
         lg.info('Loading ' + str(self.xml_file))
-        update_annotation_version(self.xml_file)
+        with open(self.xml_file, 'r') as f:
+            s = f.read()
+
+        m = search('<annotations version="([0-9]*)">', s)
+        if m is not None and int(m.groups()[0]) < int(VERSION):
+            update_annotation_version(self.xml_file)
+            with open(self.xml_file, 'r') as f:
+                s = f.read()
+
+        root, self._lazy_raters = _parse_raters(s, rater_name)
+        self._columns = {}
+        return root
+
+    def _materialize(self, raters):
+        """Parse the subtree of raters which are only placeholders.
+
+        Parameters
+        ----------
+        raters : list of instances of Element
+            raters to read in full (those which are already complete are
+            ignored)
+        """
+        for rater in raters:
+            rater_xml = self._lazy_raters.pop(rater, None)
+            if rater_xml is not None:
+                lg.debug('Parsing rater ' + rater.get('name'))
+                rater.extend(list(fromstring(rater_xml)))
 
-        xml = parse(self.xml_file)
-        return xml.getroot()
+    def _event_columns(self, rater=None):
+        """Events of one rater as arrays, cached until the rater is modified.
+
+        Parameters
+        ----------
+        rater : instance of Element, optional
+            rater of interest (if None, the current rater)
+
+        Returns
+        -------
+        dict of ndarray
+            with 'name', 'start', 'end', 'chan' (as stored in the xml) and
+            'quality', one value per event, in the order of the xml file
+        """
+        return self._cached_columns(rater, _event_columns)
+
+    def _epoch_columns(self, rater=None):
+        """Epochs of one rater as arrays, cached until the rater is modified.
+
+        Parameters
+        ----------
+        rater : instance of Element, optional
+            rater of interest (if None, the current rater)
+
+        Returns
+        -------
+        dict of ndarray
+            with 'start' (int), 'end' (int), 'stage' and 'quality', one value
+            per epoch
+        """
+        return self._cached_columns(rater, _epoch_columns)
+
+    def _cached_columns(self, rater, to_columns):
+        if rater is None:
+            rater = self.rater
+        self._materialize([rater, ])
+
+        generation = self._generation.get(rater, 0)
+        cached = self._columns.get((rater, to_columns))
+        if cached is None or cached[0] != generation:
+            cached = generation, to_columns(rater)
+            self._columns[rater, to_columns] = cached
+
+        return {k: v.copy() for k, v in cached[1].items()}
+
+    def _changed(self, rater=None):
+        """Mark one rater as modified, so that its cached columns and
+        agreement are computed again.
+
+        Parameters
+        ----------
+        rater : instance of Element, optional
+            rater which was modified (if None, the current rater)
+        """
+        if rater is None:
+            rater = self.rater
+        if rater is not None:
+            self._generation[rater] = self._generation.get(rater, 0) + 1
+            self._agreement = {k: v for k, v in self._agreement.items()
+                               if rater not in k[1:3]}
 
     def save(self):
         """Save xml to file."""
+        self._materialize(list(self._lazy_raters))
+
         if self.rater is not None:
             self.rater.set('modified', datetime.now().isoformat())
+            self._changed()
 
         xml = parseString(tostring(self.root))
         with open(self.xml_file, 'w') as f:
@@ -407,6 +525,8 @@ class Annotations():
             raise KeyError(rater_name + ' not in the list of raters (' +
                            ', '.join(self.raters) + ')')
 
+        self._materialize([self.rater, ])
+
     def add_rater(self, rater_name, epoch_length=30):
         if rater_name in self.raters:
             lg.warning('rater ' + rater_name + ' already exists, selecting it')
@@ -434,6 +554,7 @@ class Annotations():
         for rater in self.root.iterfind('rater'):
             if rater.get('name') == name:
                 rater.set('name', new_name)
+                self._changed(rater)
 
         self.save()
 
@@ -455,6 +576,7 @@ class Annotations():
                         self.rater = all_raters[idx]
 
                 self.root.remove(rater)
+                self._changed(rater)
 
         self.save()
 
@@ -749,20 +871,23 @@ class Annotations():
 
         self.get_rater(rater_name)
         stages = self.rater.find('stages')
+        self._changed()
 
         if as_qual:
+            # look up epochs by start time, instead of scanning them each time
+            epochs = {}
+            for one_epoch in stages.iterfind('epoch'):
+                epochs.setdefault(int(one_epoch.find('epoch_start').text),
+                                  one_epoch)
 
             for i, one_line in enumerate(lines[idx_first_line:]):
 
                 if one_line[idx_stage] in poor:
                     epoch_beg = first_second + (i * epoch_length)
 
-                    try:
-                        self.set_stage_for_epoch(epoch_beg, 'Poor',
-                                                 attr='quality',
-                                                 save=False)
-                    except KeyError:
+                    if epoch_beg not in epochs:
                         return 1
+                    epochs[epoch_beg].find('quality').text = 'Poor'
 
         else:
             # list is necessary so that it does not remove in place
@@ -1045,25 +1170,28 @@ class Annotations():
             save events to this or these channel(s). If None, channel will be
             read from the event list dict under 'chan'
         """
-        if name is not None:
-            evt_name = name
-            if name not in self.event_types:
-                self.add_event_type(name)
-
         events = self.rater.find('events')
-        
+        event_types = {}
+        for e_type in events:
+            event_types.setdefault(e_type.get('type'), e_type)
+        if name is not None and name not in event_types:
+            event_types[name] = SubElement(events, 'event_type')
+            event_types[name].set('type', name)
+
         if parent is not None:
             progress = QProgressDialog('Saving events', 'Abort',
-                               0, len(events) - 1, parent)
+                               0, len(event_list) - 1, parent)
             progress.setWindowModality(Qt.ApplicationModal)
 
         for i, evt in enumerate(event_list):
+            evt_name = name
             if name is None:
                 evt_name = evt['name']
-                if evt_name not in self.event_types:
-                    self.add_event_type(evt_name)
-            pattern = "event_type[@type='" + evt_name + "']"
-            event_type = events.find(pattern)
+            if evt_name not in event_types:
+                event_types[evt_name] = SubElement(events, 'event_type')
+                event_types[evt_name].set('type', evt_name)
+            event_type = event_types[evt_name]
+
             new_event = SubElement(event_type, 'event')
             event_start = SubElement(new_event, 'event_start')
             event_start.text = str(evt['start'])
@@ -1084,6 +1212,7 @@ class Annotations():
             if parent is not None:
                 progress.setValue(i)
                 if progress.wasCanceled():
+                    self._changed()  # some events were added already
                     return
 
         self.save()
@@ -1158,11 +1287,9 @@ class Annotations():
             When there is no rater / epochs at all
         """
         # get events inside window
-        events = self.rater.find('events')
-        if name is not None:
-            pattern = "event_type[@type='" + name + "']"
-        else:
-            pattern = "event_type"
+        if self.rater is None:
+            raise IndexError('You need to have at least one rater')
+        cols = self._event_columns()
 
         if chan is not None:
             if isinstance(chan, (tuple, list)):
@@ -1171,85 +1298,55 @@ class Annotations():
                 else:
                     chan = None
 
-        if stage or qual:
-            ep_starts = [x['start'] for x in self.epochs]
-            if stage:
-                ep_stages = [x['stage'] for x in self.epochs]
-            if qual:
-                ep_quality = [x['quality'] for x in self.epochs]
-                
-        if cycle:
+        good = ones(len(cols['start']), dtype=bool)
+        if name is not None:
+            good &= cols['name'] == name
+        if time is not None:
+            good &= (time[0] <= cols['end']) & (time[1] >= cols['start'])
+        if chan is not None:
+            good &= cols['chan'] == chan
+
+        if stage is not None or qual is not None:
+            epochs = list(self.epochs)
+            ep_starts = asarray([x['start'] for x in epochs])
+            # epoch where each event starts (the last one, if it starts before
+            # the first epoch)
+            pos = searchsorted(ep_starts, cols['start'], side='right') - 1
+
+        if stage is not None:
+            ep_stages = asarray([x['stage'] for x in epochs], dtype=object)
+            ev_stage = ep_stages[pos]
+            good &= asarray([x in stage for x in ev_stage], dtype=bool)
+
+        if qual is not None:
+            ep_quality = asarray([x['quality'] for x in epochs], dtype=object)
+            good &= ep_quality[pos] == qual
+
+        if cycle:  # an empty list means no selection on cycles
+            ev_cycle = empty(len(cols['start']), dtype=object)
             cycles = self.get_cycles()
+            if cycles is not None:
+                for cyc_start, cyc_end, cyc_number in cycles[::-1]:
+                    in_cycle = ((cyc_start <= cols['start']) &
+                                (cols['start'] < cyc_end))
+                    ev_cycle[in_cycle] = cyc_number
+            good &= asarray([x in cycle for x in ev_cycle], dtype=bool)
 
         ev = []
-        for e_type in events.iterfind(pattern):
-
-            event_name = e_type.get('type')
-
-            for e in e_type:
-
-                event_start = float(e.find('event_start').text)
-                event_end = float(e.find('event_end').text)
-                event_chan = e.find('event_chan').text
-                event_qual = e.find('event_qual').text
-                if event_chan is None:  # xml doesn't store empty string
-                    event_chan = ''
-
-                if stage or qual:
-                    pos = bisect_left(ep_starts, event_start)
-                    if pos == len(ep_starts):
-                        pos -= 1
-                    elif event_start != ep_starts[pos]:
-                        pos -= 1
-
-                if stage is None:
-                    stage_cond = True
-                else:
-                    ev_stage = ep_stages[pos]
-                    stage_cond = ev_stage in stage
-
-                if qual is None:
-                    qual_cond = True
-                else:
-                    ev_qual = ep_quality[pos]
-                    qual_cond = ev_qual == qual
-                    
-                if cycle is None:
-                    cycle_cond = True
-                else:
-                    ev_cycle = None
-                    for cyc in cycles:
-                        cyc_start, cyc_end, cyc_number = cyc
-                        if cyc_start <= event_start < cyc_end:
-                            ev_cycle = cyc_number
-                            break
-                    cycle_cond = ev_cycle in cycle
-
-                if time is None:
-                    time_cond = True
-                else:
-                    time_cond = time[0] <= event_end and time[1] >= event_start
-
-                if chan is None:
-                    chan_cond = True
-                else:
-                    chan_cond = event_chan == chan
-
-                if (time_cond and chan_cond and stage_cond and qual_cond and 
-                    cycle_cond):
-                    one_ev = {'name': event_name,
-                              'start': event_start,
-                              'end': event_end,
-                              'chan': event_chan.split(', '),  # always a list
-                              'stage': '',
-                              'quality': event_qual,
-                              'cycle': '',
-                              }
-                    if stage is not None:
-                        one_ev['stage'] = ev_stage
-                    if cycle is not None:
-                        one_ev['cycle'] = ev_cycle
-                    ev.append(one_ev)
+        for i in good.nonzero()[0]:
+            one_ev = {'name': cols['name'][i],
+                      'start': float(cols['start'][i]),
+                      'end': float(cols['end'][i]),
+                      'chan': cols['chan'][i].split(', '),  # always a list
+                      'stage': '',
+                      'quality': cols['quality'][i],
+                      'cycle': '',
+                      }
+            if stage is not None:
+                one_ev['stage'] = ev_stage[i]
+            if cycle:
+                one_ev['cycle'] = ev_cycle[i]
+            ev.append(one_ev)
 
         return ev
 
@@ -1269,6 +1366,7 @@ class Annotations():
                         epoch_length) * epoch_length
 
         stages = self.rater.find('stages')
+        self._changed()
         for epoch_beg in range(first_second, last_sec, epoch_length):
             epoch = SubElement(stages, 'epoch')
 
@@ -1449,6 +1547,7 @@ class Annotations():
         for one_epoch in self.rater.iterfind('stages/epoch'):
             if int(one_epoch.find('epoch_start').text) == epoch_start:
                 one_epoch.find(attr).text = name
+                self._changed()
                 if save:
                     self.save()
                 return
@@ -1644,6 +1743,148 @@ class Annotations():
 
         return latency
 
+    def stage_agreement(self, raters=None):
+        """Epoch-by-epoch agreement on sleep stages for all pairs of raters.
+
+        Parameters
+        ----------
+        raters : list of str, optional
+            raters to compare (if None, all the raters)
+
+        Returns
+        -------
+        dict
+            for each pair of raters (tuple of two str), a dict with 'stages'
+            (list of str, all the stages scored by the raters), 'confusion'
+            (ndarray with the number of epochs, the first rater in the rows and
+            the second rater in the columns), 'n_epochs' (number of epochs
+            scored by both raters), 'agreement' (proportion of epochs with the
+            same stage) and 'kappa' (Cohen's kappa)
+
+        Notes
+        -----
+        Epochs are matched by their start time. The results are cached until
+        one of the two raters is modified.
+        """
+        raters = self._get_raters(raters)
+        if len(raters) < 2:
+            return {}
+        cols = [self._epoch_columns(r) for r in raters]
+        names = [r.get('name') for r in raters]
+
+        # the same codes for the stages of all the raters
+        all_stages = concatenate([x['stage'] for x in cols]).astype(str)
+        stages, codes = unique(all_stages, return_inverse=True)
+        codes = split(codes, cumsum([len(x['stage']) for x in cols])[:-1])
+        n_stages = len(stages)
+
+        output = {}
+        for i0, i1 in combinations(range(len(raters)), 2):
+            key = ('stage', raters[i0], raters[i1], tuple(stages))
+            if key not in self._agreement:
+                _, idx0, idx1 = intersect1d(cols[i0]['start'],
+                                            cols[i1]['start'],
+                                            return_indices=True)
+                pair = codes[i0][idx0] * n_stages + codes[i1][idx1]
+                confusion = bincount(pair, minlength=n_stages ** 2).reshape(
+                        n_stages, n_stages)
+                self._agreement[key] = _cohen_kappa(confusion, stages)
+
+            output[names[i0], names[i1]] = deepcopy(self._agreement[key])
+
+        return output
+
+    def event_agreement(self, raters=None, name=None, chan=None,
+                        threshold=0.5):
+        """Agreement on events for all pairs of raters, event types and
+        channels.
+
+        Parameters
+        ----------
+        raters : list of str, optional
+            raters to compare (if None, all the raters)
+        name : str or list of str, optional
+            event types of interest (if None, all the event types)
+        chan : str or list of str, optional
+            channels of interest, as stored in the events (if None, all the
+            channels)
+        threshold : float
+            minimum intersection-union score to match a pair of events, between
+            0 and 1 (see detect.agreement.match_events)
+
+        Returns
+        -------
+        dict
+            for each tuple of (rater, rater, event type, channel), a dict with
+            'n_tp', 'n_fp', 'n_fn', 'precision', 'recall' and 'f1score'. The
+            first rater is treated as detection and the second as standard.
+
+        Notes
+        -----
+        The results are cached until one of the two raters is modified.
+        """
+        # avoid circular import
+        from ..detect.agreement import MatchedEvents, match_intervals
+
+        if isinstance(name, str):
+            name = [name, ]
+        if isinstance(chan, str):
+            chan = [chan, ]
+
+        raters = self._get_raters(raters)
+        names = [r.get('name') for r in raters]
+        groups = []
+        for r in raters:
+            cols = self._event_columns(r)
+            good = ones(len(cols['start']), dtype=bool)
+            if name is not None:
+                good &= isin(cols['name'], name)
+            if chan is not None:
+                good &= isin(cols['chan'], chan)
+            groups.append(_group_events(cols, good))
+
+        output = {}
+        for i0, i1 in combinations(range(len(raters)), 2):
+            key = ('event', raters[i0], raters[i1], threshold,
+                   None if name is None else tuple(name),
+                   None if chan is None else tuple(chan))
+
+            if key not in self._agreement:
+                pair = {}
+                empty_group = (asarray([]), asarray([]))
+                for group in sorted(set(groups[i0]) | set(groups[i1])):
+                    det = groups[i0].get(group, empty_group)
+                    std = groups[i1].get(group, empty_group)
+                    tp, fp, fn = match_intervals(det[0], det[1], std[0],
+                                                 std[1], threshold)
+                    match = MatchedEvents(tp, fp, fn, None, None, threshold)
+                    pair[group] = {'n_tp': int(match.n_tp),
+                                   'n_fp': match.n_fp,
+                                   'n_fn': match.n_fn,
+                                   'precision': match.precision,
+                                   'recall': match.recall,
+                                   'f1score': match.f1score,
+                                   }
+                self._agreement[key] = pair
+
+            for (evt_name, evt_chan), stats in self._agreement[key].items():
+                output[names[i0], names[i1], evt_name, evt_chan] = dict(stats)
+
+        return output
+
+    def _get_raters(self, raters=None):
+        """Return the xml subtree of the raters of interest."""
+        all_raters = self.root.findall('rater')
+        if raters is None:
+            return all_raters
+
+        by_name = {r.get('name'): r for r in all_raters}
+        for r in raters:
+            if r not in by_name:
+                raise KeyError(r + ' not in the list of raters (' +
+                               ', '.join(self.raters) + ')')
+        return [by_name[r] for r in raters]
+
     def export(self, file_to_export, xformat='csv'):
         """Export epochwise annotations to csv file.
 
@@ -2147,13 +2388,15 @@ class Annotations():
                                    ])
 
     def import_events(self, filename, source='wonambi', rec_start=None,
-                      chan_dict=None, chan_grp_name='eeg', parent=None):
+                      chan_dict=None, chan_grp_name='eeg', parent=None,
+                      n_jobs=None):
         """Import events from Wonambi CSV event export and write to annot.
 
         Parameters
         ----------
         filename : str
-            path to file
+            path to file, or to a directory where all the files will be
+            imported
         source : str
             source program: 'wonambi' or 'remlogic'
         rec_start : datetime
@@ -2168,119 +2411,29 @@ class Annotations():
             for prana. name of the channel group in which to store events.
         parent : QWidget
             for GUI progress bar
-        """
-        events = []
-
-        if 'wonambi' == source:
-
-            with open(filename, 'r', encoding='utf-8') as csvfile:
-                csv_reader = reader(csvfile, delimiter=',')
+        n_jobs : int, optional
+            number of processes to read the files in a directory (if None,
+            the number of CPUs)
 
-                for row in csv_reader:
-                    try:
-                        int(row[0])
-                        one_ev = {'name': row[6],
-                                  'start': float(row[1]),
-                                  'end': float(row[2]),
-                                  'chan': row[7].split(', '),  # always a list
-                                  'stage': row[4],
-                                  'quality': 'Good'
-                                  }
-                        events.append(one_ev)
-
-                    except ValueError:
-                        continue
-
-        elif 'remlogic' == source:
-
-            with open(filename, 'r', encoding='ISO-8859-1') as f:
-                lines = f.readlines()
-                time_hdrs = ('Time [hh:mm:ss', 'Heure [hh:mm:ss')
-                idx_header = lines.index(next(
-                    l for l in lines if any(hdr in l for hdr in time_hdrs)))
-                header = lines[idx_header].split('\t')
-                header = [s.strip() for s in header] # remove trailing newline
-                
-                idx_time = [i for i, s in enumerate(header) if any(
-                    x in s for x in time_hdrs)][0]
-                idx_evt = [i for i, s in enumerate(header) if any(
-                    x in s for x in (
-                        'Event', 'vènement', 'vénement', 'venement') )][0]
-                idx_dur = [i for i, s in enumerate(header) if any(
-                    x in s for x in ('Duration', 'Durée') )][0]
-                
-                # French files are in 24-hour time
-                hour24 = 'Heure' in header[idx_time]
-
-                # Find staging start date
-                date_line = lines[3].strip()
-                stage_start_date = _try_parse_datetime(
-                    date_line[date_line.index(':') + 2:],
-                        ('%Y/%m/%d', '%d/%m/%Y', '%Y.%m.%d', '%d.%m.%Y'))
-
-                # Events loop
-                for l in lines[idx_header + 1:]:
-                    cells = l.split('\t')
-                    one_evttype = cells[idx_evt]
-
-                    # skip epoch staging
-                    if 'SLEEP-' in one_evttype:
-                        continue
-
-                    clock_start = _remlogic_time(cells[idx_time],
-                                                 stage_start_date,
-                                                 hour24=hour24)
-                    start = float((clock_start - rec_start).total_seconds())
-
-                    one_ev = {'name': one_evttype,
-                              'start': start,
-                              'end': start + float(cells[idx_dur]),
-                              'chan': '',
-                              'stage': '',
-                              'quality': 'Good'
-                                  }
-                    events.append(one_ev)
-                    
-        elif 'prana' == source:
-            
-            with open(filename, 'r', encoding='ISO-8859-1') as f:
-                lines = f.readlines()
-                
-                header = lines[0].split('\t')
-                header = [s.strip() for s in header] # remove trailing newline
-                idx_time = header.index('Start')
-                idx_evt = header.index('Type')
-                idx_dur = header.index('Duration')
-                idx_chan = header.index('Channel')
-                stage_start_date = self.start_time.date()
-                
-                for l in lines[1:]:
-                    cells = l.split('\t')
-                    one_evttype = cells[idx_evt]
-                    clock_start = _prana_time(cells[idx_time], 
-                                              stage_start_date)
-                    start = float((clock_start - rec_start).total_seconds())
-                    
-                    chan_label_prana = cells[idx_chan].strip()
-                    if chan_label_prana == 'All channels':
-                        chan = ''
-                    elif chan_dict:
-                        chan = chan_dict[chan_label_prana]
-                    else: # ignores reference
-                        active_chan = chan_label_prana[4:6]
-                        chan = f'{active_chan} ({chan_grp_name})'
-                    
-                    one_ev = {'name': one_evttype,
-                              'start': start,
-                              'end': start + float(cells[idx_dur]),
-                              'chan': chan,
-                              'stage': '',
-                              'quality': 'Good'
-                                  }
-                    events.append(one_ev)
+        Notes
+        -----
+        The events of all the files are written to the annotations in one
+        go, which is much faster than adding them one by one.
+        """
+        read_one = partial(_read_events, source=source, rec_start=rec_start,
+                           start_date=self.start_time.date(),
+                           chan_dict=chan_dict, chan_grp_name=chan_grp_name)
+
+        if Path(filename).is_dir():
+            all_files = sorted(x for x in Path(filename).iterdir()
+                               if x.is_file())
+            lg.info('Importing events from ' + str(len(all_files)) + ' files')
+            with Pool(n_jobs) as p:
+                events = [ev for one_file in p.map(read_one, all_files)
+                          for ev in one_file]
 
         else:
-            raise ValueError('Unknown source program for events file')
+            events = read_one(filename)
 
         self.add_events(events, parent=parent)
 
@@ -2393,15 +2546,207 @@ def update_annotation_version(xml_file):
         with open(xml_file, 'w') as f:
             f.write(s)
 
+def _parse_raters(s, rater_name=None):
+    """Parse the annotation xml, building the tree of only one rater.
+
+    Parameters
+    ----------
+    s : str
+        content of the xml file with the sleep scoring
+    rater_name : str, optional
+        rater to read in full (if None, the first rater)
+
+    Returns
+    -------
+    instance of Element
+        root of the xml tree
+    dict
+        the other raters, which contain only their attributes, and the xml
+        text of their full subtree
+    """
+    spans = list(finditer(RATER_PATTERN, s, DOTALL))
+    names = []
+    for m in spans:
+        name = search(r'\bname="([^"]*)"', m.group('tag'))
+        names.append(None if name is None else unescape(name.groups()[0]))
+    if rater_name is None:
+        i_keep = 0
+    elif rater_name in names:
+        i_keep = names.index(rater_name)
+    else:
+        i_keep = None  # get_rater will complain
+
+    skeleton = []
+    last = 0
+    for i, m in enumerate(spans):
+        skeleton.append(s[last:m.start()])
+        if i == i_keep or m.group('body') is None:
+            skeleton.append(m.group())
+        else:  # keep only the attributes
+            skeleton.append(m.group('tag')[:-1] + '/>')
+        last = m.end()
+    skeleton.append(s[last:])
+
+    root = fromstring(''.join(skeleton))
+
+    lazy = {}
+    for i, (rater, m) in enumerate(zip(root.iterfind('rater'), spans)):
+        if i != i_keep and m.group('body') is not None:
+            lazy[rater] = m.group()
+
+    return root, lazy
+
+
+def _event_columns(rater):
+    """Collect all the events of one rater into arrays.
+
+    Parameters
+    ----------
+    rater : instance of Element
+        xml subtree of one rater
+
+    Returns
+    -------
+    dict of ndarray
+        with 'name', 'start', 'end', 'chan' (as stored in the xml) and
+        'quality', one value per event, in the order of the xml file
+    """
+    names = []
+    starts = []
+    ends = []
+    chans = []
+    quals = []
+    for e_type in rater.iterfind('events/event_type'):
+        event_name = e_type.get('type')
+        for e in e_type:
+            names.append(event_name)
+            starts.append(float(e.find('event_start').text))
+            ends.append(float(e.find('event_end').text))
+            event_chan = e.find('event_chan').text
+            if event_chan is None:  # xml doesn't store empty string
+                event_chan = ''
+            chans.append(event_chan)
+            quals.append(e.find('event_qual').text)
+
+    cols = {'start': asarray(starts, dtype=float),
+            'end': asarray(ends, dtype=float),
+            }
+    for k, v in (('name', names), ('chan', chans), ('quality', quals)):
+        cols[k] = empty(len(v), dtype=object)
+        cols[k][:] = v
+
+    return cols
+
+
+def _epoch_columns(rater):
+    """Collect all the epochs of one rater into arrays.
+
+    Parameters
+    ----------
+    rater : instance of Element
+        xml subtree of one rater
+
+    Returns
+    -------
+    dict of ndarray
+        with 'start' (int), 'end' (int), 'stage' and 'quality', one value per
+        epoch
+    """
+    epochs = rater.findall('stages/epoch')
+    cols = {'start': asarray([int(x.find('epoch_start').text)
+                              for x in epochs], dtype=int),
+            'end': asarray([int(x.find('epoch_end').text)
+                            for x in epochs], dtype=int),
+            }
+    for k in ('stage', 'quality'):
+        cols[k] = empty(len(epochs), dtype=object)
+        cols[k][:] = [x.find(k).text for x in epochs]
+
+    return cols
+
+
+def _group_events(cols, good):
+    """Split the events of one rater by event type and channel.
+
+    Parameters
+    ----------
+    cols : dict of ndarray
+        events of one rater, see _event_columns
+    good : ndarray of bool
+        events to include
+
+    Returns
+    -------
+    dict
+        for each (event type, channel), a tuple with the start and end times
+        of the events, in the order of the xml file
+    """
+    if not good.any():
+        return {}
+
+    evt_names, i_name = unique(cols['name'][good].astype(str),
+                               return_inverse=True)
+    evt_chans, i_chan = unique(cols['chan'][good].astype(str),
+                               return_inverse=True)
+    group = i_name * len(evt_chans) + i_chan
+    order = argsort(group, kind='stable')
+    bounds = flatnonzero(diff(group[order])) + 1
+
+    starts = cols['start'][good][order]
+    ends = cols['end'][good][order]
+    groups = {}
+    for idx in split(arange(len(order)), bounds):
+        one_group = group[order[idx[0]]]
+        key = (evt_names[one_group // len(evt_chans)],
+               evt_chans[one_group % len(evt_chans)])
+        groups[key] = starts[idx], ends[idx]
+
+    return groups
+
+
+def _cohen_kappa(confusion, stages):
+    """Agreement statistics from a confusion matrix of sleep stages."""
+    n_epochs = confusion.sum()
+    if n_epochs == 0:
+        agreement = kappa = nan
+    else:
+        agreement = trace(confusion) / n_epochs
+        chance = (confusion.sum(axis=1) @ confusion.sum(axis=0)) / n_epochs ** 2
+        if chance == 1:
+            kappa = nan
+        else:
+            kappa = (agreement - chance) / (1 - chance)
+
+    return {'stages': list(stages),
+            'confusion': confusion,
+            'n_epochs': int(n_epochs),
+            'agreement': agreement,
+            'kappa': kappa,
+            }
+
+
 def _abs_time_str(delay, abs_start, time_str='%Y-%m-%dT%H:%M:%S'):
     return (abs_start + timedelta(seconds=float(delay))).strftime(time_str)
 
 def _try_parse_datetime(text, fmts):
-    for fmt in fmts:
+    """Parse text with the first format that works, starting with the format
+    which worked the last time (files use the same format in every row)."""
+    fmts = tuple(fmts)
+    last_fmt = _LAST_DATETIME_FMT.get(fmts)
+    if last_fmt is not None:
         try:
-            return datetime.strptime(text, fmt)
+            return datetime.strptime(text, last_fmt)
         except ValueError:
             pass
+
+    for fmt in fmts:
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        _LAST_DATETIME_FMT[fmts] = fmt
+        return parsed
+
     raise ValueError('No valid date found.')
 
 def _remlogic_time(time_cell, date, hour24):
@@ -2462,3 +2807,219 @@ def _prana_time(time_cell, date):
         start = start + timedelta(hours=24)
 
     return start
+
+def _read_events(filename, source, rec_start, start_date, chan_dict=None,
+                 chan_grp_name='eeg'):
+    """Read all the events in one file exported by another program.
+
+    Parameters
+    ----------
+    filename : path to file
+        file with the events
+    source : str
+        source program: 'wonambi', 'remlogic' or 'prana'
+    rec_start : datetime
+        Date and time of recording start (only for remlogic and prana)
+    start_date : date
+        date of the start of the recording (only for prana)
+    chan_dict : dict
+        for prana, see Annotations.import_events
+    chan_grp_name : str
+        for prana, see Annotations.import_events
+
+    Returns
+    -------
+    list of dict
+        where each dict has 'name', 'start', 'end', 'chan', 'stage', 'quality'
+    """
+    if 'wonambi' == source:
+
+        with open(filename, 'r', encoding='utf-8') as csvfile:
+            rows = []
+            for row in reader(csvfile, delimiter=','):
+                try:
+                    int(row[0])
+                except (ValueError, IndexError):
+                    continue
+                rows.append(row)
+
+        if not rows:
+            return []
+        cols = list(zip(*rows))
+        starts = asarray(cols[1], dtype=float)
+        ends = asarray(cols[2], dtype=float)
+
+        return [{'name': name,
+                 'start': start,
+                 'end': end,
+                 'chan': chan.split(', '),  # always a list
+                 'stage': stage,
+                 'quality': 'Good'
+                 } for name, start, end, chan, stage in zip(
+                         cols[6], starts.tolist(), ends.tolist(), cols[7],
+                         cols[4])]
+
+    elif 'remlogic' == source:
+
+        with open(filename, 'r', encoding='ISO-8859-1') as f:
+            lines = f.readlines()
+
+        time_hdrs = ('Time [hh:mm:ss', 'Heure [hh:mm:ss')
+        idx_header = lines.index(next(
+            l for l in lines if any(hdr in l for hdr in time_hdrs)))
+        header = lines[idx_header].split('\t')
+        header = [s.strip() for s in header] # remove trailing newline
+
+        idx_time = [i for i, s in enumerate(header) if any(
+            x in s for x in time_hdrs)][0]
+        idx_evt = [i for i, s in enumerate(header) if any(
+            x in s for x in (
+                'Event', 'vènement', 'vénement', 'venement') )][0]
+        idx_dur = [i for i, s in enumerate(header) if any(
+            x in s for x in ('Duration', 'Durée') )][0]
+
+        # French files are in 24-hour time
+        hour24 = 'Heure' in header[idx_time]
+
+        # Find staging start date
+        date_line = lines[3].strip()
+        stage_start_date = _try_parse_datetime(
+            date_line[date_line.index(':') + 2:],
+                ('%Y/%m/%d', '%d/%m/%Y', '%Y.%m.%d', '%d.%m.%Y'))
+
+        # skip epoch staging
+        rows = [l.split('\t') for l in lines[idx_header + 1:]]
+        rows = [cells for cells in rows if 'SLEEP-' not in cells[idx_evt]]
+        if not rows:
+            return []
+        cols = list(zip(*rows))
+
+        starts = _remlogic_times(cols[idx_time], stage_start_date, hour24,
+                                 rec_start)
+        ends = starts + asarray(cols[idx_dur], dtype=float)
+
+        return [{'name': name,
+                 'start': start,
+                 'end': end,
+                 'chan': '',
+                 'stage': '',
+                 'quality': 'Good'
+                 } for name, start, end in zip(
+                         cols[idx_evt], starts.tolist(), ends.tolist())]
+
+    elif 'prana' == source:
+
+        with open(filename, 'r', encoding='ISO-8859-1') as f:
+            lines = f.readlines()
+
+        header = lines[0].split('\t')
+        header = [s.strip() for s in header] # remove trailing newline
+        idx_time = header.index('Start')
+        idx_evt = header.index('Type')
+        idx_dur = header.index('Duration')
+        idx_chan = header.index('Channel')
+
+        rows = [l.split('\t') for l in lines[1:]]
+        if not rows:
+            return []
+        cols = list(zip(*rows))
+
+        starts = _prana_times(cols[idx_time], start_date, rec_start)
+        ends = starts + asarray(cols[idx_dur], dtype=float)
+
+        chans = {}
+        for chan_label_prana in set(cols[idx_chan]):
+            label = chan_label_prana.strip()
+            if label == 'All channels':
+                chans[chan_label_prana] = ''
+            elif chan_dict:
+                chans[chan_label_prana] = chan_dict[label]
+            else: # ignores reference
+                active_chan = label[4:6]
+                chans[chan_label_prana] = f'{active_chan} ({chan_grp_name})'
+
+        return [{'name': name,
+                 'start': start,
+                 'end': end,
+                 'chan': chans[chan],
+                 'stage': '',
+                 'quality': 'Good'
+                 } for name, start, end, chan in zip(
+                         cols[idx_evt], starts.tolist(), ends.tolist(),
+                         cols[idx_chan])]
+
+    else:
+        raise ValueError('Unknown source program for events file')
+
+
+def _clock_times(date, time_strs, rec_start):
+    """Convert many clock times on the same date, all at once.
+
+    Parameters
+    ----------
+    date : date
+        date of all the clock times
+    time_strs : list of str
+        clock times as 'HH:MM:SS' or 'HH:MM:SS.ffffff'
+    rec_start : datetime
+        Date and time of recording start
+
+    Returns
+    -------
+    ndarray of timedelta64
+        time from the recording start
+
+    Raises
+    ------
+    ValueError
+        when one of the clock times cannot be read
+    """
+    day = date.isoformat() + 'T'
+    clock = asarray([day + x for x in time_strs], dtype='datetime64[us]')
+    return clock - datetime64(rec_start, 'us')
+
+
+def _remlogic_times(time_cells, date, hour24, rec_start):
+    """Read a column of RemLogic time cells, see _remlogic_time.
+
+    Returns
+    -------
+    ndarray
+        time in s from the recording start
+    """
+    time_strs = [x[x.index(':') - 2:] for x in time_cells]
+    try:
+        starts = _clock_times(date.date(), time_strs, rec_start)
+
+    except ValueError:  # unusual format, read it one by one
+        return asarray([(_remlogic_time(x, date, hour24) -
+                         rec_start).total_seconds() for x in time_cells])
+
+    if not hour24:
+        hours = asarray([int(x[:2]) for x in time_strs])
+        starts[hours == 12] -= timedelta64(12, 'h')  # 12-hour clock
+        afternoon = asarray([x[1] == 'U' for x in time_cells], dtype=bool)
+        starts += where(afternoon, 12, 24).astype('timedelta64[h]')
+
+    return starts / timedelta64(1, 's')
+
+
+def _prana_times(time_cells, date, rec_start):
+    """Read a column of PRANA time cells, see _prana_time.
+
+    Returns
+    -------
+    ndarray
+        time in s from the recording start
+    """
+    try:
+        starts = _clock_times(date, [x[3:] for x in time_cells], rec_start)
+
+    except ValueError:  # unusual format, read it one by one
+        return asarray([(_prana_time(x, date) - rec_start).total_seconds()
+                        for x in time_cells])
+
+    next_day = asarray([x[1] == '2' for x in time_cells], dtype=bool)
+    starts[next_day] += timedelta64(24, 'h')
+
+    return starts / timedelta64(1, 's')
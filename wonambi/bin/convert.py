@@ -92,7 +92,7 @@ def main():
 
     if args.sampling_freq is not None:
         lg.info(f'Resampling to {args.sampling_freq}')
-        data = resample(data, s_freq=args.sampling_freq)
+        data = resample(data, s_freq=args.sampling_freq, method='poly')
 
     outfile = Path(args.outfile)
     if outfile.suffix == '.edf':
@@ -26,7 +26,7 @@ from .ioeeg import (Abf,
                     LyonRRI,
                     )
 from .ioeeg.bci2000 import _read_header_length
-from .datatype import ChanTime
+from .datatype import ChanTime, _empty_trials
 from .utils import UnrecognizedFormat
 
 
@@ -400,7 +400,14 @@ class Dataset:
                 dat = concatenate((dat, zero_ref), axis=0)
                 chan_in_dat.append('_REF')
 
-            data.data[i] = dat
+            if n_trl > 1 and i == 0:  # all the trials in one buffer
+                data.data = _empty_trials(
+                    [(dat.shape[0], e - b) for b, e in zip(begsam, endsam)],
+                    dat.dtype)
+            if n_trl > 1 and data.data[i].shape == dat.shape:
+                data.data[i][...] = dat
+            else:
+                data.data[i] = dat
             data.axis['chan'][i] = asarray(chan_in_dat, dtype='U')
             if events is not None:
                 data.axis['time'][i] = event_t
@@ -8,12 +8,19 @@ from collections import OrderedDict
 from collections.abc import Iterable
 from copy import deepcopy
 from logging import getLogger
+from hashlib import blake2b
 from pathlib import Path
 
-from numpy import arange, array, empty, ix_, nan, squeeze, where
+from numpy import (arange, argsort, array, ascontiguousarray, asarray,
+                   concatenate, cumsum, diff, empty, flatnonzero, ix_, moveaxis,
+                   nan, ndarray, prod, result_type, searchsorted, squeeze,
+                   stack, where, zeros)
 
 lg = getLogger()
 
+MAX_SORTED_AXES = 64  # number of axes whose sorted values are kept in memory
+_SORTED_AXES = OrderedDict()
+
 
 class Data:
     """General class containing recordings.
@@ -92,7 +99,7 @@ class Data:
                      'scores': None,
                      }
 
-    def __call__(self, trial=None, tolerance=None, **axes):
+    def __call__(self, trial=None, tolerance=None, copy=True, **axes):
         """Return the recordings and their time stamps.
 
         Parameters
@@ -107,6 +114,11 @@ class Data:
             if one of the axiss is a number, it specifies the tolerance to
             consider one value as chosen (take into account floating-precision
             errors).
+        copy : bool
+            if False, it returns a view of the data when possible (when the
+            selected values are contiguous in each axis), which is much faster.
+            Do not modify the output in that case, because it modifies the
+            data as well.
 
         Returns
         -------
@@ -124,6 +136,9 @@ class Data:
         -----
         You cannot specify intervals here, you can do it in Select.
 
+        If all the selected values are present and contiguous, the data is
+        sliced (and copied if copy=True). Otherwise, the output is filled with
+        NaN where the values are not in the data.
         """
         if trial is None:
             trial = range(self.number_of('trial'))
@@ -143,6 +158,7 @@ class Data:
             idx_data = []
             idx_output = []
             squeeze_axis = []
+            idx_slice = []
 
             for axis, values in self.axis.items():
                 if axis in axes.keys():
@@ -150,10 +166,12 @@ class Data:
                     if (isinstance(selected_values, Iterable) and
                         not isinstance(selected_values, str)):
                         n_values = len(selected_values)
+                        one_value = False
                     else:
                         n_values = 1
                         selected_values = array([selected_values])
                         squeeze_axis.append(self.index_of(axis))
+                        one_value = True
 
                     idx = _get_indices(values[i],
                                        selected_values,
@@ -163,13 +181,27 @@ class Data:
 
                     idx_data.append(idx[0])
                     idx_output.append(idx[1])
+                    if idx_slice is not None:
+                        idx_slice.append(_as_slice(idx[0], n_values,
+                                                   one_value))
                 else:
                     n_values = len(values[i])
                     idx_data.append(arange(n_values))
                     idx_output.append(arange(n_values))
+                    if idx_slice is not None:
+                        idx_slice.append(slice(None))
+
+                if idx_slice is not None and idx_slice[-1] is None:
+                    idx_slice = None
 
                 output_shape.append(n_values)
 
+            if idx_slice is not None:
+                output[cnt] = self.data[i][tuple(idx_slice) + (Ellipsis, )]
+                if copy:
+                    output[cnt] = output[cnt].copy()
+                continue
+
             output[cnt] = empty(output_shape, dtype=self.data[i].dtype)
             output[cnt].fill(nan)
 
@@ -300,6 +332,46 @@ class Data:
 
             yield output
 
+    def pack(self):
+        """Store all the trials in one contiguous buffer.
+
+        Notes
+        -----
+        data.data keeps one array for each trial, but they are views of the
+        same buffer. If all the trials have the same shape, trials_array
+        returns all the trials at once without copying them, so that the
+        transformations can operate on all the trials together.
+
+        Assigning a new array to one trial (data.data[i] = x) works as
+        before, but then the trials are not stored in one buffer anymore.
+        """
+        if len(self.data) == 0 or _trials_buffer(self.data) is not None:
+            return
+
+        packed = _empty_trials([x.shape for x in self.data],
+                               result_type(*self.data))
+        for one_packed, one_trial in zip(packed, self.data):
+            one_packed[...] = one_trial
+        self.data = packed
+
+    def trials_array(self):
+        """Return all the trials in one array, with trial as first dimension.
+
+        Returns
+        -------
+        ndarray
+            all the trials, as a view of the data if the trials are stored in
+            one buffer (see pack), otherwise as a copy
+
+        Raises
+        ------
+        ValueError
+            if the trials do not have the same shape
+        """
+        if len(set(x.shape for x in self.data)) > 1:
+            raise ValueError('The trials should have the same shape')
+        return _stack_trials(self.data)
+
     def _copy(self, axis=True, attr=True, data=False):
         """Create a new instance of Data, but does not copy the data
         necessarily.
@@ -466,6 +538,95 @@ class ChanTimeFreq(Data):
         self.axis['freq'] = array([], dtype='O')
 
 
+def _empty_trials(shapes, dtype='d'):
+    """Allocate the data of all the trials in one contiguous buffer.
+
+    Parameters
+    ----------
+    shapes : list of tuple of int
+        shape of each trial
+    dtype : dtype
+        type of the data
+
+    Returns
+    -------
+    ndarray (dtype='O')
+        for each trial, a view of the buffer
+    """
+    sizes = [int(prod(shape)) for shape in shapes]
+    offsets = concatenate(([0, ], cumsum(sizes, dtype=int)))
+    buffer = empty(offsets[-1], dtype=dtype)
+
+    trials = empty(len(shapes), dtype='O')
+    for i, shape in enumerate(shapes):
+        trials[i] = buffer[offsets[i]:offsets[i + 1]].reshape(shape)
+    return trials
+
+
+def _trials_buffer(trials):
+    """Return the trials as one array without copying the data, if they are
+    consecutive views of the same buffer (with the same shape).
+
+    Parameters
+    ----------
+    trials : list or ndarray (dtype='O') of ndarray
+        data of each trial
+
+    Returns
+    -------
+    ndarray or None
+        the trials, with trial as first dimension (None if they are not stored
+        in one buffer)
+    """
+    if len(trials) == 0:
+        return None
+
+    first = trials[0]
+    base = first.base
+    if not isinstance(base, ndarray) or not base.flags.c_contiguous:
+        # f.e. trials read with mmap_mode have a mmap.mmap as base
+        return None
+
+    start = first.__array_interface__['data'][0]
+    step = first.nbytes
+    for i, one_trial in enumerate(trials):
+        if (one_trial.base is not base or one_trial.shape != first.shape or
+                one_trial.dtype != first.dtype or
+                not one_trial.flags.c_contiguous or
+                one_trial.__array_interface__['data'][0] != start + i * step):
+            return None
+
+    offset = start - base.__array_interface__['data'][0]
+    if base.dtype != first.dtype or offset % first.itemsize:
+        return None
+    offset //= first.itemsize
+    flat = base.reshape(-1)
+    return flat[offset:offset + len(trials) * first.size].reshape(
+        (len(trials), ) + first.shape)
+
+
+def _stack_trials(trials, axis=0):
+    """Stack the trials (with the same shape), without copying them if they
+    are stored in one buffer.
+
+    Parameters
+    ----------
+    trials : list or ndarray (dtype='O') of ndarray
+        data of each trial
+    axis : int
+        axis of the output which corresponds to the trials
+
+    Returns
+    -------
+    ndarray
+        the trials stacked along axis (a view if possible, do not modify it)
+    """
+    x = _trials_buffer(trials)
+    if x is None:
+        return stack(list(trials), axis=axis)
+    return moveaxis(x, 0, axis)
+
+
 def _get_indices(values, selected, tolerance):
     """Get indices based on user-selected values.
 
@@ -480,23 +641,33 @@ def _get_indices(values, selected, tolerance):
 
     Returns
     -------
-    idx_data : list of int
+    idx_data : ndarray of int
         indices of row/column to select the data
-    idx_output : list of int
+    idx_output : ndarray of int
         indices of row/column to copy into output
 
     Notes
     -----
-    This function is probably not very fast, but it's pretty robust. It keeps
-    the order, which is extremely important.
+    It keeps the order, which is extremely important. If a value is repeated
+    in the axis, it returns the first one.
 
     If you use values in the self.axis, you don't need to specify tolerance.
     However, if you specify arbitrary points, floating point errors might
     affect the actual values. Of course, using tolerance is much slower.
 
+    Without tolerance, the values are looked up in the sorted axis (see
+    _sorted_axis), so the cost does not depend on the number of selected
+    values.
+
     Maybe tolerance should be part of Select instead of here.
 
     """
+    if tolerance is None or values.dtype.kind == 'U':
+        try:
+            return _find_sorted(values, selected)
+        except TypeError:  # cannot compare the values, f.e. str and float
+            pass
+
     idx_data = []
     idx_output = []
     for idx_of_selected, one_selected in enumerate(selected):
@@ -510,4 +681,76 @@ def _get_indices(values, selected, tolerance):
             idx_data.append(idx_of_data[0])
             idx_output.append(idx_of_selected)
 
-    return idx_data, idx_output
+    return (asarray(idx_data, dtype=int), asarray(idx_output, dtype=int))
+
+
+def _find_sorted(values, selected):
+    """Find the first index of each selected value, using the sorted axis."""
+    selected = asarray(selected)
+    if values.dtype.kind == 'O' or selected.dtype.kind == 'O':
+        raise TypeError('Cannot sort objects')
+    if (values.dtype.kind in 'US') != (selected.dtype.kind in 'US'):
+        raise TypeError('Cannot compare strings and numbers')
+
+    sorter, sorted_values = _sorted_axis(values)
+    if len(sorted_values) == 0:
+        pos = zeros(selected.shape, dtype=int)
+        found = zeros(selected.shape, dtype=bool)
+    else:
+        pos = searchsorted(sorted_values, selected)
+        pos[pos == len(sorted_values)] = 0
+        found = sorted_values[pos] == selected
+
+    return sorter[pos[found]], flatnonzero(found)
+
+
+def _sorted_axis(values):
+    """Sort the values of the axis (it keeps the first one if a value is
+    repeated). The last MAX_SORTED_AXES axes are kept in memory, based on
+    their content.
+
+    Returns
+    -------
+    sorter : ndarray of int
+        indices which sort the values
+    sorted_values : ndarray
+        sorted values
+    """
+    values = ascontiguousarray(values)
+    key = (values.shape, values.dtype.str,
+           blake2b(values.view('u1').data, digest_size=16).digest())
+
+    cached = _SORTED_AXES.get(key)
+    if cached is None:
+        sorter = argsort(values, kind='stable')
+        cached = _SORTED_AXES[key] = sorter, values[sorter]
+        while len(_SORTED_AXES) > MAX_SORTED_AXES:
+            _SORTED_AXES.popitem(last=False)
+
+    return cached
+
+
+def _as_slice(idx, n_values, one_value=False):
+    """Convert the indices into a slice, if they are contiguous.
+
+    Parameters
+    ----------
+    idx : ndarray of int
+        indices of the data
+    n_values : int
+        number of values which were selected
+    one_value : bool
+        if the axis should be squeezed (then it returns an int)
+
+    Returns
+    -------
+    slice or int or None
+        None if some values are missing or the indices are not contiguous
+    """
+    if len(idx) != n_values or n_values == 0:
+        return None
+    if one_value:
+        return int(idx[0])
+    if n_values > 1 and (diff(idx) != 1).any():
+        return None
+    return slice(int(idx[0]), int(idx[-1]) + 1)
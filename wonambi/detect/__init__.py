@@ -5,3 +5,5 @@ from .ripple import DetectRipple
 from .slowwave import DetectSlowWave
 from .arousal import DetectArousal
 from .agreement import consensus, match_events
+from .stream import detect_stream
+from .cache import TransformCache, detect_multiple
@@ -1,18 +1,22 @@
 """Module for agreement and consensus analysis between raters"""
 
-from numpy import (arange, argmax, asarray, concatenate, diff, invert, 
-                   logical_and, maximum, mean, minimum, newaxis, ones, repeat, 
-                   sum, vstack, where, zeros)
+from numpy import (arange, argsort, asarray, bincount, clip, concatenate, 
+                   cumsum, diff, full, invert, isnan, lexsort, logical_and, 
+                   maximum, minimum, nan, ndarray, ones, repeat, searchsorted,
+                   unique, where, zeros)
+from scipy.sparse import csr_matrix
 
 from .. import Graphoelement
+from ..graphoelement import Events
 
 class MatchedEvents:
     """Class for storing matched events and producing statistics.
     
     Parameters
     ----------
-    tp : ndarray
-        true positives as boolean array of shape len(detection) x len(standard)
+    tp : scipy.sparse.csr_matrix or ndarray
+        true positives as boolean matrix of shape len(detection) x 
+        len(standard)
     fp : ndarray
         indices of false positives in detection
     fn : ndarray
@@ -33,7 +37,7 @@ class MatchedEvents:
         self.detection = detection
         self.standard = standard
         self.threshold = threshold        
-        self.n_tp = sum(tp)
+        self.n_tp = tp.sum()
         self.n_fp = len(fp)
         self.n_fn = len(fn)
 
@@ -80,10 +84,10 @@ class MatchedEvents:
             events = cons.events
         
         elif 'tp_det' == category:
-            events = asarray(self.detection)[self.tp.any(axis=1)]
+            events = asarray(self.detection)[unique(self.tp.nonzero()[0])]
             
         elif 'tp_std' == category:
-            events = asarray(self.standard)[self.tp.any(axis=0)] 
+            events = asarray(self.standard)[unique(self.tp.nonzero()[1])]
             
         elif 'fp' == category:
             events = asarray(self.detection)[self.fp]
@@ -105,7 +109,8 @@ class MatchedEvents:
         self.to_annot(annot, 'fn', names[3])
 
 
-def consensus(events, threshold, s_freq, min_duration=None, weights=None):
+def consensus(events, threshold, s_freq, min_duration=None, weights=None,
+              per_chan=False):
     """Take two or more event lists and output a merged list based on 
     consensus.
     
@@ -127,49 +132,40 @@ def consensus(events, threshold, s_freq, min_duration=None, weights=None):
         minimum duration for merged events, in s.
     weights : list of float
         a vector of relative weights of each event type
+    per_chan : bool
+        if True, compute the consensus separately for each channel (events
+        are compared only with events on the same channel). If False, all the
+        events are compared and the merged events get the channel of the first
+        event.
         
     Returns
     -------
     instance of wonambi.Graphoelement
         events merged by consensus
+
+    Notes
+    -----
+    The samples are not computed one by one: the consensus is constant between
+    the start and end samples of the events, so it is computed once for each 
+    of these segments. Memory depends on the number of events, not on the 
+    duration of the recording.
     """
-    chan = [one_rater[0]['chan'] for one_rater in events if one_rater][0]
-    beg = min([one_rater[0]['start'] for one_rater in events if one_rater])
-    end = max([one_rater[-1]['end'] for one_rater in events if one_rater])
-    n_samples = int((end - beg) * s_freq)
-    times = arange(beg, end + 1/s_freq, 1/s_freq)
     if weights is None:
         weights = ones(len(events))
+    values = [full(len(one_rater), wt, dtype=float) 
+              for one_rater, wt in zip(events, weights)]
     
-    positives = zeros((len(events), n_samples))
-    for i, (one_rater, wt) in enumerate(zip(events, weights)):
-        for ev in one_rater:
-            n_start = int((ev['start'] - beg) * s_freq)
-            n_end = int((ev['end'] - beg) * s_freq)
-            positives[i, n_start:n_end].fill(wt)
-                
-    consensus = mean(positives, axis=0)
-    consensus[consensus >= threshold] = 1
-    consensus[consensus < 1] = 0
-    consensus = concatenate(([0], consensus, [0]))
-    on_off = diff(consensus)
-    onsets = where(on_off == 1)
-    offsets = where(on_off == -1)
-    start_times = times[onsets]
-    end_times = times[offsets]
-    merged = vstack((start_times, end_times))
+    def _threshold(positives):
+        consensus = positives / len(events)
+        consensus[consensus >= threshold] = 1
+        consensus[consensus < 1] = 0
+        return consensus
     
-    if min_duration:
-        merged = merged[:, merged[1, :] - merged[0, :] >= min_duration]
-        
-    out = Graphoelement()
-    out.events = [{'start': merged[0, i], 
-                   'end': merged[1, i],
-                   'chan': chan} for i in range(merged.shape[1])]
+    return _consensus(events, values, _threshold, s_freq, None, min_duration,
+                      per_chan)
 
-    return out     
-
-def consensus_exact(events, threshold, s_freq, window=None, min_duration=None, weights=None):
+def consensus_exact(events, threshold, s_freq, window=None, min_duration=None, 
+                    weights=None, per_chan=False):
     """Take two or more event lists and output a merged list based on 
     consensus, where agreement is exactly equal to a threshold.
     This is useful when combining >2 event types, and creating a 
@@ -189,10 +185,15 @@ def consensus_exact(events, threshold, s_freq, window=None, min_duration=None, w
         belonging to a merged event.
     s_freq : int
         sampling frequency, in Hz
+    window : tuple of float, optional
+        start and end time (in s) of the period used for the consensus. If 
+        None, it spans from the first to the last event.
     min_duration : float, optional
         minimum duration for merged events, in s.
     weights : a dict containing event names (str) and their corresponding 
         weighting (int) e.g. {'low' : 1,'med' : 2,'high' : 3}
+    per_chan : bool
+        if True, compute the consensus separately for each channel
         
     Returns
     -------
@@ -204,86 +205,237 @@ def consensus_exact(events, threshold, s_freq, window=None, min_duration=None, w
     This function is a modification of agreement.consensus contributed by 
     Nathan Cross.
     """
-    chan = [one_rater[0]['chan'] for one_rater in events if one_rater][0]
+    if weights is None:
+        weights = {'low':1,'med':2,'high':3}
+    
+    values = []
+    for one_rater in events:
+        names = _column(one_rater, 'name')
+        values.append(asarray([weights[name] if name in ('low', 'med', 'high')
+                               else nan for name in names], dtype=float))
+        
+    def _threshold(positives):
+        consensus = positives
+        consensus[consensus != threshold] = 0
+        consensus[consensus == threshold] = 1
+        return consensus
+    
+    return _consensus(events, values, _threshold, s_freq, window, 
+                      min_duration, per_chan)
+
+def _consensus(events, values, threshold, s_freq, window, min_duration,
+               per_chan):
+    """Compute consensus between raters, on the segments between the start 
+    and end samples of all the events.
+    
+    Parameters
+    ----------
+    events : tuple of lists of dict
+        two or more lists of events from different raters
+    values : list of ndarray
+        for each rater, value assigned to the samples of each event (NaN to
+        ignore the event)
+    threshold : function
+        takes the sum of the values across raters (for each segment) and 
+        returns 1 for the segments belonging to a merged event
+    s_freq, window, min_duration, per_chan
+        see consensus_exact
+        
+    Returns
+    -------
+    instance of wonambi.Graphoelement
+        events merged by consensus
+    """
+    non_empty = [one_rater for one_rater in events if len(one_rater)]
+    chan = non_empty[0][0]['chan']
     if window is None:
-        beg = min([one_rater[0]['start'] for one_rater in events if one_rater])
-        end = max([one_rater[-1]['end'] for one_rater in events if one_rater])
+        beg = min([one_rater[0]['start'] for one_rater in non_empty])
+        end = max([one_rater[-1]['end'] for one_rater in non_empty])
     else:
         beg = window[0]
         end = window[1]
-   
+
     n_samples = int((end - beg) * s_freq)
-    times = arange(beg, end + 1/s_freq, 1/s_freq)
-    if weights is None:
-        weights = {'low':1,'med':2,'high':3}
+    # same time points as arange(beg, end, 1 / s_freq)
+    step = (beg + 1 / s_freq) - beg
     
-    positives = zeros((len(events), n_samples))
-    for i, one_rater in enumerate(events):
-        for ev in one_rater:
-            n_start = int((ev['start'] - beg) * s_freq)
-            n_end = int((ev['end'] - beg) * s_freq)
-            if ev['name'] == 'low':
-                positives[i, n_start:n_end].fill(weights['low'])
-            elif ev['name'] == 'med':
-                positives[i, n_start:n_end].fill(weights['med'])
-            elif ev['name'] == 'high':
-                positives[i, n_start:n_end].fill(weights['high'])
-                
-    consensus = sum(positives, axis=0)
-    consensus[consensus != threshold] = 0
-    consensus[consensus == threshold] = 1  
-    consensus = concatenate(([0], consensus, [0]))
-    on_off = diff(consensus)
-    onsets = where(on_off == 1)
-    offsets = where(on_off == -1)
-    start_times = times[onsets]
-    end_times = times[offsets]
-    merged = vstack((start_times, end_times))
+    n_start = []
+    n_end = []
+    for one_rater in events:
+        n_start.append(_to_sample(_column(one_rater, 'start'), beg, s_freq, 
+                                  n_samples))
+        n_end.append(_to_sample(_column(one_rater, 'end'), beg, s_freq, 
+                                n_samples))
+
+    if per_chan:
+        chan_keys = [[_chan_key(x) for x in _column(one_rater, 'chan')]
+                     for one_rater in events]
+        chans = {}
+        for one_rater, one_keys in zip(events, chan_keys):
+            for i, key in enumerate(one_keys):
+                if key not in chans:
+                    chans[key] = one_rater[i]['chan']
+        groups = [(chans[key], [asarray([x == key for x in one_keys], 
+                                        dtype=bool) 
+                                for one_keys in chan_keys]) 
+                  for key in chans]
+    else:
+        groups = [(chan, [ones(len(one_start), dtype=bool) 
+                          for one_start in n_start])]
+
+    merged = []
+    for one_chan, masks in groups:
+        onsets, offsets = _sweep(
+                [x[m] for x, m in zip(n_start, masks)],
+                [x[m] for x, m in zip(n_end, masks)],
+                [x[m] for x, m in zip(values, masks)],
+                n_samples, threshold)
+        merged.extend((beg + on * step, beg + off * step, one_chan) 
+                      for on, off in zip(onsets, offsets))
     
+    if per_chan:
+        merged.sort(key=lambda x: x[0])
+
     if min_duration:
-        merged = merged[:, merged[1, :] - merged[0, :] >= min_duration]
+        merged = [x for x in merged if x[1] - x[0] >= min_duration]
         
     out = Graphoelement()
-    out.events = [{'start': merged[0, i], 
-                   'end': merged[1, i],
-                   'chan': chan} for i in range(merged.shape[1])]
+    out.events = [{'start': start_time,
+                   'end': end_time,
+                   'chan': one_chan} for start_time, end_time, one_chan 
+                  in merged]
 
-    return out 
-            
-def match_events(detection, standard, threshold):
-    """Find best matches between detected and standard events, by a thresholded
-    intersection-union rule.
+    return out
+
+def _sweep(n_start, n_end, values, n_samples, threshold):
+    """Find the periods where the raters agree, with a sweep over the start 
+    and end samples of the events.
     
     Parameters
     ----------
-    detection : list of dict
-        list of detected events to be tested against the standard, with 
-        'start', 'end' and 'chan'
-    standard : list of dict
-        list of ground-truth events, with 'start', 'end' and 'chan'
+    n_start, n_end : list of ndarray
+        for each rater, start and end sample of the events
+    values : list of ndarray
+        for each rater, value of each event
+    n_samples : int
+        number of samples
+    threshold : function
+        see _consensus
+        
+    Returns
+    -------
+    ndarray
+        first sample of each merged event
+    ndarray
+        sample after the last sample of each merged event
+    """
+    bounds = unique(concatenate([[0, n_samples], ] + n_start + n_end))
+    
+    positives = zeros(len(bounds) - 1)
+    for one_start, one_end, one_values in zip(n_start, n_end, values):
+        positives = positives + _paint(bounds, one_start, one_end, one_values)
+    
+    consensus = concatenate(([0], threshold(positives), [0]))
+    on_off = diff(consensus)
+    onsets = bounds[where(on_off == 1)]
+    offsets = bounds[where(on_off == -1)]
+    
+    return onsets, offsets
+
+def _paint(bounds, n_start, n_end, values):
+    """Value of one rater for each segment between bounds. When events of the
+    same rater overlap, the later event in the list is used."""
+    keep = (n_end > n_start) & ~isnan(values)
+    i_start = searchsorted(bounds, n_start[keep])
+    i_end = searchsorted(bounds, n_end[keep])
+    values = values[keep]
+    
+    painted = zeros(len(bounds) - 1)
+    if len(unique(values)) == 1:
+        count = cumsum(bincount(i_start, minlength=len(bounds)) - 
+                       bincount(i_end, minlength=len(bounds)))
+        painted[count[:-1] > 0] = values[0]
+    
+    else:
+        for b, e, v in zip(i_start, i_end, values):
+            painted[b:e] = v
+    
+    return painted
+
+def _to_sample(times, beg, s_freq, n_samples):
+    """Convert times to samples (rounding toward beg), between 0 and 
+    n_samples."""
+    n_smp = ((asarray(times, dtype=float) - beg) * s_freq).astype(int)
+    return clip(n_smp, 0, n_samples)
+
+def _column(events, key):
+    """Values of one key for all the events (list of dict or Events)."""
+    if isinstance(events, Events):
+        return events.columns[key] if len(events) else []
+    return [ev[key] for ev in events]
+
+def _chan_key(chan):
+    """Channel as a hashable value (channels in annotations are lists)."""
+    if isinstance(chan, (list, ndarray)):
+        return tuple(chan)
+    return chan
+
+def match_intervals(det_beg, det_end, std_beg, std_end, threshold):
+    """Find best matches between detected and standard intervals, by a 
+    thresholded intersection-union rule (see match_events).
+    
+    Parameters
+    ----------
+    det_beg, det_end : ndarray
+        start and end times of the detected events
+    std_beg, std_end : ndarray
+        start and end times of the ground-truth events
     threshold : float
         minimum intersection-union score to match a pair, between 0 and 1
         
     Returns
     -------
-    instance of MatchedEvents
-        indices of true positives, false positives and false negatives, with
-        statistics (recall, precision, F1)
-    """
-    # Vectorize start and end times and set up for broadcasting
-    det_beg = asarray([x['start'] for x in detection])[:, newaxis]
-    det_end = asarray([x['end'] for x in detection])[:, newaxis]
-    std_beg = asarray([x['start'] for x in standard])[newaxis, :]
-    std_end = asarray([x['end'] for x in standard])[newaxis, :]
+    scipy.sparse.csr_matrix
+        true positives as sparse boolean matrix of shape len(detection) x 
+        len(standard)
+    ndarray
+        indices of false positives in detection
+    ndarray
+        indices of false negatives in standard
 
-    # Get durations and broadcast them
-    det_dur = repeat(det_end - det_beg, len(standard), axis=1)
-    std_dur = repeat(std_end - std_beg, len(detection), axis=0)
+    Notes
+    -----
+    The intersection-union score is computed only for the pairs of intervals
+    which overlap, so memory depends on the number of overlapping pairs, not 
+    on len(detection) x len(standard). The matching is the same as when the
+    scores are stored in a full matrix: a pair is matched when each interval
+    is the best match of the other (the first one, for ties), in two rounds.
+    Like argmax on a row of zeros, an interval without any match counts as 
+    matching the first interval of the other list.
+    """
+    n_det = len(det_beg)
+    n_std = len(std_beg)
+    det_beg = asarray(det_beg, dtype=float)
+    det_end = asarray(det_end, dtype=float)
+    std_beg = asarray(std_beg, dtype=float)
+    std_end = asarray(std_end, dtype=float)
+    
+    # If no events, tp and fp are empty, fn is all events
+    if n_det == 0 or n_std == 0:
+        tp = csr_matrix((n_det, n_std), dtype=bool)
+        fp = asarray([])
+        fn = arange(n_std)
+        return tp, fp, fn
+    
+    i_det, i_std = _overlapping_pairs(det_beg, det_end, std_beg, std_end)
+    
+    # Get durations
+    det_dur = det_end[i_det] - det_beg[i_det]
+    std_dur = std_end[i_std] - std_beg[i_std]
     
-    # Subtract every end by every start and find overlaps
-    det_minus_std = det_end - std_beg # array of shape (len(det), len(std))
-    std_minus_det = std_end - det_beg    
-    overlapping = logical_and(det_minus_std > 0, std_minus_det > 0)
+    # Subtract ends by starts, for each overlapping pair
+    det_minus_std = det_end[i_det] - std_beg[i_std]
+    std_minus_det = std_end[i_std] - det_beg[i_det]
     
     # Find intersection and union
     shorter_diff = minimum(det_minus_std, std_minus_det)
@@ -294,44 +446,141 @@ def match_events(detection, standard, threshold):
     
     interx = minimum(shorter_diff, shorter_dur)
     union = maximum(longer_diff, longer_dur)
-        
-    # Compute intersection-union score and set non-overlapping pairs to 0
+    
+    # Compute intersection-union score and threshold it, to yield True 
+    # Positive candidates
     iu = interx / union
-    iu[invert(overlapping)] = 0
+    candidate = iu > threshold
+    i_det = i_det[candidate]
+    i_std = i_std[candidate]
+    iu = iu[candidate]
     
-    # Threshold IU score to yield  True Positive candidates
-    iu[iu <= threshold] = 0
+    # Find partial matches, round 1
+    det_match1 = _best_match(i_det, i_std, iu, n_det)
+    std_match1 = _best_match(i_std, i_det, iu, n_std)
     
-    # If no events, tp and fp are empty, fn is all events
-    if iu.size == 0:
-        tp = fp = asarray([])
-        fn = arange(len(standard))
-    else:
+    # Find full matches, round 1, then remove them from the candidates
+    tp_std1 = where(det_match1[std_match1] == arange(n_std))[0]
+    tp_det1 = std_match1[tp_std1]
     
-        # Find partial matches, round 1
-        det_match1 = argmax(iu, axis=1)
-        std_match1 = argmax(iu, axis=0)
-        
-        # Find full matches, round 1, then remove them from IU
-        tp = zeros(iu.shape, dtype=bool)
-        for i, j in enumerate(std_match1):
-            if det_match1[j] == i:
-                tp[j, i] = True
-                iu[j, :].fill(0)
-                iu[:, i].fill(0)
+    matched_det = zeros(n_det, dtype=bool)
+    matched_det[tp_det1] = True
+    matched_std = zeros(n_std, dtype=bool)
+    matched_std[tp_std1] = True
+    left = invert(matched_det[i_det] | matched_std[i_std])
+    i_det = i_det[left]
+    i_std = i_std[left]
+    iu = iu[left]
+    
+    # Round 2
+    det_match2 = _best_match(i_det, i_std, iu, n_det)
+    std_match2 = _best_match(i_std, i_det, iu, n_std)
+    
+    tp_std2 = where(det_match2[std_match2] == arange(n_std))[0]
+    tp_det2 = std_match2[tp_std2]
+    
+    tp_idx = unique(concatenate((tp_det1 * n_std + tp_std1, 
+                                 tp_det2 * n_std + tp_std2)))
+    tp = csr_matrix((ones(len(tp_idx), dtype=bool), 
+                     (tp_idx // n_std, tp_idx % n_std)), 
+                    shape=(n_det, n_std))
+
+    # Find false positives and false negatives
+    fp = where(logical_and(det_match1 == 0, det_match2 == 0))[0]
+    fn = where(logical_and(std_match1 == 0, std_match2 == 0))[0]
+    
+    return tp, fp, fn
+
+def _overlapping_pairs(det_beg, det_end, std_beg, std_end, max_size=2 ** 22):
+    """Find all the pairs of detected and standard intervals which overlap.
+    
+    Parameters
+    ----------
+    det_beg, det_end, std_beg, std_end : ndarray
+        start and end times of the intervals
+    max_size : int
+        maximum number of candidate pairs tested at the same time
+    
+    Returns
+    -------
+    ndarray
+        index of the detected interval, for each overlapping pair
+    ndarray
+        index of the standard interval, for each overlapping pair
         
-        # Round 2
-        det_match2 = argmax(iu, axis=1)
-        std_match2 = argmax(iu, axis=0)
+    Notes
+    -----
+    The standard intervals are sorted by their start. For each detected 
+    interval, the candidates start before the end of the detected interval 
+    and come after the last standard interval where all the previous ones end
+    before the start of the detected interval.
+    """
+    order = argsort(std_beg, kind='stable')
+    sorted_beg = std_beg[order]
+    prev_end = maximum.accumulate(std_end[order])
+    
+    lo = searchsorted(prev_end, det_beg, 'right')
+    hi = searchsorted(sorted_beg, det_end, 'left')
+    n_cand = clip(hi - lo, 0, None)
+    
+    i_det = []
+    i_std = []
+    chunk_beg = 0
+    n_cumul = cumsum(n_cand)
+    while chunk_beg < len(det_beg):
+        offset = n_cumul[chunk_beg] - n_cand[chunk_beg]
+        chunk_end = max(chunk_beg + 1, 
+                        searchsorted(n_cumul, offset + max_size, 'right'))
+        n = n_cand[chunk_beg:chunk_end]
+        one_det = repeat(arange(chunk_beg, chunk_end), n)
+        one_std = order[arange(n.sum()) - repeat(cumsum(n) - n, n) + 
+                        repeat(lo[chunk_beg:chunk_end], n)]
+        overlapping = logical_and(det_end[one_det] - std_beg[one_std] > 0,
+                                  std_end[one_std] - det_beg[one_det] > 0)
+        i_det.append(one_det[overlapping])
+        i_std.append(one_std[overlapping])
+        chunk_beg = chunk_end
         
-        for i, j in enumerate(std_match2):
-            if det_match2[j] == i:
-                tp[j, i] = True
+    return concatenate(i_det), concatenate(i_std)
+
+def _best_match(rows, cols, iu, n_rows):
+    """For each row, column with the highest score, like argmax on the rows of
+    the full matrix (first column for ties, 0 if the row has no score)."""
+    best = zeros(n_rows, dtype=int)
+    if len(rows) == 0:
+        return best
     
-        # Find false positives and false negatives
-        fp = where(logical_and(det_match1 == 0, det_match2 == 0))[0]
-        fn = where(logical_and(std_match1 == 0, std_match2 == 0))[0]
+    order = lexsort((cols, -iu, rows))
+    rows = rows[order]
+    first = concatenate(([True], rows[1:] != rows[:-1]))
+    best[rows[first]] = cols[order][first]
+    return best
+
+def match_events(detection, standard, threshold):
+    """Find best matches between detected and standard events, by a thresholded
+    intersection-union rule.
     
+    Parameters
+    ----------
+    detection : list of dict
+        list of detected events to be tested against the standard, with 
+        'start', 'end' and 'chan'
+    standard : list of dict
+        list of ground-truth events, with 'start', 'end' and 'chan'
+    threshold : float
+        minimum intersection-union score to match a pair, between 0 and 1
+        
+    Returns
+    -------
+    instance of MatchedEvents
+        indices of true positives, false positives and false negatives, with
+        statistics (recall, precision, F1)
+    """
+    tp, fp, fn = match_intervals(
+            _column(detection, 'start'), _column(detection, 'end'),
+            _column(standard, 'start'), _column(standard, 'end'),
+            threshold)
+
     # Store in MatchedEvents class, which computes statistics
     match = MatchedEvents(tp, fp, fn, detection, standard, threshold)
     
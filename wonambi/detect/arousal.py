@@ -1,6 +1,7 @@
 """Module to detect arousals
 """
 
+from functools import partial
 from logging import getLogger
 from numpy import abs, argmin, asarray, hstack, mean, sum, vstack, where, zeros
 from scipy.signal import spectrogram
@@ -11,7 +12,8 @@ try:
 except ImportError:
     pass
 
-from .spindle import within_duration, remove_straddlers
+from .spindle import (detect_per_chan, within_duration, remove_straddlers,
+                      _report_progress)
 from ..graphoelement import Arousals
 
 lg = getLogger(__name__)
@@ -67,7 +69,7 @@ class DetectArousal:
         return ('detsw_{0}_{1:04.2f}-{2:04.2f}Hz'
                 ''.format(self.method, *self.det_filt['freq']))
 
-    def __call__(self, data, parent=None):
+    def __call__(self, data, parent=None, n_jobs=1):
         """Detect slow waves on the data.
 
         Parameters
@@ -76,51 +78,49 @@ class DetectArousal:
             data used for detection
         parent : QWidget
             for use with GUI, as parent widget for the progress bar
+        n_jobs : int or None
+            number of processes to run the channels in parallel (None means
+            all the CPUs, 1 runs the channels one after the other)
         
         Returns
         -------
         instance of graphoelement.Arousals
             description of the detected arousals
         """
+        report = None
         if parent is not None:
             progress = QProgressDialog('Finding arousals', 'Abort', 
                                        0, data.number_of('chan')[0], parent)
             progress.setWindowModality(Qt.ApplicationModal)
+            report = partial(_report_progress, progress)
             
         arousal = Arousals()
         arousal.chan_name = data.axis['chan'][0]
 
-        all_arousals = []
-        for i, chan in enumerate(data.axis['chan'][0]):
-            
-            lg.info('Detecting arousals on chan %s', chan)
-            time = hstack(data.axis['time'])
-            dat_orig = hstack(data(chan=chan))
-
-            if 'HouseDetector' in self.method:
-                arou_in_chan = detect_HouseDetector(dat_orig, data.s_freq, time,
-                                                  self)
-
-            else:
-                raise ValueError('Unknown method')
+        results = detect_per_chan(_detect_arousal_chan, data, self, 
+                                  n_jobs=n_jobs, progress=report)
+        if results is None:
+            return
 
+        all_arousals = []
+        for chan, arou_in_chan in zip(data.axis['chan'][0], results):
             for ar in arou_in_chan:
                 ar.update({'chan': chan})
             all_arousals.extend(arou_in_chan)
-            
-            if parent is not None:
-                progress.setValue(i)
-                if progress.wasCanceled():
-                    return
-            # end of loop over chan
 
         arousal.events = sorted(all_arousals, key=lambda x: x['start'])
 
-        if parent is not None:
-            progress.setValue(i + 1)
-
         return arousal
 
+
+def _detect_arousal_chan(dat_orig, s_freq, time, opts):
+    """Detect arousals on one channel, with the method in opts."""
+    if 'HouseDetector' in opts.method:
+        return detect_HouseDetector(dat_orig, s_freq, time, opts)
+
+    else:
+        raise ValueError('Unknown method')
+
 def detect_HouseDetector(dat_orig, s_freq, time, opts):
     """House arousal detection.
 
@@ -0,0 +1,204 @@
+"""Module to share the transformed signals between detection methods.
+"""
+from collections import OrderedDict
+from hashlib import blake2b
+from logging import getLogger
+
+from numpy import ascontiguousarray, ndarray, zeros
+
+lg = getLogger(__name__)
+
+MAX_MEMORY = 2 ** 30  # in bytes
+
+_ACTIVE = []
+
+
+class TransformCache:
+    """Cache of the signals computed by transform_signal, with LRU eviction.
+
+    Parameters
+    ----------
+    max_memory : int
+        maximum size (in bytes) of the transformed signals kept in memory
+
+    Attributes
+    ----------
+    n_hits : int
+        number of transformations which were already in the cache
+    n_misses : int
+        number of transformations which had to be computed
+
+    Notes
+    -----
+    The cache is used by transform_signal only inside a "with" statement:
+
+        with TransformCache():
+            sp1 = DetectSpindle('Moelle2011')(data)
+            sp2 = DetectSpindle('Nir2011')(data)
+
+    Signals are identified by their content (a hash of the values), so that
+    the same channel gives the same key, even if it was copied or demeaned
+    again, and a signal which was modified in place gets a new key. The cache
+    returns a copy of the signal, so that it can be modified safely.
+    """
+    def __init__(self, max_memory=MAX_MEMORY):
+        self.max_memory = max_memory
+        self.n_hits = 0
+        self.n_misses = 0
+        self._cache = OrderedDict()
+        self._nbytes = 0
+
+    def __enter__(self):
+        _ACTIVE.append(self)
+        return self
+
+    def __exit__(self, *args):
+        _ACTIVE.remove(self)
+        self.clear()
+
+    def __call__(self, func, dat, s_freq, method, method_opt=None, dat2=None):
+        """Return the transformed signal, from the cache if possible.
+
+        Parameters
+        ----------
+        func : function
+            function which computes the transformation, with the same
+            signature as transform_signal
+        dat, s_freq, method, method_opt, dat2
+            see transform_signal
+
+        Returns
+        -------
+        ndarray
+            transformed signal
+        """
+        key = (method, _freeze(method_opt), s_freq, _identity(dat),
+               None if dat2 is None else _identity(dat2))
+
+        if key in self._cache:
+            self.n_hits += 1
+            self._cache.move_to_end(key)
+            out = self._cache[key]
+
+        else:
+            self.n_misses += 1
+            out = func(dat, s_freq, method, method_opt, dat2)
+            if not isinstance(out, ndarray):
+                return out
+            self._add(key, out)
+
+        return out.copy()
+
+    def clear(self):
+        """Remove all the signals from the cache."""
+        self._cache.clear()
+        self._nbytes = 0
+
+    def _add(self, key, out):
+        if out.nbytes > self.max_memory:
+            return
+
+        self._cache[key] = out
+        self._nbytes += out.nbytes
+        while self._nbytes > self.max_memory:
+            _, old = self._cache.popitem(last=False)
+            self._nbytes -= old.nbytes
+
+
+
+def active_cache():
+    """Return the cache of the innermost "with TransformCache()" or None."""
+    if _ACTIVE:
+        return _ACTIVE[-1]
+
+
+def detect_multiple(detectors, data, max_memory=MAX_MEMORY):
+    """Run several detectors on the same data, sharing the transformed signals.
+
+    Parameters
+    ----------
+    detectors : list of instances of DetectSpindle, DetectSlowWave
+        detection methods with their options
+    data : instance of Data
+        data used for detection
+    max_memory : int
+        maximum size (in bytes) of the transformed signals kept in memory
+
+    Returns
+    -------
+    list of instances of Graphoelement
+        output of each detector, in the same order as detectors
+
+    Notes
+    -----
+    The detectors are run on one channel at the time, so that all the
+    transformed signals of one channel are in the cache when the next detector
+    needs them. The cache is emptied before the next channel.
+    """
+    from ..trans import select  # avoid circular import
+    from .spindle import merge_close
+
+    chans = data.axis['chan'][0]
+    outputs = [[] for _ in detectors]
+    merges = [getattr(det, 'merge', False) for det in detectors]
+
+    with TransformCache(max_memory) as cache:
+        try:
+            for chan in chans:
+                lg.info('Detecting events on channel %s', chan)
+                data_chan = select(data, chan=[chan], copy=False)
+                for det, out, merge in zip(detectors, outputs, merges):
+                    if merge:
+                        det.merge = False
+                    out.append(det(data_chan))
+                cache.clear()
+        finally:
+            for det, merge in zip(detectors, merges):
+                if merge:
+                    det.merge = merge
+
+        lg.info('Transformations computed %d times, reused %d times',
+                cache.n_misses, cache.n_hits)
+
+    results = []
+    for det, out_chans, merge in zip(detectors, outputs, merges):
+        res = out_chans[0].__class__()
+        res.chan_name = chans
+        all_events = []
+        for out in out_chans:
+            all_events.extend(out.events)
+        res.events = sorted(all_events, key=lambda x: x['start'])
+
+        if hasattr(out_chans[0], 'density'):
+            res.det_values = zeros(len(chans), dtype='O')
+            res.density = zeros(len(chans))
+            for i, out in enumerate(out_chans):
+                res.det_values[i] = out.det_values[0]
+                res.density[i] = out.density[0]
+
+        if merge and len(chans) > 1:
+            res.events = merge_close(res.events, det.min_interval)
+
+        results.append(res)
+
+    return results
+
+
+def _identity(dat):
+    """Key of the signal, from the hash of the values."""
+    dat = ascontiguousarray(dat)
+    return (dat.shape, dat.dtype.str,
+            blake2b(dat.view('u1').data, digest_size=16).digest())
+
+
+def _freeze(value):
+    """Convert the options into something that can be used as key of a dict.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, ndarray):
+        return (value.shape, value.dtype.str, value.tobytes())
+    else:
+        return value
@@ -1,9 +1,11 @@
 """Module to detect slow waves.
 
 """
+from functools import partial
 from logging import getLogger
-from numpy import (argmin, concatenate, diff, hstack, logical_and, newaxis, 
-                   ones, percentile, roll, sign, sum, vstack, where, zeros)
+from numpy import (arange, concatenate, cumsum, diff, empty, flatnonzero, full,
+                   iinfo, isnan, logical_and, maximum, minimum, newaxis, 
+                   repeat, roll, searchsorted, sign, vstack, where)
 from scipy.signal import firwin, kaiserord, lfilter
 
 try:
@@ -12,8 +14,9 @@ try:
 except ImportError:
     pass
 
-from .spindle import (detect_events, transform_signal, within_duration, 
-                      remove_straddlers)
+from .spindle import (define_threshold, detect_events, detect_per_chan, 
+                      transform_signal, within_duration, remove_straddlers, 
+                      _report_progress)
 from ..graphoelement import SlowWaves
 
 lg = getLogger(__name__)
@@ -91,7 +94,7 @@ class DetectSlowWave:
         return ('detsw_{0}_{1:04.2f}-{2:04.2f}Hz'
                 ''.format(self.method, *self.det_filt['freq']))
 
-    def __call__(self, data, parent=None):
+    def __call__(self, data, parent=None, n_jobs=1, stream=None):
         """Detect slow waves on the data.
 
         Parameters
@@ -100,59 +103,88 @@ class DetectSlowWave:
             data used for detection
         parent : QWidget
             for use with GUI, as parent widget for the progress bar
-        
+        n_jobs : int or None
+            number of processes to run the channels in parallel (None means
+            all the CPUs, 1 runs the channels one after the other)
+        stream : instance of StreamThresholds, optional
+            thresholds over the whole recording, when detecting in chunks (see
+            detect_stream). The data should have only one channel.
+
         Returns
         -------
         instance of graphoelement.SlowWaves
             description of the detected SWs
         """
+        report = None
         if parent is not None:
             progress = QProgressDialog('Finding slow waves', 'Abort', 
                                        0, data.number_of('chan')[0], parent)
             progress.setWindowModality(Qt.ApplicationModal)
-            
+            report = partial(_report_progress, progress)
+
         slowwave = SlowWaves()
         slowwave.chan_name = data.axis['chan'][0]
 
-        all_slowwaves = []
-        for i, chan in enumerate(data.axis['chan'][0]):
-            
-            lg.info('Detecting slow waves on chan %s', chan)
-            time = hstack(data.axis['time'])
-            dat_orig = hstack(data(chan=chan))
-            dat_orig = dat_orig - dat_orig.mean()  # demean
-
-            if 'Massimini2004' in self.method:
-                sw_in_chan = detect_Massimini2004(dat_orig, data.s_freq, time,
-                                                  self)
-                
-            elif 'Ngo2015' == self.method:
-                sw_in_chan = detect_Ngo2015(dat_orig, data.s_freq, time, self)
-                
-            elif 'Staresina2015' == self.method:
-                sw_in_chan = detect_Staresina2015(dat_orig, data.s_freq, time, 
-                                                  self)
+        detect_chan = _detect_slowwave_chan
+        if stream is not None:
+            if data.number_of('chan')[0] != 1:
+                raise ValueError('Thresholds over the whole recording can '
+                                 'only be used on one channel at a time')
+            detect_chan = partial(_detect_slowwave_chan, stream=stream)
 
-            else:
-                raise ValueError('Unknown method')
+        results = detect_per_chan(detect_chan, data, self, 
+                                  n_jobs=n_jobs, progress=report)
+        if results is None:
+            return
 
+        all_slowwaves = []
+        for chan, sw_in_chan in zip(data.axis['chan'][0], results):
             for sw in sw_in_chan:
                 sw.update({'chan': chan})
             all_slowwaves.extend(sw_in_chan)
-            
-            if parent is not None:
-                progress.setValue(i)
-                if progress.wasCanceled():
-                    return
-            # end of loop over chan
 
         slowwave.events = sorted(all_slowwaves, key=lambda x: x['start'])
 
-        if parent is not None:
-            progress.setValue(i + 1)
-
         return slowwave
 
+
+def _detect_slowwave_chan(dat_orig, s_freq, time, opts, stream=None):
+    """Detect slow waves on one channel, with the method in opts.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    time : ndarray (dtype='float')
+        vector with the time points for each sample
+    opts : instance of 'DetectSlowWave'
+        options for the detection
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
+
+    Returns
+    -------
+    list of dict
+        list of detected SWs
+    """
+    dat_orig = dat_orig - dat_orig.mean()  # demean
+
+    if 'Massimini2004' in opts.method:
+        return detect_Massimini2004(dat_orig, s_freq, time, opts)
+
+    elif 'Ngo2015' == opts.method:
+        return detect_Ngo2015(dat_orig, s_freq, time, opts, stream)
+
+    elif 'Staresina2015' == opts.method:
+        return detect_Staresina2015(dat_orig, s_freq, time, opts, stream)
+
+    else:
+        raise ValueError('Unknown method')
+
+
 def detect_Massimini2004(dat_orig, s_freq, time, opts):
     """Slow wave detection based on Massimini et al., 2004.
 
@@ -221,7 +253,7 @@ def detect_Massimini2004(dat_orig, s_freq, time, opts):
 
     return sw_in_chan
 
-def detect_Ngo2015(dat_orig, s_freq, time, opts):
+def detect_Ngo2015(dat_orig, s_freq, time, opts, stream=None):
     """Slow wave detection based on Ngo et al., 2015.
 
     Parameters
@@ -242,6 +274,9 @@ def detect_Ngo2015(dat_orig, s_freq, time, opts):
             threshold; SWs above this threshold are kept
         'ptp_thresh' : float
             percentile of mean ptp values, above which SW is kept
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -271,14 +306,20 @@ def detect_Ngo2015(dat_orig, s_freq, time, opts):
             # Negative peak threshold
             idx_neg_peak = events[:, 1]
             # Trough threshhold is set as peak_thresh (float) times the mean trough amplitude over all events:
-            neg_peak_thresh = dat_det[idx_neg_peak].mean() * opts.peak_thresh
+            neg_peak_thresh = define_threshold(dat_det[idx_neg_peak], s_freq,
+                                               'mean', opts.peak_thresh, 
+                                               stream=stream,
+                                               time=time[events[:, 0]])
             events = events[dat_det[idx_neg_peak] < neg_peak_thresh, :] 
             
             if events is not None:
                 # Peak-to-peak amplitude threshold
                 ptp = dat_det[events[:, 3]] - dat_det[events[:, 1]]
                 # Peak-to-peak threshold is set as a percentile of the mean ptp amplitude:
-                ptp_thresh = ptp.mean() * opts.ptp_thresh
+                ptp_thresh = define_threshold(ptp, s_freq, 'mean', 
+                                              opts.ptp_thresh, 
+                                              stream=stream,
+                                              time=time[events[:, 0]])
                 events = events[ptp > ptp_thresh, :]
                 
                 if events is not None:
@@ -290,7 +331,7 @@ def detect_Ngo2015(dat_orig, s_freq, time, opts):
 
     return sw_in_chan
 
-def detect_Staresina2015(dat_orig, s_freq, time, opts):
+def detect_Staresina2015(dat_orig, s_freq, time, opts, stream=None):
     """Slow wave detection based on Ngo et al., 2015.
 
     Parameters
@@ -308,6 +349,9 @@ def detect_Staresina2015(dat_orig, s_freq, time, opts):
             min and max duration of SW
         'ptp_thresh' : float
             percentile of mean ptp values, above which SW is kept
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -348,7 +392,10 @@ def detect_Staresina2015(dat_orig, s_freq, time, opts):
         if events is not None:
             # Peak-to-peak amplitude threshold
             ptp = dat_det[events[:, 3]] - dat_det[events[:, 1]]
-            ptp_thresh = percentile(ptp, opts.ptp_thresh)
+            ptp_thresh = define_threshold(ptp, s_freq, 'percentile', 
+                                          opts.ptp_thresh, 
+                                          stream=stream,
+                                          time=time[events[:, 0]])
             events = events[ptp >= ptp_thresh, :] 
             
             if events is not None:
@@ -405,21 +452,33 @@ def make_slow_waves(events, data, time, s_freq):
         peak_val, peak-to-peak amplitude (signal units), area_under_curve
         (signal units * s)
     """
-    slow_waves = []
-    for ev in events:
-        one_sw = {'start': time[ev[0]],
-                  'trough_time': time[ev[1]],
-                  'zero_time': time[ev[2]],
-                  'peak_time': time[ev[3]],
-                  'end': time[ev[4] - 1],
-                  'trough_val': data[ev[1]],
-                  'peak_val': data[ev[3]],
-                  'dur': (ev[4] - ev[0]) / s_freq,
-                  'ptp': abs(ev[3] - ev[1])
-                  }
-        slow_waves.append(one_sw)
-
-    return slow_waves
+    cols = slowwave_columns(events, data, time, s_freq)
+    return [dict(zip(cols, values)) for values in zip(*cols.values())]
+
+
+def slowwave_columns(events, data, time, s_freq):
+    """Compute the parameters of the slow waves, with one array per parameter.
+
+    Parameters
+    ----------
+    see make_slow_waves
+
+    Returns
+    -------
+    dict of ndarray
+        the same keys as each slow wave in make_slow_waves, with one value for
+        each slow wave
+    """
+    return {'start': time[events[:, 0]],
+            'trough_time': time[events[:, 1]],
+            'zero_time': time[events[:, 2]],
+            'peak_time': time[events[:, 3]],
+            'end': time[events[:, 4] - 1],
+            'trough_val': data[events[:, 1]],
+            'peak_val': data[events[:, 3]],
+            'dur': (events[:, 4] - events[:, 0]) / s_freq,
+            'ptp': abs(events[:, 3] - events[:, 1]),
+            }
 
 
 def _add_halfwave(data, events, s_freq, opts):
@@ -453,31 +512,27 @@ def _add_halfwave(data, events, s_freq, opts):
     
     window = int(s_freq * max_dur)
 
-    peak_and_end = zeros((events.shape[0], 2), dtype='int')
-    events = concatenate((events, peak_and_end), axis=1)
-    selected = []
-
-    for ev in events:
-        zero_crossings = where(diff(sign(data[ev[2]:ev[0] + window])))[0]
-        
-        if zero_crossings.any():
-            ev[4] = ev[2] + zero_crossings[0] + 1
-            #lg.info('0cross is at ' + str(ev[4]))
-            
-        else:
-            selected.append(False)
-            #lg.info('no 0cross, rejected')
-            continue
-
-        ev[3] = ev[2] + argmin(data[ev[2]:ev[4]])
-
-        if abs(data[ev[1]] - data[ev[3]]) < opts.min_ptp:
-            selected.append(False)
-            #lg.info('ptp too low, rejected: ' + str(abs(data[ev[1]] - data[ev[3]])))
-            continue
-
-        selected.append(True)
-        #lg.info('SW checks out, accepted! ptp is ' + str(abs(data[ev[1]] - data[ev[3]])))
+    # next zero crossing, between the end of the trough and max duration
+    zero_crossings = find_zero_crossings(data)
+    beg = events[:, 2]
+    end = minimum(events[:, 0] + window, len(data))
+    i_zx = searchsorted(zero_crossings, beg)
+    zx = _take(zero_crossings, i_zx)
+    selected = zx <= end - 2
+    # a single zero crossing on the first sample does not count
+    first_only = logical_and(zx == beg, _take(zero_crossings, i_zx + 1) > 
+                             end - 2)
+    selected &= ~first_only
+    #lg.info('no 0cross, rejected: ' + str(sum(~selected)))
+
+    events = events[selected, :]
+    zero = zx[selected] + 1
+    peak = _segment_argext(data, events[:, 2], zero, minimum)
+    events = concatenate((events, peak[:, newaxis], zero[:, newaxis]), 
+                         axis=1)
+
+    selected = ~(abs(data[events[:, 1]] - data[events[:, 3]]) < opts.min_ptp)
+    #lg.info('ptp too low, rejected: ' + str(sum(~selected)))
 
     return events[selected, :]
 
@@ -564,21 +619,66 @@ def find_peaks_in_slowwwave(data, events):
         N x 5 matrix with start, trough, - to + zero crossing, peak, 
         and end samples
     """
-    new_events = concatenate((
-        events[:, 0, newaxis], 
-        zeros((events.shape[0], 3), dtype='int64'), 
-        events[:, 1, newaxis]), 
-                        axis=1)
+    beg, end = events[:, 0], events[:, 1]
     
-    selected = ones(events.shape[0], dtype='bool')
-    for i, ev in enumerate(events):
-        try:
-            ev_dat = data[ev[0]:ev[1]]
-            new_events[i, 1] = ev[0] + ev_dat.argmin() # trough
-            new_events[i, 2] = ev[0] + where(diff(sign(ev_dat)) > 0)[0][0] # -to+
-            new_events[i, 3] = ev[0] + ev_dat.argmax() # peak
-        except IndexError:
-            selected[i] = False
+    # first - to + zero crossing within each event
+    neg_to_pos = find_zero_crossings(data, xtype='neg_to_pos')
+    zero = _take(neg_to_pos, searchsorted(neg_to_pos, beg))
+    selected = zero <= end - 2
+    beg, zero, end = beg[selected], zero[selected], end[selected]
         
-    return new_events[selected, :]
+    trough = _segment_argext(data, beg, end, minimum)
+    peak = _segment_argext(data, beg, end, maximum)
+    
+    return vstack((beg, trough, zero, peak, end)).T
+
+
+def _take(indices, i):
+    """Values of indices at i, or a value larger than any sample when i is 
+    beyond the last index."""
+    out = full(len(i), iinfo(indices.dtype).max, dtype=indices.dtype)
+    inside = i < len(indices)
+    out[inside] = indices[i[inside]]
+    return out
+
 
+def _segment_argext(data, beg, end, func, max_size=2 ** 22):
+    """Index of the first minimum or maximum of each segment, like argmin or 
+    argmax on data[beg:end].
+
+    Parameters
+    ----------
+    data : ndarray (dtype='float')
+        vector with the data
+    beg, end : ndarray (dtype='int')
+        first and last sample (excluded) of each segment (not empty)
+    func : numpy.ufunc
+        minimum or maximum
+    max_size : int
+        maximum number of samples of the segments processed at the same time
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        index (in data) of the extreme value of each segment
+    """
+    n_smp = end - beg
+    out = empty(len(beg), dtype='int64')
+    n_cumul = cumsum(n_smp)
+    
+    i0 = 0
+    while i0 < len(beg):
+        i1 = max(i0 + 1, searchsorted(n_cumul, n_cumul[i0] - n_smp[i0] + 
+                                      max_size, 'right'))
+        n = n_smp[i0:i1]
+        offset = cumsum(n) - n
+        idx = arange(n.sum()) - repeat(offset - beg[i0:i1], n)
+        val = data[idx]
+        extreme = func.reduceat(val, offset)
+        # like argmin and argmax, the first NaN is the extreme value
+        is_extreme = (val == repeat(extreme, n)) | isnan(val)
+        first = flatnonzero(is_extreme)
+        out[i0:i1] = idx[first[searchsorted(first, offset)]]
+        i0 = i1
+    
+    return out
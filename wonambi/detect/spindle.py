@@ -1,12 +1,17 @@
 """Module to detect spindles.
 """
+from functools import partial
 from logging import getLogger
-from numpy import (absolute, arange, argmax, argmin, around, asarray, 
-                   concatenate, cos, diff, exp, empty, histogram, 
-                   hstack, insert, invert, isnan, log10, logical_and, mean, median, 
-                   nan, ones, percentile, pi, ptp, real, sqrt, square, std, 
-                   sum, vstack, where, zeros)
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from numpy import (absolute, add, arange, argmax, argmin, around, asarray, 
+                   bincount, clip, concatenate, cos, cumsum, diff, exp, empty,
+                   histogram, hstack, inf, insert, invert, isnan, linspace, 
+                   log10, logical_and, maximum, mean, median, minimum, nan, 
+                   ndarray, ones, percentile, pi, ptp, real, searchsorted, 
+                   sqrt, square, std, sum, unique, vstack, where, zeros)
 from numpy.fft import rfftfreq
+from numpy.lib.stride_tricks import sliding_window_view
 from scipy.ndimage.filters import gaussian_filter
 from scipy.signal import (argrelmax, butter, cheby2, filtfilt, 
                           fftconvolve, hilbert, periodogram, remez, 
@@ -18,7 +23,8 @@ try:
 except ImportError:
     pass
 
-from ..graphoelement import Spindles
+from .cache import active_cache
+from ..graphoelement import Events, Spindles
 
 lg = getLogger(__name__)
 MAX_FREQUENCY_OF_INTEREST = 50
@@ -250,7 +256,7 @@ class DetectSpindle:
                 ''.format(self.method, self.frequency[0], self.frequency[1],
                           self.duration[0], self.duration[1]))
 
-    def __call__(self, data, parent=None):
+    def __call__(self, data, parent=None, n_jobs=1, stream=None):
         """Detect spindles on the data.
 
         Parameters
@@ -259,16 +265,24 @@ class DetectSpindle:
             data used for detection
         parent : QWidget
             for use with GUI, as parent widget for the progress bar
+        n_jobs : int or None
+            number of processes to run the channels in parallel (None means
+            all the CPUs, 1 runs the channels one after the other)
+        stream : instance of StreamThresholds, optional
+            thresholds over the whole recording, when detecting in chunks (see
+            detect_stream). The data should have only one channel.
 
         Returns
         -------
         instance of graphoelement.Spindles
             description of the detected spindles
         """
+        report = None
         if parent is not None:
             progress = QProgressDialog('Finding spindles', 'Abort', 
                                        0, data.number_of('chan')[0], parent)
             progress.setWindowModality(Qt.ApplicationModal)
+            report = partial(_report_progress, progress)
         
         spindle = Spindles()
         spindle.chan_name = data.axis['chan'][0]
@@ -278,77 +292,21 @@ class DetectSpindle:
         if self.duration[1] is None:
             self.duration = self.duration[0], MAX_DURATION
 
-        all_spindles = []
-        i = 0
-        for i, chan in enumerate(data.axis['chan'][0]):
-                
-            lg.info('Detecting spindles on channel %s', chan)
-            time = hstack(data.axis['time'])
-            dat_orig = hstack(data(chan=chan))
-            dat_orig = dat_orig - dat_orig.mean() # demean
-
-            if self.method == 'Ferrarelli2007':
-                sp_in_chan, values, density = detect_Ferrarelli2007(dat_orig,
-                                                                    data.s_freq,
-                                                                    time,
-                                                                    self)
-                
-            elif self.method == 'Moelle2011':
-                sp_in_chan, values, density = detect_Moelle2011(dat_orig,
-                                                                data.s_freq,
-                                                                time, self)
-                
-            elif self.method == 'Nir2011':
-                sp_in_chan, values, density = detect_Nir2011(dat_orig,
-                                                             data.s_freq,
-                                                             time, self)
-                
-                
-            elif self.method == 'Wamsley2012':
-                sp_in_chan, values, density = detect_Wamsley2012(dat_orig,
-                                                                 data.s_freq,
-                                                                 time, self)
-                
-            elif self.method == 'Martin2013':
-                sp_in_chan, values, density = detect_Martin2013(dat_orig,
-                                                                data.s_freq,
-                                                                time, self)
-                
-            elif self.method == 'Ray2015':
-                sp_in_chan, values, density = detect_Ray2015(dat_orig,
-                                                            data.s_freq,
-                                                            time, self)
-                
-            elif self.method == 'Lacourse2018':
-                sp_in_chan, values, density = detect_Lacourse2018(dat_orig,
-                                                                  data.s_freq,
-                                                                  time, self)    
-                
-            elif self.method == 'FASST':
-                sp_in_chan, values, density = detect_FASST(dat_orig,
-                                                           data.s_freq,
-                                                           time, self,
-                                                           submethod='abs')
-                
-            elif self.method == 'FASST2':
-                sp_in_chan, values, density = detect_FASST(dat_orig,
-                                                           data.s_freq,
-                                                           time, self,
-                                                           submethod='rms')
-                
-            elif self.method == 'UCSD':
-                sp_in_chan, values, density = detect_UCSD(dat_orig,
-                                                          data.s_freq, time,
-                                                          self)
-                
-            elif self.method == 'Concordia':
-                sp_in_chan, values, density = detect_Concordia(dat_orig,
-                                                               data.s_freq,
-                                                               time, self)
-                
-            else:
-                raise ValueError('Unknown method')
+        detect_chan = _detect_spindle_chan
+        if stream is not None:
+            if data.number_of('chan')[0] != 1:
+                raise ValueError('Thresholds over the whole recording can '
+                                 'only be used on one channel at a time')
+            detect_chan = partial(_detect_spindle_chan, stream=stream)
+
+        results = detect_per_chan(detect_chan, data, self, 
+                                  n_jobs=n_jobs, progress=report)
+        if results is None:
+            return
 
+        all_spindles = []
+        for i, (chan, (sp_in_chan, values, density)) in enumerate(
+                zip(data.axis['chan'][0], results)):
             spindle.det_values[i] = values
             spindle.density[i] = density
 
@@ -356,12 +314,6 @@ class DetectSpindle:
                 sp.update({'chan': chan})
 
             all_spindles.extend(sp_in_chan)
-            
-            if parent is not None:
-                progress.setValue(i)
-                if progress.wasCanceled():
-                    return
-            # end of loop over chan
 
         spindle.events = sorted(all_spindles, key=lambda x: x['start'])
         lg.info(str(len(spindle.events)) + ' spindles detected.')
@@ -369,13 +321,78 @@ class DetectSpindle:
         if self.merge and len(data.axis['chan'][0]) > 1:
             spindle.events = merge_close(spindle.events, self.min_interval)
 
-        if parent is not None:
-            progress.setValue(i + 1)            
-        
         return spindle
 
 
-def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
+def _detect_spindle_chan(dat_orig, s_freq, time, opts, stream=None):
+    """Detect spindles on one channel, with the method in opts.
+
+    Parameters
+    ----------
+    dat_orig : ndarray (dtype='float')
+        vector with the data for one channel
+    s_freq : float
+        sampling frequency
+    time : ndarray (dtype='float')
+        vector with the time points for each sample
+    opts : instance of 'DetectSpindle'
+        options for the detection
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
+
+    Returns
+    -------
+    list of dict
+        list of detected spindles
+    dict
+        'det_value_lo' with detection value, 'det_value_hi' with nan,
+        'sel_value' with selection value
+    float
+        spindle density, per 30-s epoch
+    """
+    dat_orig = dat_orig - dat_orig.mean() # demean
+
+    if opts.method == 'Ferrarelli2007':
+        return detect_Ferrarelli2007(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Moelle2011':
+        return detect_Moelle2011(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Nir2011':
+        return detect_Nir2011(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Wamsley2012':
+        return detect_Wamsley2012(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Martin2013':
+        return detect_Martin2013(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Ray2015':
+        return detect_Ray2015(dat_orig, s_freq, time, opts)
+        
+    elif opts.method == 'Lacourse2018':
+        return detect_Lacourse2018(dat_orig, s_freq, time, opts)
+        
+    elif opts.method == 'FASST':
+        return detect_FASST(dat_orig, s_freq, time, opts, submethod='abs',
+                            stream=stream)
+        
+    elif opts.method == 'FASST2':
+        return detect_FASST(dat_orig, s_freq, time, opts, submethod='rms',
+                            stream=stream)
+        
+    elif opts.method == 'UCSD':
+        return detect_UCSD(dat_orig, s_freq, time, opts, stream)
+        
+    elif opts.method == 'Concordia':
+        return detect_Concordia(dat_orig, s_freq, time, opts, stream)
+        
+    else:
+        raise ValueError('Unknown method')
+
+
+def detect_Ferrarelli2007(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on Ferrarelli et al. 2007, and scripts obtained
     from Warby et al. (2014).
 
@@ -394,6 +411,9 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
             detection threshold
         'sel_thresh' : float
             selection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -420,9 +440,11 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
     troughs = ones(len(envelope)) * -1
     troughs[idx_trough] = envelope[idx_trough] # all non-trough values are -1
 
-    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh)
+    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh,
+                                 stream=stream)
     sel_value = define_threshold(dat_det[idx_peak], s_freq, 'histmax', 
-                                 opts.sel_thresh, nbins=120)
+                                 opts.sel_thresh, nbins=120, 
+                                 stream=stream, time=time[idx_peak])
     
     events_env = detect_events(envelope, 'above_thresh', det_value)
     
@@ -456,7 +478,7 @@ def detect_Ferrarelli2007(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Moelle2011(dat_orig, s_freq, time, opts):
+def detect_Moelle2011(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on Moelle et al. 2011
 
     Parameters
@@ -476,6 +498,9 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
             parameters for 'smooth'
         'det_thresh' : float
             detection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -496,7 +521,7 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
     dat_det = transform_signal(dat_det, s_freq, 'smooth', opts.smooth)
 
     det_value = define_threshold(dat_det, s_freq, 'mean+std',
-                                 opts.det_thresh)
+                                 opts.det_thresh, stream=stream)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -522,7 +547,7 @@ def detect_Moelle2011(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Nir2011(dat_orig, s_freq, time, opts):
+def detect_Nir2011(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on Nir et al. 2011
 
     Parameters
@@ -542,6 +567,9 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
             detection threshold
         'sel_thresh' : float
             selection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -573,8 +601,9 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
     dat_det = transform_signal(dat_det, s_freq, 'gaussian', opts.smooth)
 
     det_value = define_threshold(dat_det, s_freq, 'mean+std',
-                                 opts.det_thresh)
-    sel_value = define_threshold(dat_det, s_freq, 'mean+std', opts.sel_thresh)
+                                 opts.det_thresh, stream=stream)
+    sel_value = define_threshold(dat_det, s_freq, 'mean+std', opts.sel_thresh,
+                                 stream=stream)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -602,7 +631,7 @@ def detect_Nir2011(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Wamsley2012(dat_orig, s_freq, time, opts):
+def detect_Wamsley2012(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on Wamsley et al. 2012 (cmor-style wavelet).
     
     Parameters
@@ -620,6 +649,9 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
             parameters for 'smooth'
         'det_thresh' : float
             detection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -639,7 +671,8 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
     dat_det = real(dat_wav ** 2) ** 2
     dat_det = transform_signal(dat_det, s_freq, 'smooth', opts.smooth)
 
-    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh)
+    det_value = define_threshold(dat_det, s_freq, 'mean', opts.det_thresh,
+                                 stream=stream)
 
     events = detect_events(dat_det, 'above_thresh', det_value)
 
@@ -665,7 +698,7 @@ def detect_Wamsley2012(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Martin2013(dat_orig, s_freq, time, opts):
+def detect_Martin2013(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on Martin et al. 2013
     
     Parameters
@@ -702,7 +735,8 @@ def detect_Martin2013(dat_orig, s_freq, time, opts):
     dat_det = transform_signal(dat_filt, s_freq, 'moving_rms', opts.moving_rms)
         # downsampled
     
-    det_value = percentile(dat_det, opts.det_thresh)
+    det_value = define_threshold(dat_det, s_freq, 'percentile', 
+                                 opts.det_thresh, stream=stream)
     
     events = detect_events(dat_det, 'above_thresh', det_value)
     
@@ -755,6 +789,9 @@ def detect_Ray2015(dat_orig, s_freq, time, opts):
             detection threshold
         'sel_thresh' : nan
             selection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -952,7 +989,7 @@ def detect_Lacourse2018(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_FASST(dat_orig, s_freq, time, opts, submethod='rms'):
+def detect_FASST(dat_orig, s_freq, time, opts, submethod='rms', stream=None):
     """Spindle detection based on FASST method, itself based on Moelle et al. 
     (2002).
     
@@ -975,6 +1012,9 @@ def detect_FASST(dat_orig, s_freq, time, opts, submethod='rms'):
             detection threshold (percentile)
     submethod : str
         'abs' (rectified) or 'rms' (root-mean-square)
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -992,7 +1032,8 @@ def detect_FASST(dat_orig, s_freq, time, opts, submethod='rms'):
     """
     dat_det = transform_signal(dat_orig, s_freq, 'butter', opts.det_butter)
     
-    det_value = percentile(dat_det, opts.det_thresh)
+    det_value = define_threshold(dat_det, s_freq, 'percentile', 
+                                 opts.det_thresh, stream=stream)
     
     if submethod == 'abs':
         dat_det = transform_signal(dat_det, s_freq, 'abs')
@@ -1026,7 +1067,7 @@ def detect_FASST(dat_orig, s_freq, time, opts, submethod='rms'):
     return sp_in_chan, values, density
 
 
-def detect_UCSD(dat_orig, s_freq, time, opts):
+def detect_UCSD(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection based on the UCSD method
 
     Parameters
@@ -1048,6 +1089,9 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
             selection threshold
         ratio_thresh : float
             ratio between power inside and outside spindle band to accept them
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -1064,14 +1108,14 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
                                opts.det_wavelet)
 
     det_value = define_threshold(dat_det, s_freq, 'median+std',
-                                 opts.det_thresh)
+                                 opts.det_thresh, stream=stream)
 
     events = detect_events(dat_det, 'maxima', det_value)
 
     dat_sel = transform_signal(dat_orig, s_freq, 'wavelet_real',
                                opts.sel_wavelet)
     sel_value = define_threshold(dat_sel, s_freq, 'median+std',
-                                 opts.sel_thresh)
+                                 opts.sel_thresh, stream=stream)
     events = select_events(dat_sel, events, 'above_thresh', sel_value)
 
     events = _merge_close(dat_det, events, time, opts.tolerance)
@@ -1094,7 +1138,7 @@ def detect_UCSD(dat_orig, s_freq, time, opts):
     return sp_in_chan, values, density
 
 
-def detect_Concordia(dat_orig, s_freq, time, opts):
+def detect_Concordia(dat_orig, s_freq, time, opts, stream=None):
     """Spindle detection, experimental Concordia method. Similar to Moelle 2011
     and Nir2011.
 
@@ -1117,6 +1161,9 @@ def detect_Concordia(dat_orig, s_freq, time, opts):
             high detection threshold
         'sel_thresh' : float
             selection threshold
+    stream : instance of StreamThresholds, optional
+        thresholds over the whole recording, when detecting in chunks (see
+        detect_stream)
 
     Returns
     -------
@@ -1133,10 +1180,11 @@ def detect_Concordia(dat_orig, s_freq, time, opts):
     dat_det = transform_signal(dat_det, s_freq, 'smooth', opts.smooth)
 
     det_value_lo = define_threshold(dat_det, s_freq, 'mean+std',
-                                    opts.det_thresh)
+                                    opts.det_thresh, stream=stream)
     det_value_hi = define_threshold(dat_det, s_freq, 'mean+std',
-                                    opts.det_thresh_hi)
-    sel_value = define_threshold(dat_det, s_freq, 'mean+std', opts.sel_thresh)
+                                    opts.det_thresh_hi, stream=stream)
+    sel_value = define_threshold(dat_det, s_freq, 'mean+std', opts.sel_thresh,
+                                 stream=stream)
 
     events = detect_events(dat_det, 'between_thresh',
                            value=(det_value_lo, det_value_hi))
@@ -1331,7 +1379,19 @@ def transform_signal(dat, s_freq, method, method_opt=None, dat2=None):
             wavelet width
         win : float
             moving average window length (sec) of wavelet convolution
+
+    If it's called inside "with TransformCache()", the transformed signals are
+    reused when the same transformation is applied to the same signal.
     """
+    cache = active_cache()
+    if cache is not None:
+        return cache(_transform_signal, dat, s_freq, method, method_opt, dat2)
+
+    return _transform_signal(dat, s_freq, method, method_opt, dat2)
+
+
+def _transform_signal(dat, s_freq, method, method_opt=None, dat2=None):
+    """Transform the data, see transform_signal for the methods."""
     if 'abs' == method:
         dat = absolute(dat)
 
@@ -1459,30 +1519,29 @@ def transform_signal(dat, s_freq, method, method_opt=None, dat2=None):
             
         out = zeros((len_out))
         
-        if 'moving_covar' == method:            
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                win1 = dat[beg:end]
-                win2 = dat2[beg:end]
-                out[i] = mean((win1 - mean(win1)) * (win2 - mean(win2)))
+        if 'moving_covar' == method:
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            x = dat - mean(dat)  # remove offset, for numerical precision
+            y = dat2 - mean(dat2)
+            n_smp = end - beg
+            out[:len(beg)] = (_moving_sum(x * y, beg, end) / n_smp -
+                              _moving_sum(x, beg, end) / n_smp * 
+                              _moving_sum(y, beg, end) / n_smp)
             dat = out
             
         if 'moving_periodogram' == method:  
-            nfft = next_fast_len(dur * s_freq)
+            nfft = next_fast_len(int(dur * s_freq))
             sf = rfftfreq(nfft, 1 / s_freq)
             freq = method_opt['freq']
-            f0 = asarray([abs(x - freq[0]) for x in sf]).argmin()
-            f1 = asarray([abs(x - freq[1]) for x in sf]).argmin()
+            f0 = abs(sf - freq[0]).argmin()
+            f1 = abs(sf - freq[1]).argmin()
             out = zeros((len_out, f1 - f0))
             
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                windat = dat[beg:end]
-                sf, psd = periodogram(windat, s_freq, 'hann', nfft=nfft,
-                                       detrend='constant')
-                out[i, :] = psd[f0:f1]
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            for idx, _, psd in _moving_periodogram(dat, s_freq, beg, end, 
+                                                   window='hann', nfft=nfft,
+                                                   detrend='constant'):
+                out[idx, :] = psd[:, f0:f1]
                 
             dat = out
             
@@ -1491,56 +1550,48 @@ def transform_signal(dat, s_freq, method, method_opt=None, dat2=None):
             freq2 = method_opt['freq_broad']
             fft_dur = method_opt['fft_dur']
             nfft = int(s_freq * fft_dur)
+            sf = rfftfreq(nfft, 1 / s_freq)
+            f0_1 = abs(sf - freq1[0]).argmin()
+            f1_1 = abs(sf - freq1[1]).argmin()
+            f0_2 = abs(sf - freq2[0]).argmin()
+            f1_2 = abs(sf - freq2[1]).argmin()
             
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                windat = dat[beg:end]
-                
-                sf, psd = periodogram(windat, s_freq, 'hann', nfft=nfft,
-                                       detrend='constant')
-                f0 = asarray([abs(x - freq1[0]) for x in sf]).argmin()
-                f1 = asarray([abs(x - freq1[1]) for x in sf]).argmin()
-                pow1 = sum(psd[f0:f1])
-                
-                f0 = asarray([abs(x - freq2[0]) for x in sf]).argmin()
-                f1 = asarray([abs(x - freq2[1]) for x in sf]).argmin()
-                pow2 = sum(psd[f0:f1])
-                
-                
-                out[i] = pow1 / pow2
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            for idx, _, psd in _moving_periodogram(dat, s_freq, beg, end, 
+                                                   window='hann', nfft=nfft,
+                                                   detrend='constant'):
+                pow1 = sum(psd[:, f0_1:f1_1], axis=1)
+                pow2 = sum(psd[:, f0_2:f1_2], axis=1)
+                out[idx] = pow1 / pow2
     
             dat = out
         
         if 'moving_sd' == method:
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                win = dat[beg:end]
-                out[i] = std(win)
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            out[:len(beg)] = _moving_std(dat, beg, end)
             dat = out
         
         if 'moving_zscore' == method:        
             pcl_range = method_opt['pcl_range']
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            offset = mean(dat)
+            win_mean = (_moving_sum(dat - offset, beg, end) / (end - beg) + 
+                        offset)
+            
             if pcl_range is not None:
                 lo = percentile(dat, pcl_range[0])
                 hi = percentile(dat, pcl_range[1])
+                win_std = _moving_std(dat, beg, end, 
+                                      logical_and(dat > lo, dat < hi))
+            else:
+                win_std = _moving_std(dat, beg, end)
             
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                windat = stddat = dat[beg:end]
-                
-                if pcl_range is not None:
-                    stddat = windat[logical_and(windat > lo, windat < hi)]
-                out[i] = (dat[i] - mean(windat)) / std(stddat)
+            out[:len(beg)] = (dat[:len(beg)] - win_mean) / win_std
             dat = out
         
         if method in ['moving_rms', 'moving_ms']:
-            for i, j in enumerate(arange(0, total_dur, step)[:-1]):
-                beg = max(0, int((j - halfdur) * s_freq))
-                end = min(last, int((j + halfdur) * s_freq))
-                out[i] = mean(square(dat[beg:end]))   
+            beg, end = _moving_windows(len(dat), s_freq, dur, step)
+            out[:len(beg)] = _moving_sum(square(dat), beg, end) / (end - beg)
             if method == 'moving_rms':
                 out = sqrt(out)
             dat = out
@@ -1613,7 +1664,8 @@ def transform_signal(dat, s_freq, method, method_opt=None, dat2=None):
     return dat
 
 
-def define_threshold(dat, s_freq, method, value, nbins=120):
+def define_threshold(dat, s_freq, method, value, nbins=120, stream=None, 
+                     time=None):
     """Return the value of the threshold based on relative values.
 
     Parameters
@@ -1623,11 +1675,19 @@ def define_threshold(dat, s_freq, method, value, nbins=120):
     s_freq : float
         sampling frequency
     method : str
-        one of 'mean', 'median', 'std', 'mean+std', 'median+std', 'histmax'
+        one of 'mean', 'median', 'std', 'mean+std', 'median+std', 'histmax',
+        'percentile'
     value : float
-        value to multiply the values for
+        value to multiply the values for (for 'percentile', the percentile)
     nbins : int
         for histmax method only, number of bins in the histogram
+    stream : instance of StreamThresholds, optional
+        when detecting in chunks, it computes the threshold over all the 
+        chunks instead of dat only
+    time : ndarray, optional
+        when dat contains one value per event (instead of one value per 
+        sample), the time of each event. It is only used with stream, to keep
+        the events in the core of the chunk.
 
     Returns
     -------
@@ -1635,6 +1695,9 @@ def define_threshold(dat, s_freq, method, value, nbins=120):
         threshold in useful units.
 
     """
+    if stream is not None:
+        return stream(dat, s_freq, method, value, nbins, time)
+
     if method == 'mean':
         value = value * mean(dat)
     elif method == 'median':
@@ -1650,10 +1713,217 @@ def define_threshold(dat, s_freq, method, value, nbins=120):
         idx_maxbin = argmax(hist[0])
         maxamp = mean((hist[1][idx_maxbin], hist[1][idx_maxbin + 1]))
         value = value * maxamp
+    elif method == 'percentile':
+        value = percentile(dat, value)
 
     return value
 
 
+class StreamThresholds:
+    """Thresholds computed over the whole recording, when the detection is run
+    in chunks.
+
+    The detection is run on all the chunks at least twice. During each pass, 
+    each call to define_threshold collects the statistics it needs: sums for 
+    mean and std and a histogram for median, percentile and histmax. compute()
+    turns them into the thresholds of the whole recording, which are used 
+    during the next pass. When a threshold depends on a previous one (for 
+    example, when the events are selected by the first threshold before 
+    computing the second one), its statistics change after the first pass, so
+    the passes are repeated until the thresholds do not change.
+
+    Attributes
+    ----------
+    stats : list of dict
+        statistics for each call to define_threshold, in the order in which 
+        the detection method calls it, during the current pass
+    values : list of float
+        thresholds for each call to define_threshold, after compute()
+
+    Notes
+    -----
+    Only the values in the core of the chunk (without the overlap with the 
+    previous and next chunks) are used. For values with one value per event,
+    an event is in the core if its time is in the core, as in detect_stream.
+    For values with one value per sample, the core is defined as a fraction
+    of the samples, because the data passed to define_threshold might be 
+    downsampled.
+
+    Median, percentile and histmax use a histogram with a fixed number of bins,
+    so they are approximated within one bin (the range of the values divided
+    by 16384, for the default n_bins).
+    """
+    def __init__(self, n_bins=2 ** 14):
+        self.n_bins = n_bins
+        self.stats = []
+        self.values = []
+        self._i = 0
+        self._core = 0, 1
+        self._core_time = -inf, inf
+
+    def new_chunk(self, core_beg=0, core_end=1, beg_time=-inf, end_time=inf):
+        """Start a new chunk.
+
+        Parameters
+        ----------
+        core_beg, core_end : float
+            beginning and end of the core of the chunk, as fraction of the 
+            chunk (the rest overlaps with the previous or next chunk)
+        beg_time, end_time : float
+            beginning and end of the core of the chunk, in s (end_time is not
+            included)
+        """
+        self._i = 0
+        self._core = core_beg, core_end
+        self._core_time = beg_time, end_time
+
+    def __call__(self, dat, s_freq, method, value, nbins=120, time=None):
+        i = self._i
+        self._i += 1
+
+        if i == len(self.stats):
+            self.stats.append({'method': method, 'value': value, 
+                               'nbins': nbins, 'n': 0, 'sum': 0., 
+                               'sumsq': 0., 'shift': None, 'hist': None})
+        st = self.stats[i]
+
+        if time is None:
+            n_smp = len(dat)
+            core = dat[int(around(n_smp * self._core[0])):
+                       int(around(n_smp * self._core[1]))]
+        else:
+            core = dat[(self._core_time[0] <= time) & 
+                       (time < self._core_time[1])]
+
+        if len(core) > 0:
+            if st['shift'] is None:  # for numerical precision
+                st['shift'] = mean(core)
+            x = core - st['shift']
+            st['n'] += len(x)
+            st['sum'] += sum(x)
+            st['sumsq'] += sum(square(x))
+            if method in ('median', 'median+std', 'histmax', 'percentile'):
+                if st['hist'] is None:
+                    st['hist'] = _Histogram(self.n_bins)
+                st['hist'].add(core)
+
+        if i < len(self.values):
+            return self.values[i]
+
+        # threshold of this chunk only, for the first pass
+        return define_threshold(dat, s_freq, method, value, nbins)
+
+    def compute(self):
+        """Compute the thresholds over all the chunks and start a new pass.
+
+        Returns
+        -------
+        bool
+            True if the thresholds changed, so the detection should be run 
+            again with the new thresholds
+        """
+        values = []
+        for st in self.stats:
+            if st['n'] == 0:
+                values.append(nan)
+                continue
+
+            avg = st['sum'] / st['n']
+            sd = sqrt(max(st['sumsq'] / st['n'] - avg ** 2, 0))
+            avg += st['shift']
+            method, value = st['method'], st['value']
+
+            if method == 'mean':
+                value = value * avg
+            elif method == 'std':
+                value = value * sd
+            elif method == 'mean+std':
+                value = avg + value * sd
+            elif method == 'median':
+                value = value * st['hist'].percentile(50)
+            elif method == 'median+std':
+                value = st['hist'].percentile(50) + value * sd
+            elif method == 'histmax':
+                value = value * st['hist'].histmax(st['nbins'])
+            elif method == 'percentile':
+                value = st['hist'].percentile(value)
+            values.append(float(value))
+
+        changed = (len(values) != len(self.values) or 
+                   any(v0 != v1 and not (isnan(v0) and isnan(v1)) 
+                       for v0, v1 in zip(values, self.values)))
+        self.values = values
+        self.stats = []
+
+        return changed
+
+
+class _Histogram:
+    """Histogram with a fixed number of bins, whose range grows to include all
+    the values (by merging pairs of bins).
+
+    Parameters
+    ----------
+    n_bins : int
+        number of bins (it should be even)
+    """
+    def __init__(self, n_bins):
+        self.counts = zeros(n_bins, dtype='int64')
+        self.lo = None
+        self.width = None
+        self.min = inf
+        self.max = -inf
+
+    def add(self, x):
+        """Add values to the histogram."""
+        n_bins = len(self.counts)
+        x_min = x.min()
+        x_max = x.max()
+        self.min = min(self.min, x_min)
+        self.max = max(self.max, x_max)
+
+        if self.lo is None:
+            self.lo = x_min
+            self.width = (x_max - x_min) / n_bins
+            if self.width == 0:
+                self.width = max(abs(x_min), 1) * 1e-9
+
+        while x_min < self.lo:  # extend to lower values
+            pairs = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = concatenate((zeros(n_bins // 2, dtype='int64'), 
+                                       pairs))
+            self.lo -= self.width * n_bins
+            self.width *= 2
+        while x_max >= self.lo + self.width * n_bins:  # to higher values
+            pairs = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = concatenate((pairs, 
+                                       zeros(n_bins // 2, dtype='int64')))
+            self.width *= 2
+
+        idx = ((x - self.lo) / self.width).astype('int64')
+        self.counts += bincount(clip(idx, 0, n_bins - 1), minlength=n_bins)
+
+    def percentile(self, q):
+        """Percentile of the values, as numpy.percentile (linear), with values
+        spread uniformly in each bin."""
+        rank = q / 100 * (self.counts.sum() - 1)
+        cum = cumsum(self.counts)
+        i = searchsorted(cum, rank, side='right')
+        in_bin = (rank - (cum[i] - self.counts[i]) + 0.5) / self.counts[i]
+        value = self.lo + self.width * (i + in_bin)
+        return min(max(value, self.min), self.max)
+
+    def histmax(self, nbins):
+        """Center of the fullest bin, as define_threshold with 'histmax'."""
+        edges = linspace(self.min, self.max, nbins + 1)
+        centers = self.lo + self.width * (arange(len(self.counts)) + 0.5)
+        coarse = clip(searchsorted(edges, centers, side='right') - 1, 0, 
+                      nbins - 1)
+        hist = bincount(coarse, weights=self.counts, minlength=nbins)
+        idx_maxbin = argmax(hist)
+        return mean((edges[idx_maxbin], edges[idx_maxbin + 1]))
+
+
 def peaks_in_time(dat, troughs=False):
     """Find indices of peaks or troughs in data.
     
@@ -1787,12 +2057,121 @@ def select_events(dat, detected, method, value):
     return detected
 
 
+def detect_per_chan(detect_chan, data, opts, n_jobs=1, progress=None):
+    """Run the detection on each channel, one after the other or in parallel.
+
+    Parameters
+    ----------
+    detect_chan : function
+        function with signature (dat_orig, s_freq, time, opts), which detects
+        the events on one channel. It needs to be defined at the module level, 
+        so that it can be used by other processes.
+    data : instance of Data
+        data used for detection
+    opts : instance of 'DetectSpindle', 'DetectSlowWave', 'DetectArousal'
+        options for the detection
+    n_jobs : int or None
+        number of processes (None means all the CPUs, 1 runs the channels in 
+        this process)
+    progress : function, optional
+        called with the number of channels which are done. If it returns 
+        True, the detection is interrupted.
+
+    Returns
+    -------
+    list
+        output of detect_chan for each channel, in the same order as the 
+        channels in data. It's None if the detection was interrupted.
+
+    Notes
+    -----
+    With more than one process, the data of all the channels is copied only 
+    once into shared memory, so that each process can read the channel it 
+    needs without passing the signal between processes.
+    """
+    chans = data.axis['chan'][0]
+    time = hstack(data.axis['time'])
+
+    if n_jobs == 1 or len(chans) == 1:
+        results = []
+        for i, chan in enumerate(chans):
+            lg.info('Detecting events on channel %s', chan)
+            results.append(detect_chan(hstack(data(chan=chan, copy=False)), data.s_freq, 
+                                       time, opts))
+            if progress is not None and progress(i + 1):
+                return
+        return results
+
+    # the data keeps its dtype, the time (after the data) keeps its own
+    shape = (len(chans), len(time))
+    dtype = data.data[0].dtype
+    n_bytes = len(chans) * len(time) * dtype.itemsize
+    offset = n_bytes + (-n_bytes) % time.dtype.itemsize  # aligned
+    shm = SharedMemory(create=True, size=max(offset + time.nbytes, 1))
+    try:
+        shared = ndarray(shape, dtype=dtype, buffer=shm.buf)
+        shared_time = ndarray(time.shape, dtype=time.dtype, buffer=shm.buf,
+                              offset=offset)
+        shared_time[:] = time
+        for i, chan in enumerate(chans):
+            shared[i] = hstack(data(chan=chan, copy=False))
+
+        results = [None] * len(chans)
+        with Pool(n_jobs, initializer=_init_shared, 
+                  initargs=(shm.name, shape, dtype, offset, time.dtype,
+                            detect_chan, data.s_freq, opts)) as p:
+            for n_done, (i, output) in enumerate(
+                    p.imap_unordered(_detect_shared, range(len(chans)))):
+                results[i] = output
+                if progress is not None and progress(n_done + 1):
+                    p.terminate()
+                    return
+
+        del shared, shared_time
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
+
+
+_SHARED = {}
+
+
+def _init_shared(shm_name, shape, dtype, offset, time_dtype, detect_chan,
+                 s_freq, opts):
+    """Attach each worker process to the shared memory with the data (chan x
+    time, with dtype) followed by the time (at offset, with time_dtype)."""
+    shm = SharedMemory(name=shm_name)
+    _SHARED['shm'] = shm  # keep a reference, otherwise the memory is closed
+    _SHARED['dat'] = ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _SHARED['time'] = ndarray(shape[1:], dtype=time_dtype, buffer=shm.buf,
+                              offset=offset)
+    _SHARED['detect_chan'] = detect_chan
+    _SHARED['s_freq'] = s_freq
+    _SHARED['opts'] = opts
+
+
+def _detect_shared(i):
+    """Run the detection on one channel of the shared data."""
+    output = _SHARED['detect_chan'](_SHARED['dat'][i].copy(), 
+                                    _SHARED['s_freq'], 
+                                    _SHARED['time'].copy(), _SHARED['opts'])
+    return i, output
+
+
+def _report_progress(progress, n_done):
+    """Update the progress bar in the GUI, returns True if canceled."""
+    progress.setValue(n_done)
+    return progress.wasCanceled()
+
+
 def merge_close(events, min_interval, merge_to_longer=False):
     """Merge events that are separated by a less than a minimum interval.
 
     Parameters
     ----------
-    events : list of dict
+    events : list of dict or instance of Events
         events with 'start' and 'end' times, from one or several channels.
         **Events must be sorted by their start time.**
     min_interval : float
@@ -1803,9 +2182,39 @@ def merge_close(events, min_interval, merge_to_longer=False):
 
     Returns
     -------
-    list of dict
-        original events list with close events merged.
+    list of dict or instance of Events
+        original events list with close events merged (Events if the input
+        is Events).
     """
+    if merge_to_longer:
+        return _merge_to_longer(events, min_interval)
+
+    as_list = not isinstance(events, Events)
+    events = Events(events)
+    if len(events) == 0:
+        return [] if as_list else events
+
+    half_iv = min_interval / 2
+    start = events.columns['start']
+    end = events.columns['end']
+
+    # an event is merged if it starts before the end of all previous events
+    prev_end = maximum.accumulate(end)
+    new = ones(len(events), dtype=bool)
+    new[1:] = start[1:] - half_iv > prev_end[:-1] + half_iv
+    first = where(new)[0]
+
+    merged = events.select(first)
+    merged.set_value('end', maximum.reduceat(end, first))
+
+    if as_list:
+        return merged.to_list()
+    return merged
+
+
+def _merge_to_longer(events, min_interval):
+    """merge_close, keeping the info of the longer event."""
+    as_list = not isinstance(events, Events)
     half_iv = min_interval / 2
     merged = []
 
@@ -1819,8 +2228,8 @@ def merge_close(events, min_interval, merge_to_longer=False):
 
             if higher['start'] - half_iv <= lower['end'] + half_iv:
 
-                if merge_to_longer and (higher['end'] - higher['start'] >
-                lower['end'] - lower['start']):
+                if (higher['end'] - higher['start'] >
+                    lower['end'] - lower['start']):
                     start = min(lower['start'], higher['start'])
                     higher.update({'start': start})
                     merged[-1] = higher
@@ -1832,7 +2241,9 @@ def merge_close(events, min_interval, merge_to_longer=False):
             else:
                 merged.append(higher)
 
-    return merged
+    if as_list:
+        return merged
+    return Events(merged)
 
 
 def within_duration(events, time, limits):
@@ -1916,23 +2327,20 @@ def power_ratio(events, dat, s_freq, limits, ratio_thresh):
     In the original matlab script, it uses amplitude, not power.
 
     """
-    ratio = empty(events.shape[0])
-    for i, one_event in enumerate(events):
+    ratio = zeros(events.shape[0])
+    x0 = events[:, 0]
+    x1 = events[:, 2]
+    good = where((x0 >= 0) & (x1 < len(dat)))[0]
 
-        x0 = one_event[0]
-        x1 = one_event[2]
-
-        if x0 < 0 or x1 >= len(dat):
-            ratio[i] = 0
-
-        else:
-            f, Pxx = periodogram(dat[x0:x1], s_freq, scaling='spectrum')
-            Pxx = sqrt(Pxx)  # use amplitude
+    for idx, f, Pxx in _moving_periodogram(dat, s_freq, x0[good], x1[good], 
+                                           scaling='spectrum'):
+        Pxx = sqrt(Pxx)  # use amplitude
 
-            freq_sp = (f >= limits[0]) & (f <= limits[1])
-            freq_nonsp = (f <= limits[1])
+        freq_sp = (f >= limits[0]) & (f <= limits[1])
+        freq_nonsp = (f <= limits[1])
 
-            ratio[i] = mean(Pxx[freq_sp]) / mean(Pxx[freq_nonsp])
+        ratio[good[idx]] = (mean(Pxx[:, freq_sp], axis=1) / 
+                            mean(Pxx[:, freq_nonsp], axis=1))
 
     events = events[ratio > ratio_thresh, :]
 
@@ -1967,22 +2375,19 @@ def peak_in_power(events, dat, s_freq, method, value=None):
     peak.fill(nan)
 
     if method is not None:
-        for i, one_event in enumerate(events):
+        if method == 'peak':
+            x0 = (events[:, 1] - value / 2 * s_freq).astype(int)
+            x1 = (events[:, 1] + value / 2 * s_freq).astype(int)
 
-            if method == 'peak':
-                x0 = one_event[1] - value / 2 * s_freq
-                x1 = one_event[1] + value / 2 * s_freq
+        elif method == 'interval':
+            x0 = events[:, 0]
+            x1 = events[:, 2]
 
-            elif method == 'interval':
-                x0 = one_event[0]
-                x1 = one_event[2]
-
-            if x0 < 0 or x1 >= len(dat):
-                peak[i] = nan
-            else:
-                f, Pxx = periodogram(dat[x0:x1], s_freq)
-                idx_peak = Pxx[f < MAX_FREQUENCY_OF_INTEREST].argmax()
-                peak[i] = f[idx_peak]
+        good = where((x0 >= 0) & (x1 < len(dat)))[0]
+        for idx, f, Pxx in _moving_periodogram(dat, s_freq, x0[good], 
+                                               x1[good]):
+            idx_peak = Pxx[:, f < MAX_FREQUENCY_OF_INTEREST].argmax(axis=1)
+            peak[good[idx]] = f[idx_peak]
 
     return peak
 
@@ -2011,19 +2416,15 @@ def power_in_band(events, dat, s_freq, frequency):
     pw = empty(events.shape[0])
     pw.fill(nan)
 
-    for i, one_event in enumerate(events):
+    x0 = events[:, 0]
+    x1 = events[:, 2]
+    good = where((x0 >= 0) & (x1 < len(dat)))[0]
 
-        x0 = one_event[0]
-        x1 = one_event[2]
-
-        if x0 < 0 or x1 >= len(dat):
-            pw[i] = nan
-        else:
-            sf, Pxx = periodogram(dat[x0:x1], s_freq)
-            # find nearest frequencies in sf
-            b0 = asarray([abs(x - frequency[0]) for x in sf]).argmin()
-            b1 = asarray([abs(x - frequency[1]) for x in sf]).argmin()
-            pw[i] = mean(Pxx[b0:b1])
+    for idx, sf, Pxx in _moving_periodogram(dat, s_freq, x0[good], x1[good]):
+        # find nearest frequencies in sf
+        b0 = abs(sf - frequency[0]).argmin()
+        b1 = abs(sf - frequency[1]).argmin()
+        pw[good[idx]] = mean(Pxx[:, b0:b1], axis=1)
 
     return pw
 
@@ -2056,29 +2457,50 @@ def make_spindles(events, power_peaks, powers, dat_det, dat_orig, time,
         end_time (s), peak_val (signal units), area_under_curve
         (signal units * s), peak_freq (Hz)
     """
+    cols = spindle_columns(events, power_peaks, powers, dat_det, dat_orig, 
+                           time, s_freq)
+    return [dict(zip(cols, values)) for values in zip(*cols.values())]
+
+
+def spindle_columns(events, power_peaks, powers, dat_det, dat_orig, time,
+                    s_freq):
+    """Compute the parameters of the spindles, with one array per parameter.
+
+    Parameters
+    ----------
+    see make_spindles
+
+    Returns
+    -------
+    dict of ndarray
+        the same keys as each spindle in make_spindles, with one value for 
+        each spindle
+    """
     i, events = _remove_duplicate(events, dat_det)
     power_peaks = power_peaks[i]
-
-    spindles = []
-    for i, one_peak, one_pwr in zip(events, power_peaks, powers):
-        one_spindle = {'start': time[i[0]],
-                       'end': time[i[2] - 1],
-                       'peak_time': time[i[1]],
-                       'peak_val_det': dat_det[i[1]],
-                       'peak_val_orig': dat_orig[i[1]],
-                       'dur': (i[2] - i[0]) / s_freq,
-                       'auc_det': sum(dat_det[i[0]:i[2]]) / s_freq,
-                       'auc_orig': sum(dat_orig[i[0]:i[2]]) / s_freq,
-                       'rms_det': sqrt(mean(square(dat_det[i[0]:i[2]]))),
-                       'rms_orig': sqrt(mean(square(dat_orig[i[0]:i[2]]))),
-                       'power_orig': one_pwr,
-                       'peak_freq': one_peak,
-                       'ptp_det': ptp(dat_det[i[0]:i[2]]),
-                       'ptp_orig': ptp(dat_orig[i[0]:i[2]])
-                       }
-        spindles.append(one_spindle)
-
-    return spindles
+    n_evt = min(len(events), len(power_peaks), len(powers))
+    events = events[:n_evt]
+    beg, peak, end = events[:, 0], events[:, 1], events[:, 2]
+    n_smp = end - beg
+
+    det = _segment_stats(dat_det, beg, end)
+    orig = _segment_stats(dat_orig, beg, end)
+
+    return {'start': time[beg],
+            'end': time[end - 1],
+            'peak_time': time[peak],
+            'peak_val_det': dat_det[peak],
+            'peak_val_orig': dat_orig[peak],
+            'dur': n_smp / s_freq,
+            'auc_det': det['sum'] / s_freq,
+            'auc_orig': orig['sum'] / s_freq,
+            'rms_det': sqrt(det['sumsq'] / n_smp),
+            'rms_orig': sqrt(orig['sumsq'] / n_smp),
+            'power_orig': powers[:n_evt],
+            'peak_freq': power_peaks[:n_evt],
+            'ptp_det': det['max'] - det['min'],
+            'ptp_orig': orig['max'] - orig['min'],
+            }
 
 
 def _remove_duplicate(old_events, dat):
@@ -2244,6 +2666,167 @@ def _merge_close(dat, events, time, min_interval):
     return new_events
 
 
+def _moving_windows(n_smp, s_freq, dur, step):
+    """Find the first and last sample of each window for the moving_* methods
+    in transform_signal.
+
+    Parameters
+    ----------
+    n_smp : int
+        number of samples in the signal
+    s_freq : float
+        sampling frequency
+    dur : float
+        duration of the window (sec)
+    step : float
+        step between consecutive windows (sec)
+
+    Returns
+    -------
+    ndarray (dtype='int')
+        first sample of each window
+    ndarray (dtype='int')
+        last sample (excluded) of each window
+
+    Notes
+    -----
+    Windows are centered on each step, clipped at the beginning of the signal
+    and they never include the last sample.
+    """
+    halfdur = dur / 2
+    centers = arange(0, n_smp / s_freq, step)[:-1]
+    beg = maximum(0, ((centers - halfdur) * s_freq).astype(int))
+    end = minimum(n_smp - 1, ((centers + halfdur) * s_freq).astype(int))
+    return beg, end
+
+
+def _cumsum(dat):
+    """Cumulative sum, starting with zero (so that it has one more value)."""
+    csum = empty(len(dat) + 1, dtype=cumsum(dat[:1]).dtype)
+    csum[0] = 0
+    cumsum(dat, out=csum[1:])
+    return csum
+
+
+def _moving_sum(dat, beg, end):
+    """Sum of the values between beg and end, using the cumulative sum."""
+    csum = _cumsum(dat)
+    return csum[end] - csum[beg]
+
+
+def _moving_std(dat, beg, end, good=None):
+    """Standard deviation of the values between beg and end.
+
+    Parameters
+    ----------
+    dat : ndarray (dtype='float')
+        vector with all the data for one channel
+    beg, end : ndarray (dtype='int')
+        first and last sample (excluded) of each window
+    good : ndarray (dtype='bool'), optional
+        only samples marked as True are used
+
+    Returns
+    -------
+    ndarray (dtype='float')
+        standard deviation in each window
+    """
+    x = dat - mean(dat)  # remove offset, for numerical precision
+    if good is None:
+        n_smp = end - beg
+        val = x
+        idx_beg, idx_end = beg, end
+    else:
+        x = where(good, x, 0)
+        val = x[good]
+        n_good = _cumsum(good)
+        idx_beg, idx_end = n_good[beg], n_good[end]
+        n_smp = idx_end - idx_beg
+    win_mean = _moving_sum(x, beg, end) / n_smp
+    win_var = _moving_sum(square(x), beg, end) / n_smp - square(win_mean)
+    win_var = maximum(win_var, 0)
+
+    # cumsum leaves rounding errors, so constant windows are set to zero
+    last = maximum(idx_end - 1, idx_beg)
+    n_change = _moving_sum(diff(val) != 0, idx_beg, last)
+    win_var[n_change == 0] = 0
+    return sqrt(win_var)
+
+
+def _moving_periodogram(dat, s_freq, beg, end, max_size=2 ** 22, **kwargs):
+    """Periodogram of many windows at once, in chunks to limit memory usage.
+
+    Parameters
+    ----------
+    dat : ndarray (dtype='float')
+        vector with all the data for one channel
+    s_freq : float
+        sampling frequency
+    beg, end : ndarray (dtype='int')
+        first and last sample (excluded) of each window
+    max_size : int
+        maximum number of values in the FFT of each chunk
+    **kwargs
+        options passed to scipy.signal.periodogram (window, nfft, etc)
+
+    Yields
+    ------
+    ndarray (dtype='int')
+        index of the windows in this chunk
+    ndarray (dtype='float')
+        frequency of the power spectral density
+    ndarray (dtype='float')
+        windows X frequency, power spectral density of each window
+
+    Notes
+    -----
+    Windows are grouped by length, so that the window function and the scaling
+    in scipy.signal.periodogram are the same as for each window separately.
+    """
+    n_smp = end - beg
+    if len(n_smp) == 0:
+        return
+
+    nfft = kwargs.get('nfft') or 1
+    n_rows = max(1, max_size // max(nfft, n_smp.max()))
+
+    for win_len in unique(n_smp):
+        idx = where(n_smp == win_len)[0]
+        windows = sliding_window_view(dat, win_len)
+        for i in range(0, len(idx), n_rows):
+            chunk = idx[i:i + n_rows]
+            sf, psd = periodogram(windows[beg[chunk]], s_freq, **kwargs)
+            yield chunk, sf, psd
+
+
+def _segment_stats(dat, beg, end):
+    """Sum, sum of squares, min and max of the values between beg and end.
+
+    Parameters
+    ----------
+    dat : ndarray (dtype='float')
+        vector with all the data for one channel
+    beg, end : ndarray (dtype='int')
+        first and last sample (excluded) of each segment (not empty)
+
+    Returns
+    -------
+    dict of ndarray
+        'sum', 'sumsq', 'min', 'max' for each segment
+    """
+    if len(beg) == 0:
+        return {k: zeros(0) for k in ('sum', 'sumsq', 'min', 'max')}
+
+    # reduceat works on [beg, end) when the indices alternate beg and end
+    idx = vstack((beg, end)).T.ravel()
+    x = concatenate((dat, [0]))  # so that end can be the last sample
+    return {'sum': add.reduceat(x, idx)[::2],
+            'sumsq': add.reduceat(square(x), idx)[::2],
+            'min': minimum.reduceat(x, idx)[::2],
+            'max': maximum.reduceat(x, idx)[::2],
+            }
+
+
 def _cmor_wamsley(fb, fc, scale, dur=6.0):
     """Complex Morlet wavelet approximating MATLAB cmor with CWT scaling.
 
@@ -0,0 +1,151 @@
+"""Module to detect events in chunks, for recordings which do not fit in memory.
+"""
+from logging import getLogger
+from numpy import arange, zeros
+
+from .spindle import StreamThresholds, merge_close
+from ..trans import select
+
+lg = getLogger(__name__)
+
+
+def detect_stream(detector, dataset, chan, chunk_dur=1800, overlap=30,
+                  begtime=None, endtime=None):
+    """Detect events on a recording, reading the data in chunks.
+
+    Parameters
+    ----------
+    detector : instance of DetectSpindle or DetectSlowWave
+        detection method and its options
+    dataset : instance of Dataset
+        recording to read the data from
+    chan : list of str
+        channels to run the detection on
+    chunk_dur : float
+        duration of each chunk (in s), without the overlap
+    overlap : float
+        duration of the data (in s) which is read before and after each chunk,
+        so that filters and moving windows are not affected by the edges of the
+        chunks. It should be longer than the longest event.
+    begtime : float, optional
+        beginning of the period of interest (in s from the start of the
+        recording)
+    endtime : float, optional
+        end of the period of interest (in s from the start of the recording)
+
+    Returns
+    -------
+    instance of graphoelement.Spindles or graphoelement.SlowWaves
+        description of the detected events
+
+    Notes
+    -----
+    Events are kept only by the chunk whose core (the chunk without the
+    overlap) contains the start of the event, so that events are not repeated
+    at the boundaries of the chunks.
+
+    Relative thresholds (such as mean + std) are computed over the whole
+    recording, with StreamThresholds: the first pass over the chunks collects
+    the statistics and the second pass detects the events. When a threshold
+    depends on a previous one, the passes are repeated until the thresholds do
+    not change. If the detection method only uses absolute thresholds, the
+    first pass is used directly. The thresholds of each channel are passed to
+    the detector as the stream argument, so the detector is not modified.
+
+    Median, percentile and histmax thresholds are approximated with a
+    histogram (see StreamThresholds).
+
+    Transformations which use the whole signal, such as the percentiles in
+    'moving_zscore' or the mean removed before detecting slow waves, are
+    computed on each chunk, so the results are close but not identical to the
+    detection on the whole signal.
+    """
+    s_freq = dataset.header['s_freq']
+    begsam = 0 if begtime is None else int(begtime * s_freq)
+    endsam = dataset.header['n_samples']
+    if endtime is not None:
+        endsam = min(endsam, int(endtime * s_freq))
+    chunk_smp = int(chunk_dur * s_freq)
+    overlap_smp = int(overlap * s_freq)
+    chunks = [(i, min(i + chunk_smp, endsam))
+              for i in arange(begsam, endsam, chunk_smp)]
+    if not chunks:
+        raise ValueError('No data between ' + str(begtime) + ' and ' +
+                         str(endtime) + ' s')
+    if len(chan) == 0:
+        raise ValueError('You need to specify at least one channel')
+
+    thresholds = {one_chan: StreamThresholds() for one_chan in chan}
+    events = _detect_chunks(detector, dataset, chan, chunks, overlap_smp,
+                            endsam, thresholds)
+
+    # each pass fixes at least one more threshold
+    n_thresh = max(len(one_thresh.stats)
+                   for one_thresh in thresholds.values())
+    for i_pass in range(n_thresh):
+        changed = [one_thresh.compute() for one_thresh in thresholds.values()]
+        if not any(changed):
+            break
+        lg.info('Pass %d, with thresholds over the whole recording',
+                i_pass + 2)
+        events = _detect_chunks(detector, dataset, chan, chunks, overlap_smp,
+                                endsam, thresholds)
+
+    out, all_events, det_values = events
+    out.chan_name = chan
+    out.events = sorted(all_events, key=lambda x: x['start'])
+    lg.info(str(len(out.events)) + ' events detected.')
+
+    if hasattr(out, 'density'):
+        out.det_values = det_values
+        total_dur = (endsam - begsam) / s_freq
+        out.density = zeros(len(chan))
+        for i, one_chan in enumerate(chan):
+            n_evt = sum(1 for evt in out.events if evt['chan'] == one_chan)
+            out.density[i] = n_evt * 30 / total_dur
+
+    if getattr(detector, 'merge', False) and len(chan) > 1:
+        out.events = merge_close(out.events, detector.min_interval)
+
+    return out
+
+
+def _detect_chunks(detector, dataset, chan, chunks, overlap_smp, endsam,
+                   thresholds):
+    """Run the detection on all the chunks, once.
+
+    Returns
+    -------
+    instance of Graphoelement
+        output of the detector on the last chunk (only used for its type)
+    list of dict
+        events in all the chunks
+    ndarray (dtype='O')
+        det_values of each channel, if the detector returns them
+    """
+    all_events = []
+    det_values = zeros(len(chan), dtype='O')
+
+    for chunk_beg, chunk_end in chunks:
+        read_beg = max(0, chunk_beg - overlap_smp)
+        read_end = min(endsam, chunk_end + overlap_smp)
+        lg.info('Detecting events between samples %d and %d', chunk_beg,
+                chunk_end)
+        data = dataset.read_data(chan=chan, begsam=read_beg, endsam=read_end)
+        core_beg = (chunk_beg - read_beg) / (read_end - read_beg)
+        core_end = (chunk_end - read_beg) / (read_end - read_beg)
+        time = data.axis['time'][0]
+        beg_time = time[chunk_beg - read_beg]
+        end_time = time[chunk_end - read_beg - 1] + 1 / data.s_freq
+
+        for i, one_chan in enumerate(chan):
+            thresholds[one_chan].new_chunk(core_beg, core_end, beg_time,
+                                           end_time)
+            out = detector(select(data, chan=[one_chan], copy=False),
+                           stream=thresholds[one_chan])
+            all_events.extend(evt for evt in out.events
+                              if beg_time <= evt['start'] < end_time)
+            if hasattr(out, 'det_values'):
+                det_values[i] = out.det_values[0]
+
+    return out, all_events, det_values
@@ -5,11 +5,268 @@ These graphoelements can be generated by the package "detect".
 """
 from copy import deepcopy
 from csv import reader, writer
-from numpy import empty, asarray, sum, mean
+from numpy import (arange, argsort, asarray, bool_, concatenate, empty, 
+                   integer, mean, ndarray, number, result_type, sum)
 
 from .datatype import Data
 
 
+class _Missing:
+    """Value of the events which do not have one of the keys."""
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'  # only one instance, also after copy or pickle
+
+
+MISSING = _Missing()
+
+
+class Events:
+    """Events stored as one array per key, which behaves like a list of dict.
+
+    Parameters
+    ----------
+    events : list of dict or instance of Events, optional
+        events, with the same keys (missing keys are allowed, but slower)
+
+    Attributes
+    ----------
+    columns : dict of ndarray
+        one array for each key, with one value for each event. Numeric values
+        are stored as numeric arrays, the others (str, list) as object arrays
+
+    Notes
+    -----
+    Iterating over the events or indexing with an int returns a dict for each 
+    event. Changing the values of the dict changes the events, as when the 
+    events were stored as a list of dict. To change the values of many events,
+    columns and set_value are much faster.
+    """
+    def __init__(self, events=None):
+        self.columns = {}
+        self._n = 0
+
+        if isinstance(events, Events):
+            self.columns = {k: v.copy() for k, v in events.columns.items()}
+            self._n = len(events)
+
+        elif events:
+            events = list(events)
+            keys = list(events[0])
+            for one_event in events[1:]:
+                for k in one_event:
+                    if k not in keys:
+                        keys.append(k)
+
+            self.columns = {k: _to_column([one_event.get(k, MISSING) 
+                                           for one_event in events])
+                            for k in keys}
+            self._n = len(events)
+
+    @classmethod
+    def from_columns(cls, columns):
+        """Create the events from a dict of arrays (one array per key)."""
+        events = cls()
+        events.columns = {k: asarray(v) for k, v in columns.items()}
+        if events.columns:
+            events._n = len(next(iter(events.columns.values())))
+        return events
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        keys = list(self.columns)
+        for i, values in enumerate(zip(*[col.tolist() 
+                                         for col in self.columns.values()])):
+            yield _Event(self, i, _to_dict(keys, values))
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, integer)):
+            if index < 0:
+                index += self._n
+            if not 0 <= index < self._n:
+                raise IndexError('event index out of range')
+            return _Event(self, index,
+                          _to_dict(list(self.columns), 
+                                   [col[index:index + 1].tolist()[0] 
+                                    for col in self.columns.values()]))
+
+        if isinstance(index, slice):
+            index = arange(self._n)[index]
+        return self.from_columns({k: v[index] 
+                                  for k, v in self.columns.items()})
+
+    def __eq__(self, other):
+        if isinstance(other, (Events, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __add__(self, other):
+        out = Events(self)
+        out.extend(other)
+        return out
+
+    def keys(self):
+        """Keys of the events."""
+        return list(self.columns)
+
+    def append(self, event):
+        """Add one event at the end (slow, use extend for many events)."""
+        self.extend([event])
+
+    def extend(self, events):
+        """Add events at the end.
+
+        Parameters
+        ----------
+        events : list of dict or instance of Events
+            events to add
+        """
+        if not isinstance(events, Events):
+            events = Events(events)
+        if len(events) == 0:
+            return
+        if self._n == 0:
+            self.columns = {k: v.copy() for k, v in events.columns.items()}
+            self._n = len(events)
+            return
+
+        keys = list(self.columns)
+        keys.extend(k for k in events.columns if k not in self.columns)
+        columns = {}
+        for k in keys:
+            col1 = self.columns.get(k)
+            if col1 is None:
+                col1 = _missing_column(self._n)
+            col2 = events.columns.get(k)
+            if col2 is None:
+                col2 = _missing_column(len(events))
+            if col1.dtype == 'O' or col2.dtype == 'O':
+                col1, col2 = col1.astype('O'), col2.astype('O')
+            columns[k] = concatenate((col1, col2))
+
+        self.columns = columns
+        self._n += len(events)
+
+    def select(self, mask):
+        """Select the events with a boolean mask or with indices.
+
+        Parameters
+        ----------
+        mask : ndarray (dtype='bool' or 'int')
+            events to keep
+
+        Returns
+        -------
+        instance of Events
+            selected events
+        """
+        return self[asarray(mask)]
+
+    def sort(self, key='start'):
+        """Sort the events (stable sort, as in python).
+
+        Parameters
+        ----------
+        key : str
+            key to sort the events by
+
+        Returns
+        -------
+        instance of Events
+            sorted events
+        """
+        if self._n == 0:
+            return Events(self)
+        return self[argsort(self.columns[key], kind='stable')]
+
+    def set_value(self, key, values):
+        """Set the values of one key for all the events."""
+        values = asarray(values)
+        if values.ndim == 0:
+            values = values.repeat(self._n)
+        self.columns[key] = values
+
+    def to_list(self):
+        """Return the events as list of dict."""
+        return list(self)
+
+    def _set_event_value(self, index, key, value):
+        """Change the value of one key for one event (MISSING removes it)."""
+        col = self.columns.get(key)
+        if col is None:
+            col = _missing_column(self._n)
+
+        if col.dtype != 'O':
+            new = _to_column([value])
+            if result_type(col.dtype, new.dtype) != col.dtype:
+                # do not change the type of the values of the other events
+                col = col.astype('O')
+
+        col[index] = value
+        self.columns[key] = col
+
+
+class _Event(dict):
+    """One event, as dict, which changes the events when it is changed."""
+    def __init__(self, events, index, values):
+        super().__init__(values)
+        self._events = events
+        self._index = index
+
+    def __setitem__(self, key, value):
+        self._events._set_event_value(self._index, key, value)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._events._set_event_value(self._index, key, MISSING)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = list(self)[-1]
+        return key, self.pop(key)
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def __reduce__(self):
+        return dict, (dict(self), )  # copies are normal dicts
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+
 class Graphoelement:
     """Class containing all the events of one type in one dataset.
 
@@ -17,12 +274,24 @@ class Graphoelement:
     ----------
     chan_name : ndarray (dtype='U')
         list of channels
+    events : instance of Events
+        events, which can be set with a list of dict
         
     """
     def __init__(self):
         self.chan_name = None
         self.events = []
 
+    @property
+    def events(self):
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        if not isinstance(events, Events):
+            events = Events(events)
+        self._events = events
+
     def __iter__(self):
         for one_event in self.events:
             yield one_event
@@ -34,14 +303,28 @@ class Graphoelement:
         return self.events[index]
 
     def __call__(self, func=None):
+        """Select events.
 
-        events = []
-        for one_ev in self.events:
-            if func(one_ev):
-                events.append(one_ev)
+        Parameters
+        ----------
+        func : function or ndarray (dtype='bool')
+            function which takes one event (dict) and returns True if the 
+            event should be kept, or boolean mask with the events to keep
+
+        Returns
+        -------
+        instance of Graphoelement
+            copy of the graphoelement, with only the selected events
+        """
+        if callable(func):
+            mask = asarray([bool(func(one_ev)) for one_ev in self.events], 
+                           dtype=bool)
+        else:
+            mask = asarray(func, dtype=bool)
 
-        output = deepcopy(self)
-        output.events = events
+        # do not copy the events which are not selected
+        output = deepcopy(self, {id(self._events): self._events})
+        output.events = self.events.select(mask)
 
         return output
 
@@ -52,13 +335,20 @@ class Graphoelement:
         data.axis['chan'][0] = self.chan_name
         data.data = empty(1, dtype='O')
 
+        if len(self.events) == 0:  # no columns yet
+            chans = empty(0, dtype='O')
+            columns = {parameter: empty(0)}
+        else:
+            chans = self.events.columns['chan']
+            columns = self.events.columns
+
         values = []
         for one_chan in self.chan_name:
+            in_chan = _is_chan(chans, one_chan)
             if parameter == 'count':
-                value = sum(1 for x in self.events if x['chan'] == one_chan)
+                value = sum(in_chan)
             else:
-                value = operator([x[parameter] for x in self.events
-                                  if x['chan'] == one_chan])
+                value = operator(columns[parameter][in_chan])
             values.append(value)
 
         data.data[0] = asarray(values)
@@ -242,3 +532,32 @@ def events_from_csv(source_file, stage=[]):
     grapho.chan_name = list(set([chan for e in events for chan in e['chan']]))
     
     return grapho
+
+
+def _to_column(values):
+    """Convert the values of one key to an array (object array if needed)."""
+    if all(isinstance(v, (bool, bool_, int, integer, float, number)) 
+           for v in values):
+        return asarray(values)
+    col = empty(len(values), dtype='O')
+    for i, v in enumerate(values):  # lists are kept as elements
+        col[i] = v
+    return col
+
+
+def _missing_column(n):
+    col = empty(n, dtype='O')
+    col.fill(MISSING)
+    return col
+
+
+def _to_dict(keys, values):
+    return {k: v for k, v in zip(keys, values) if v is not MISSING}
+
+
+def _is_chan(chans, one_chan):
+    """Boolean mask of events in one channel (same as x['chan'] == one_chan).
+    """
+    if len(chans) == 0:
+        return empty(0, dtype=bool)
+    return asarray(chans == one_chan, dtype=bool)
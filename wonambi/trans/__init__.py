@@ -6,7 +6,7 @@ use this package to transform to other classes. If you want to transform to
 basic elements, use the package "detect" for example.
 
 """
-from .filter import filter_, convolve
+from .filter import filter_, convolve, StreamFilter
 from .select import (select, resample, get_times, _select_channels, fetch,
                      Segments)
 from .frequency import frequency, timefrequency, band_power
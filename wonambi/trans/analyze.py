@@ -4,8 +4,12 @@
 from logging import getLogger
 from itertools import compress
 from csv import writer
-from numpy import (amax, amin, asarray, concatenate, in1d, mean, negative, ptp, 
-                   reshape, sqrt, square)
+from copy import deepcopy
+from numpy import (add, arange, argmax, asarray, concatenate, cumsum, diff,
+                   empty, errstate, full, in1d, inf, isinf, lexsort, maximum,
+                   minimum, nan, negative, ones, reshape, searchsorted, sign,
+                   sqrt, square, stack, where)
+from scipy.signal import fftconvolve
 
 try:
     from PyQt5.QtCore import Qt
@@ -15,12 +19,14 @@ except ImportError:
     QProgressDialog = None
 
 from .. import __version__
-from .math import math, get_descriptives
-from .frequency import band_power
-from .peaks import get_slopes
+from .math import get_descriptives
+from .frequency import _fft, band_power
 
 lg = getLogger(__name__)
 
+PARAM_KEYS = ['dur', 'minamp', 'maxamp', 'ptp', 'rms', 'power', 'peakpf',
+              'energy', 'peakef']
+
 
 def event_params(segments, params, band=None, n_fft=None, slopes=None, 
                  prep=None, parent=None):
@@ -50,109 +56,75 @@ def event_params(segments, params, band=None, n_fft=None, slopes=None,
     -------
     list of dict
         list of segments, with time series, metadata and parameters
+
+    Notes
+    -----
+    The parameters are computed on all the segments at once by
+    event_params_table, this function only splits the table by segment.
     """
     if parent is not None:
         progress = QProgressDialog('Computing parameters', 'Abort',
                                    0, len(segments) - 1, parent)
         progress.setWindowModality(Qt.ApplicationModal)
 
-    param_keys = ['dur', 'minamp', 'maxamp', 'ptp', 'rms', 'power', 'peakpf', 
-                  'energy', 'peakef']
-    
-    if params == 'all':
-        params = {k: 1 for k in param_keys}
-    if prep is None:
-        prep = {k: 0 for k in param_keys}    
-    if band is None:
-        band = (None, None)
+    params, prep = _params_options(params, prep)
+    table = event_params_table(segments, params, band=band, n_fft=n_fft,
+                               slopes=slopes, prep=prep)
 
     params_out = []
-    evt_output = False
+    if not (any(params[k] for k in PARAM_KEYS) or slopes):
+        if parent:
+            progress.close()
+        return params_out
+
+    # rows of each segment
+    idx_rows = searchsorted(table['segment'], arange(len(segments) + 1))
 
     for i, seg in enumerate(segments):
         out = dict(seg)
-        dat = seg['data']            
+        dat = seg['data']
+        rows = slice(idx_rows[i], idx_rows[i + 1])
 
         if params['dur']:
             out['dur'] = float(dat.number_of('time')) / dat.s_freq
-            evt_output = True
 
-        if params['minamp']:
-            dat1 = dat
-            if prep['minamp']:
-                dat1 = seg['trans_data']
-            out['minamp'] = math(dat1, operator=_amin, axis='time')
-            evt_output = True
-
-        if params['maxamp']:
-            dat1 = dat
-            if prep['maxamp']:
-                dat1 = seg['trans_data']
-            out['maxamp'] = math(dat1, operator=_amax, axis='time')
-            evt_output = True
-
-        if params['ptp']:
-            dat1 = dat
-            if prep['ptp']:
-                dat1 = seg['trans_data']
-            out['ptp'] = math(dat1, operator=_ptp, axis='time')
-            evt_output = True
-
-        if params['rms']:
-            dat1 = dat
-            if prep['rms']:
-                dat1 = seg['trans_data']
-            out['rms'] = math(dat1, operator=(square, _mean, sqrt),
-               axis='time')
-            evt_output = True
+        for amp in ('minamp', 'maxamp', 'ptp', 'rms'):
+            if params[amp]:
+                dat1 = dat
+                if prep[amp]:
+                    dat1 = seg['trans_data']
+                out[amp] = _chan_values(dat1, table[amp][rows])
 
         for pw, pk in [('power', 'peakpf'), ('energy', 'peakef')]:
-
             if params[pw] or params[pk]:
-                evt_output = True
-
-                if prep[pw] or prep[pk]:
-                    prep_pw, prep_pk = band_power(seg['trans_data'], band,
-                                                 scaling=pw, n_fft=n_fft)
-                if not (prep[pw] and prep[pk]):
-                    raw_pw, raw_pk = band_power(dat, band, 
-                                                scaling=pw, n_fft=n_fft)
-
-                if prep[pw]:
-                    out[pw] = prep_pw
-                else:
-                    out[pw] = raw_pw
-
-                if prep[pk]:
-                    out[pk] = prep_pk
-                else:
-                    out[pk] = raw_pk
+                for k in (pw, pk):
+                    dat1 = dat
+                    if prep[k]:
+                        dat1 = seg['trans_data']
+                    out[k] = dict(zip(dat1.axis['chan'][0], table[k][rows]))
 
         if slopes:
-            evt_output = True
-            out['slope'] = {}
             dat1 = dat
             if slopes['prep']:
                 dat1 = seg['trans_data']
-            if slopes['invert']:
-                dat1 = math(dat1, operator=negative, axis='time')
 
-            if slopes['avg_slope'] and slopes['max_slope']:
-                level = 'all'
-            elif slopes['avg_slope']:
-                level = 'average'
-            else:
-                level = 'maximum'
-
-            for chan in dat1.axis['chan'][0]:
-                d = dat1(chan=chan)[0]
-                out['slope'][chan] = get_slopes(d, dat.s_freq, level=level)
-                
-        if evt_output:
-            timeline = dat.axis['time'][0]
-            out['start'] = timeline[0]
-            out['end'] = timeline[-1]
-            params_out.append(out)
+            out['slope'] = {}
+            for chan, r in zip(dat1.axis['chan'][0],
+                               range(rows.start, rows.stop)):
+                if 'avg_slope' in table and 'max_slope' in table:
+                    out['slope'][chan] = (table['avg_slope'][r],
+                                          table['max_slope'][r])
+                elif 'avg_slope' in table:
+                    out['slope'][chan] = (table['avg_slope'][r],
+                                          full(5, nan))
+                else:  # get_slopes returns the same array twice
+                    max_slope = table['max_slope'][r]
+                    out['slope'][chan] = (max_slope, max_slope)
+
+        timeline = dat.axis['time'][0]
+        out['start'] = timeline[0]
+        out['end'] = timeline[-1]
+        params_out.append(out)
 
         if parent:
             progress.setValue(i)
@@ -166,6 +138,108 @@ def event_params(segments, params, band=None, n_fft=None, slopes=None,
 
     return params_out
 
+
+def event_params_table(segments, params, band=None, n_fft=None, slopes=None,
+                       prep=None, max_size=2 ** 22):
+    """Compute the event parameters of all the segments at once.
+
+    Parameters
+    ----------
+    segments : instance of wonambi.trans.select.Segments
+        list of segments, with time series and metadata
+    params : dict of bool, or str
+        see event_params
+    band : tuple of float
+        band of interest for power and energy
+    n_fft : int
+        length of FFT. if shorter than input signal, signal is truncated; if 
+        longer, signal is zero-padded to length
+    slopes : dict of bool
+        'avg_slope', 'max_slope', 'prep', 'invert'
+    prep : dict of bool
+        same keys as params. if True, segment['trans_data'] will be used
+    max_size : int
+        maximum number of values of the segments which are processed at once
+        (for the spectra and the slopes)
+
+    Returns
+    -------
+    dict of ndarray
+        columns of the table, with one row for each channel of each segment:
+        'segment' (index of the segment), 'chan', 'start', 'end', and one
+        column for each parameter in params. Slopes are in 'avg_slope' and
+        'max_slope', with 5 values for each row (q1, q2, q3, q4 and q23, as
+        in get_slopes).
+
+    Notes
+    -----
+    All the channels of all the segments are packed into one long buffer, so
+    that the amplitudes are computed with one reduction for all the segments.
+    The spectra and the slopes are computed on groups of segments with the
+    same number of samples, with one FFT for the whole group.
+
+    If one parameter is computed on 'trans_data', it should have the same
+    channels as 'data'.
+    """
+    params, prep = _params_options(params, prep)
+    if band is None:
+        band = (None, None)
+
+    packed = {'data': _pack_rows(segments, 'data')}
+
+    def rows_of(use_prep):
+        key = 'trans_data' if use_prep else 'data'
+        if key not in packed:
+            packed[key] = _pack_rows(segments, key)
+        return packed[key]
+
+    raw = packed['data']
+    timelines = [seg['data'].axis['time'][0] for seg in segments]
+    table = {
+        'segment': raw['segment'],
+        'chan': raw['chan'],
+        'start': asarray([t[0] for t in timelines])[raw['segment']],
+        'end': asarray([t[-1] for t in timelines])[raw['segment']],
+        }
+
+    if params['dur']:
+        n_smp = asarray([seg['data'].number_of('time') for seg in segments])
+        s_freq = asarray([seg['data'].s_freq for seg in segments])
+        table['dur'] = (n_smp / s_freq)[raw['segment']]
+
+    for amp in ('minamp', 'maxamp', 'ptp', 'rms'):
+        if params[amp]:
+            table[amp] = _amplitude_rows(rows_of(prep[amp]), amp)
+
+    for pw, pk in [('power', 'peakpf'), ('energy', 'peakef')]:
+        if params[pw] or params[pk]:
+            for use_prep in set((prep[pw], prep[pk])):
+                power, peakf = _band_power_rows(rows_of(use_prep), band, pw,
+                                                n_fft, max_size)
+                if prep[pw] == use_prep:
+                    table[pw] = power
+                if prep[pk] == use_prep:
+                    table[pk] = peakf
+
+    if slopes:
+        if slopes['avg_slope'] and slopes['max_slope']:
+            level = 'all'
+        elif slopes['avg_slope']:
+            level = 'average'
+        else:
+            level = 'maximum'
+
+        avg_slope, max_slope = _slopes_rows(rows_of(slopes['prep']),
+                                            raw['s_freq'], level,
+                                            slopes['invert'], max_size)
+        if level in ('average', 'all'):
+            table['avg_slope'] = avg_slope
+        if level in ('maximum', 'all'):
+            table['max_slope'] = max_slope
+
+    return table
+
+
 def export_event_params(filename, params, count=None, density=None):
     """Write event analysis data to CSV."""
     heading_row_1 = ['Segment index',
@@ -418,14 +492,240 @@ def export_freq_band(xfreq, bands, filename):
                                    chan,
                                    ] + data_row)
 
-def _amax(x, axis, keepdims=None):
-    return amax(x, axis=axis)
+def _params_options(params, prep):
+    """Expand params='all' and the default prep."""
+    if params == 'all':
+        params = {k: 1 for k in PARAM_KEYS}
+    if prep is None:
+        prep = {k: 0 for k in PARAM_KEYS}
+    return params, prep
 
-def _amin(x, axis, keepdims=None):
-    return amin(x, axis=axis)
 
-def _ptp(x, axis, keepdims=None):
-    return ptp(x, axis=axis)
+def _chan_values(dat, values):
+    """Put one value per channel in Data, as math(dat, axis='time') does."""
+    output = dat._copy(axis=False)
+    del output.axis['time']
+    for one_axis in output.axis:
+        output.axis[one_axis] = deepcopy(dat.axis[one_axis])
+    output.data[0] = values
+    return output
+
+
+def _pack_rows(segments, key):
+    """Concatenate all the channels of all the segments into one buffer.
+
+    Returns
+    -------
+    dict
+        'buffer' with the values of all the rows, and for each row: 'start'
+        (index in the buffer), 'length', 'segment', 'chan' and 's_freq'
+    """
+    x = [seg[key].data[0] for seg in segments]
+    n_rows = asarray([one.shape[0] for one in x], dtype=int)
+    n_smp = asarray([one.shape[-1] for one in x], dtype=int)
+
+    rows = {}
+    if x:
+        rows['buffer'] = concatenate([one.ravel() for one in x])
+        rows['chan'] = concatenate([seg[key].axis['chan'][0]
+                                    for seg in segments])
+    else:
+        rows['buffer'] = empty(0)
+        rows['chan'] = empty(0, dtype='O')
+    rows['segment'] = arange(len(x)).repeat(n_rows)
+    rows['length'] = n_smp.repeat(n_rows)
+    rows['start'] = concatenate(([0], cumsum(rows['length'])[:-1]))
+    rows['s_freq'] = asarray([seg[key].s_freq for seg in segments],
+                             dtype=float).repeat(n_rows)
+    return rows
+
+
+def _equal_rows(rows, max_size):
+    """Group the rows with the same length and sampling frequency.
+
+    Yields
+    ------
+    float
+        sampling frequency
+    2d ndarray
+        values of the rows (row x time), at most max_size values
+    1d ndarray
+        index of the rows
+    """
+    order = lexsort((rows['length'], rows['s_freq']))
+    keys = stack((rows['s_freq'][order], rows['length'][order]))
+    changes = (diff(keys, axis=1) != 0).any(axis=0).nonzero()[0] + 1
+    edges = concatenate(([0], changes, [len(order)]))
+
+    for i0, i1 in zip(edges[:-1], edges[1:]):
+        if i0 == i1:  # no rows
+            continue
+        s_freq = rows['s_freq'][order[i0]]
+        n_smp = rows['length'][order[i0]]
+        n_batch = max(max_size // max(n_smp, 1), 1)
+        for j0 in range(i0, i1, n_batch):
+            idx = order[j0:min(j0 + n_batch, i1)]
+            x = rows['buffer'][rows['start'][idx, None] + arange(n_smp)]
+            yield s_freq, x, idx
+
+
+def _amplitude_rows(rows, param):
+    """Compute minamp, maxamp, ptp or rms of each row, with one reduction."""
+    buffer = rows['buffer']
+    dtype = buffer.dtype if buffer.dtype.kind == 'f' else float
+    nonempty = rows['length'] > 0
+    idx = rows['start'][nonempty]
+
+    out = full(len(rows['length']), nan, dtype=dtype)
+    if not nonempty.any():
+        return out
+
+    if param == 'minamp':
+        out[nonempty] = minimum.reduceat(buffer, idx)
+    elif param == 'maxamp':
+        out[nonempty] = maximum.reduceat(buffer, idx)
+    elif param == 'ptp':
+        out[nonempty] = (maximum.reduceat(buffer, idx) -
+                         minimum.reduceat(buffer, idx))
+    elif param == 'rms':
+        sumsq = add.reduceat(square(buffer, dtype=float), idx)
+        out[nonempty] = sqrt(sumsq / rows['length'][nonempty])
+
+    return out
+
+
+def _band_power_rows(rows, band, scaling, n_fft, max_size):
+    """Compute power and peak frequency of each row, as band_power does."""
+    power = full(len(rows['length']), nan)
+    peakf = full(len(rows['length']), nan)
+
+    for s_freq, x, idx in _equal_rows(rows, max_size):
+        if x.shape[1] == 0:
+            continue
+
+        sf, Sxx = _fft(x, s_freq, detrend=None, taper=None,
+                       output='spectraldensity', sides='one', scaling=scaling,
+                       halfbandwidth=3, n_fft=n_fft)
+        f_res = sf[1] - sf[0]
+
+        if band[0] is not None:
+            idx_f1 = abs(sf - band[0]).argmin()
+        else:
+            idx_f1 = 0
+        if band[1] is not None:
+            idx_f2 = min(abs(sf - band[1]).argmin() + 1, len(sf) - 1)
+        else:
+            idx_f2 = len(sf) - 1
+
+        s = Sxx[:, idx_f1:idx_f2]
+        power[idx] = s.sum(axis=1) * f_res
+        peakf[idx] = sf[idx_f1:idx_f2][s.argmax(axis=1)]
+
+    return power, peakf
+
+
+def _slopes_rows(rows, s_freq, level, invert, max_size, smooth=0.05):
+    """Compute the slopes of each row, as get_slopes does.
+
+    Parameters
+    ----------
+    rows : dict
+        output of _pack_rows
+    s_freq : 1d ndarray
+        sampling frequency of each row, used for the slopes
+    level : str
+        'average', 'maximum' or 'all'
+    invert : bool
+        if the data should be inverted
+    max_size : int
+        maximum number of values which are processed at once
+    smooth : float
+        duration of the moving average before computing the maximum slopes
+
+    Returns
+    -------
+    2d ndarray
+        average slopes (row x 5)
+    2d ndarray
+        maximum slopes (row x 5)
+    """
+    rows = dict(rows, s_freq=s_freq)
+    avg_slope = full((len(s_freq), 5), nan)
+    max_slope = full((len(s_freq), 5), nan)
+
+    for one_s_freq, x, idx in _equal_rows(rows, max_size):
+        if not invert:
+            x = negative(x)  # legacy code, as in get_slopes
+        avg_slope[idx], max_slope[idx] = _slopes_batch(x, one_s_freq, level,
+                                                       smooth)
+
+    return avg_slope, max_slope
+
+
+def _slopes_batch(x, s_freq, level, smooth):
+    """Compute the slopes of rows with the same length (see get_slopes)."""
+    n_rows, n_smp = x.shape
+    avg_slope = full((n_rows, 5), nan)
+    max_slope = full((n_rows, 5), nan)
+    if n_smp < 2:
+        return avg_slope, max_slope
+
+    rows = arange(n_rows)
+    j = arange(n_smp - 1)[None, :]  # index of the zero crossings
+    idx_trough = x.argmin(axis=1)[:, None]
+    idx_peak = x.argmax(axis=1)[:, None]
+    crossing = diff(sign(x), axis=1) != 0
+
+    # a zero crossing on the first sample of each part does not count
+    zc_0 = crossing & (j <= idx_trough - 2)
+    zc_1 = crossing & (j >= idx_trough) & (j <= idx_peak - 2)
+    zc_2 = crossing & (j >= idx_peak)
+    valid = ((idx_trough < idx_peak)[:, 0] &
+             (zc_1 & (j > idx_trough)).any(axis=1))
+
+    idx_zero_0 = where(zc_0.any(axis=1),
+                       n_smp - 2 - argmax(zc_0[:, ::-1], axis=1), 0)
+    idx_zero_1 = argmax(zc_1, axis=1)
+    idx_zero_2 = where((zc_2 & (j > idx_peak)).any(axis=1),
+                       argmax(zc_2, axis=1), n_smp - 1)
+    idx_trough = idx_trough[:, 0]
+    idx_peak = idx_peak[:, 0]
+
+    if level in ('average', 'all'):
+        trough = x[rows, idx_trough]
+        peak = x[rows, idx_peak]
+        with errstate(divide='ignore', invalid='ignore'):
+            avg_slope = stack((
+                trough / ((idx_trough - idx_zero_0) / s_freq),
+                trough / ((idx_zero_1 - idx_trough) / s_freq),
+                peak / ((idx_peak - idx_zero_1) / s_freq),
+                peak / ((idx_zero_2 - idx_peak) / s_freq),
+                (peak - trough) / ((idx_peak - idx_trough) / s_freq),
+                ), axis=1)
+        avg_slope[isinf(avg_slope)] = nan
+        avg_slope[~valid] = nan
+
+    if level in ('maximum', 'all'):
+        win = int(smooth * s_freq)
+        x = fftconvolve(x, ones((1, win)) / win, mode='same', axes=1)
+        dx = diff(x, axis=1)
+
+        quadrants = [
+            (idx_zero_0, idx_trough, False),
+            (idx_trough, idx_zero_1, True),
+            (idx_zero_1, idx_peak, True),
+            (idx_peak, idx_zero_2, False),
+            (idx_trough, idx_peak, True),
+            ]
+        for i, (i0, i1, is_max) in enumerate(quadrants):
+            in_quadrant = (j >= i0[:, None]) & (j <= i1[:, None] - 2)
+            if is_max:
+                values = where(in_quadrant, dx, -inf).max(axis=1)
+            else:
+                values = where(in_quadrant, dx, inf).min(axis=1)
+            max_slope[:, i] = where(i1 - i0 >= win, values, nan)
+
+        max_slope[isinf(max_slope)] = nan
+        max_slope[~valid] = nan
 
-def _mean(x, axis, keepdims=None):
-    return mean(x, axis=axis)
\ No newline at end of file
+    return avg_slope, max_slope
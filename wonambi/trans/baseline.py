@@ -52,7 +52,7 @@ def apply_baseline(data, baseline='ratio', **axis_to_select):
     incorrect values.
     """
     axis = list(axis_to_select)[0]
-    bl_data = select(data, **axis_to_select)
+    bl_data = select(data, copy=False, **axis_to_select)
     if baseline in ('dB', ):
         bl_m = math(bl_data, operator_name='gmean', axis=axis)
     else:
@@ -0,0 +1,138 @@
+"""Module to cache arrays which are expensive to compute and are used many
+times, such as the tapers of the spectral analysis or the filter designs.
+
+The caches are shared by the whole process. You can change their size or
+store the expensive arrays on disk, so that they can be reused by the next
+processes:
+
+    from wonambi.trans.cache import TAPERS
+    TAPERS.directory = '/path/to/cache'
+"""
+from collections import OrderedDict
+from hashlib import blake2b
+from logging import getLogger
+from os import getpid, replace
+from pathlib import Path
+from threading import Lock
+
+from numpy import load, ndarray, save
+
+lg = getLogger(__name__)
+
+
+class ArrayCache:
+    """Cache of arrays, with LRU eviction based on their size in memory.
+
+    Parameters
+    ----------
+    max_memory : int
+        maximum size (in bytes) of the arrays kept in memory
+    directory : str or Path, optional
+        directory where the arrays computed with disk=True are stored
+
+    Attributes
+    ----------
+    n_hits : int
+        number of arrays which were already in the cache
+    n_misses : int
+        number of arrays which had to be computed (or read from disk)
+
+    Notes
+    -----
+    The arrays are read-only, because they are shared by all the functions
+    which use the cache. Make a copy if you need to modify them.
+    """
+    def __init__(self, max_memory, directory=None):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.n_hits = 0
+        self.n_misses = 0
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._lock = Lock()
+
+    def __call__(self, key, func, disk=False):
+        """Return the array from the cache or compute it.
+
+        Parameters
+        ----------
+        key : tuple
+            hashable description of the array (it should contain all the
+            parameters of func)
+        func : function
+            function without arguments which computes the array (or a tuple of
+            arrays)
+        disk : bool
+            if the array should be stored on disk as well (only when directory
+            is specified and func returns one array)
+
+        Returns
+        -------
+        ndarray or tuple of ndarray
+            read-only array(s)
+        """
+        try:
+            hash(key)
+        except TypeError:  # the parameters cannot be used as key
+            return func()
+
+        with self._lock:
+            if key in self._cache:
+                self.n_hits += 1
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        self.n_misses += 1
+        if disk and self.directory is not None:
+            value = self._from_disk(key, func)
+        else:
+            value = func()
+
+        arrays = value if isinstance(value, tuple) else (value, )
+        for one_array in arrays:
+            one_array.setflags(write=False)
+        nbytes = sum(one_array.nbytes for one_array in arrays)
+
+        with self._lock:
+            if key not in self._cache and nbytes <= self.max_memory:
+                self._cache[key] = value
+                self._nbytes += nbytes
+                while self._nbytes > self.max_memory:
+                    _, old = self._cache.popitem(last=False)
+                    old = old if isinstance(old, tuple) else (old, )
+                    self._nbytes -= sum(x.nbytes for x in old)
+
+        return value
+
+    def clear(self):
+        """Remove all the arrays from memory (not from disk)."""
+        with self._lock:
+            self._cache.clear()
+            self._nbytes = 0
+
+    def _from_disk(self, key, func):
+        """Read the array from disk or compute it and write it to disk."""
+        digest = blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        directory = Path(self.directory)
+        filename = directory / (str(key[0]) + '_' + digest + '.npy')
+
+        if filename.exists():
+            try:
+                return load(filename)
+            except (OSError, ValueError):
+                lg.warning('Could not read ' + str(filename) + ', computing '
+                           'it again')
+
+        value = func()
+        if isinstance(value, ndarray):
+            directory.mkdir(parents=True, exist_ok=True)
+            # write to temporary file first, in case of parallel processes
+            tmp_file = filename.with_suffix('.' + str(getpid()) + '.npy')
+            save(tmp_file, value)
+            replace(tmp_file, filename)
+
+        return value
+
+
+TAPERS = ArrayCache(max_memory=2 ** 28)
+FILTERS = ArrayCache(max_memory=2 ** 24)
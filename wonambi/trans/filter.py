@@ -1,22 +1,32 @@
 """Module to filter the data.
 """
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
+from os import cpu_count
 
 from itertools import product
 
-from numpy import arange, empty, ix_, expand_dims, squeeze
+from numpy import (arange, array_split, concatenate, empty, ix_, expand_dims,
+                   moveaxis, nonzero, squeeze, vstack, zeros)
 from scipy.signal import (iirfilter,
                           iirnotch,
-                          filtfilt,
+                          sosfilt,
+                          sosfilt_zi,
+                          sosfiltfilt,
                           get_window,
                           fftconvolve,
+                          tf2sos,
                           )
 
+from .cache import FILTERS
+from ..datatype import _stack_trials
+
 lg = getLogger(__name__)
 
 
 def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
-            ftype='butter', Rs=None, notchfreq=50, notchquality=25):
+            ftype='butter', Rs=None, notchfreq=50, notchquality=25, n_jobs=1):
     """Design filter and apply it.
 
     Parameters
@@ -37,6 +47,8 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
         (only for notch) frequency to apply notch filter to (+ harmonics)
     notchquality : int
         (only for notch) Quality factor (see scipy.signal.iirnotch)
+    n_jobs : int or None
+        number of threads used to filter the data (None means all the CPUs)
 
     Returns
     -------
@@ -54,12 +66,53 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
     low_cut and high_cut should be given as ratio of the Nyquist. But if you
     specify s_freq, then the ratio will be computed automatically.
 
+    The filters are designed as second-order sections (more stable than the
+    transfer function for high orders or low cutoffs) and kept in the cache
+    wonambi.trans.cache.FILTERS. Trials with the same shape are filtered 
+    together, and their output are views of one contiguous array.
+
     Raises
     ------
     ValueError
         if the cutoff frequency is larger than the Nyquist frequency.
     """
-    nyquist = data.s_freq / 2.
+    sos = _design_filters(data.s_freq, low_cut, high_cut, order, ftype, Rs,
+                          notchfreq, notchquality)
+
+    idx_axis = data.index_of(axis)
+    n_jobs = cpu_count() if n_jobs is None else n_jobs
+
+    groups = {}
+    for i, x in enumerate(data.data):
+        groups.setdefault(x.shape, []).append(i)
+
+    fdata = data._copy()
+    for trials in groups.values():
+        x = _stack_trials([data.data[i] for i in trials])
+        x = _filter_threads(sos, x, idx_axis + 1, n_jobs)
+        for i, one_trial in zip(trials, x):
+            fdata.data[i] = one_trial
+
+    return fdata
+
+
+def _design_filters(s_freq, low_cut=None, high_cut=None, order=4,
+                    ftype='butter', Rs=None, notchfreq=50, notchquality=25):
+    """Design the filters used by filter_ and StreamFilter.
+
+    Parameters
+    ----------
+    s_freq : float
+        sampling frequency
+    low_cut, high_cut, order, ftype, Rs, notchfreq, notchquality
+        see filter_
+
+    Returns
+    -------
+    list of ndarray
+        filters (as second-order sections) to apply one after the other
+    """
+    nyquist = s_freq / 2.
 
     btype = None
     if low_cut is not None and high_cut is not None:
@@ -91,21 +144,351 @@ def filter_(data, axis='time', low_cut=None, high_cut=None, order=4,
         Rs = 40
 
     if ftype == 'notch':
-        b_a = [iirnotch(w0 / nyquist, notchquality) for w0 in arange(notchfreq, nyquist, notchfreq)]
+        sos = [_design_notch(w0 / nyquist, notchquality) 
+               for w0 in arange(notchfreq, nyquist, notchfreq)]
 
     else:
         lg.debug('order {0: 2}, Wn {1}, btype {2}, ftype {3}'
                  ''.format(order, str(Wn), btype, ftype))
-        b_a = [iirfilter(order, Wn, btype=btype, ftype=ftype, rs=Rs), ]
+        sos = [_design_filter(order, Wn, btype, ftype, Rs), ]
 
-    fdata = data._copy()
-    for i in range(data.number_of('trial')):
-        x = data.data[i]
-        for b, a in b_a:
-            x = filtfilt(b, a, x, axis=data.index_of(axis))
-        fdata.data[i] = x
+    return sos
 
-    return fdata
+
+def _design_filter(order, Wn, btype, ftype, Rs):
+    """Design the IIR filter as second-order sections (from the cache)."""
+    if not isinstance(Wn, (int, float)):
+        Wn = tuple(Wn)
+    key = ('iirfilter', order, Wn, btype, ftype, Rs)
+    return FILTERS(key, partial(iirfilter, order, Wn, btype=btype, ftype=ftype,
+                                rs=Rs, output='sos'))
+
+
+def _design_notch(w0, quality):
+    """Design the notch filter as second-order sections (from the cache)."""
+    key = ('iirnotch', w0, quality)
+    return FILTERS(key, lambda: tf2sos(*iirnotch(w0, quality)))
+
+
+def _filter_threads(sos, x, axis, n_jobs):
+    """Apply the filters forward and backward, with one or more threads.
+
+    Parameters
+    ----------
+    sos : list of ndarray
+        filters (as second-order sections) to apply one after the other
+    x : ndarray
+        data to filter
+    axis : int
+        axis to filter
+    n_jobs : int
+        number of threads
+
+    Returns
+    -------
+    ndarray
+        filtered data
+
+    Notes
+    -----
+    The data is divided along the longest of the other axes. sosfiltfilt
+    releases the GIL, so the threads run in parallel.
+    """
+    sos = [one_sos.copy() for one_sos in sos]  # scipy needs writeable arrays
+
+    def _filter(x):
+        for one_sos in sos:
+            x = sosfiltfilt(one_sos, x, axis=axis)
+        return x
+
+    other_axes = [i for i in range(x.ndim) if i != axis]
+    if n_jobs == 1 or not other_axes:
+        return _filter(x)
+
+    split_axis = max(other_axes, key=lambda i: x.shape[i])
+    chunks = array_split(x, min(n_jobs, x.shape[split_axis]), axis=split_axis)
+    with ThreadPoolExecutor(n_jobs) as executor:
+        filtered = list(executor.map(_filter, chunks))
+    return concatenate(filtered, axis=split_axis)
+
+
+class StreamFilter:
+    """Filter which keeps its state between successive chunks of data.
+
+    Parameters
+    ----------
+    s_freq : float
+        sampling frequency
+    low_cut, high_cut, order, ftype, Rs, notchfreq, notchquality
+        see filter_ (they are ignored if you pass sos)
+    zero_phase : bool
+        if False, the filter is causal (the same as scipy.signal.sosfilt). If
+        True, the forward-backward filter (the same as filter_) is
+        approximated with overlap-add, and the output is delayed by padding.
+    padding : float, optional
+        (only for zero_phase) duration (in s) of the impulse response of the
+        forward-backward filter on each side. If None, it's the duration of the
+        causal impulse response until it decays below 1e-6 of its peak.
+    axis : str, optional
+        axis to apply the filter on.
+    sos : ndarray or list of ndarray, optional
+        filters (as second-order sections) to apply one after the other,
+        instead of designing them from the cutoffs
+
+    Attributes
+    ----------
+    delay : float
+        delay (in s) between the last sample of the input and the last sample
+        of the output
+    n_samples : int
+        number of samples which were passed to the filter
+
+    Notes
+    -----
+    Each trial of the data is a chunk, and the chunks should follow each other
+    in time, with the same channels. The output of the successive chunks
+    (followed by the output of flush for zero_phase) is the same as filtering
+    the whole signal at once:
+
+      - the causal filter starts in the steady state for the first sample, so
+        it's the same as sosfilt(sos, x, zi=sosfilt_zi(sos) * x[0]).
+      - the zero-phase filter is the convolution with the impulse response of
+        the forward-backward filter (truncated at padding), assuming that the
+        signal is zero before the first and after the last sample. It's close
+        to filter_ except at the edges of the recording, where filter_ pads
+        the signal.
+
+    The time axis of the output contains the time points of the samples which
+    were filtered, so that the output of zero_phase is shorter than the input
+    for the first chunk.
+    """
+    def __init__(self, s_freq, low_cut=None, high_cut=None, order=4,
+                 ftype='butter', Rs=None, notchfreq=50, notchquality=25,
+                 zero_phase=False, padding=None, axis='time', sos=None):
+        if sos is None:
+            sos = _design_filters(s_freq, low_cut, high_cut, order, ftype, Rs,
+                                  notchfreq, notchquality)
+        elif not isinstance(sos, (list, tuple)):
+            sos = [sos, ]
+
+        self.s_freq = s_freq
+        self.zero_phase = zero_phase
+        self.axis = axis
+        # a cascade of filters is the same as the filter with all the sections
+        self.sos = vstack(sos)
+
+        if zero_phase:
+            if padding is None:
+                n_pad = _impulse_length(self.sos, s_freq) - 1
+            else:
+                n_pad = int(round(padding * s_freq))
+            self._n_pad = n_pad
+            h = sosfilt(self.sos, _unit_impulse(2 * n_pad + 1))
+            self._kernel = fftconvolve(h, h[::-1])[n_pad:3 * n_pad + 1]
+        else:
+            self._n_pad = 0
+
+        self.reset()
+
+    @classmethod
+    def from_transform(cls, s_freq, method, method_opt, zero_phase=True,
+                       padding=None):
+        """Create the filter of transform_signal, to apply it in chunks.
+
+        Parameters
+        ----------
+        s_freq : float
+            sampling frequency
+        method : str
+            one of 'butter', 'sosbutter', 'double_butter', 'double_sosbutter',
+            'cheby2', 'high_butter', 'low_butter'
+        method_opt : dict
+            parameters of the method (see transform_signal)
+        zero_phase, padding
+            see StreamFilter
+
+        Returns
+        -------
+        instance of StreamFilter
+            filter with the same frequency response as transform_signal
+
+        Notes
+        -----
+        transform_signal applies the transfer function for 'butter',
+        'cheby2', 'high_butter', 'low_butter' and 'double_butter', while
+        StreamFilter always uses second-order sections, so the results can
+        differ slightly for high orders or very low cutoffs.
+        """
+        if method not in ('butter', 'sosbutter', 'cheby2', 'double_butter',
+                          'double_sosbutter', 'high_butter', 'low_butter'):
+            raise ValueError('Method ' + method + ' cannot be applied in '
+                             'chunks')
+
+        freq = method_opt['freq']
+        N = method_opt['order']
+        nyquist = s_freq / 2
+
+        if method in ('butter', 'sosbutter'):
+            sos = [_design_filter(N, (freq[0] / nyquist, freq[1] / nyquist),
+                                  'bandpass', 'butter', 40), ]
+        elif method == 'cheby2':
+            sos = [_design_filter(N, (freq[0] / nyquist, freq[1] / nyquist),
+                                  'bandpass', 'cheby2', 40), ]
+        elif method in ('double_butter', 'double_sosbutter'):
+            sos = [_design_filter(N, freq[0] / nyquist, 'highpass', 'butter',
+                                  40),
+                   _design_filter(N, freq[1] / nyquist, 'lowpass', 'butter',
+                                  40)]
+        elif method == 'high_butter':
+            sos = [_design_filter(N, freq / nyquist, 'highpass', 'butter',
+                                  40), ]
+        elif method == 'low_butter':
+            sos = [_design_filter(N, freq / nyquist, 'lowpass', 'butter',
+                                  40), ]
+
+        return cls(s_freq, sos=sos, zero_phase=zero_phase, padding=padding)
+
+    @property
+    def delay(self):
+        return self._n_pad / self.s_freq
+
+    def reset(self):
+        """Forget the previous chunks, to filter a new signal."""
+        self.n_samples = 0
+        self._zi = None
+        self._tail = None
+        self._time = None
+        self._template = None
+
+    def __call__(self, data):
+        """Filter the next chunk(s) of the signal.
+
+        Parameters
+        ----------
+        data : instance of Data
+            the next chunk of data (if there are multiple trials, they are
+            considered as successive chunks)
+
+        Returns
+        -------
+        instance of Data
+            filtered data, with one trial for each trial of the input
+        """
+        idx_axis = data.index_of(self.axis)
+
+        fdata = data._copy()
+        for i in range(data.number_of('trial')):
+            x = moveaxis(data.data[i], idx_axis, -1)
+            time = data.axis[self.axis][i]
+
+            if self.zero_phase:
+                x, time = self._overlap_add(x, time)
+            else:
+                x = self._causal(x)
+
+            fdata.axis[self.axis][i] = time
+            fdata.data[i] = moveaxis(x, -1, idx_axis)
+
+        self._template = fdata
+        return fdata
+
+    def flush(self):
+        """Return the last samples of the zero-phase filter, assuming that the
+        signal ends here.
+
+        Returns
+        -------
+        instance of Data or None
+            the filtered samples which were still waiting for the next chunk
+            (None for the causal filter or if there is no data)
+        """
+        if not self.zero_phase or self._tail is None:
+            return None
+
+        idx_axis = self._template.index_of(self.axis)
+        n_pad = self._n_pad
+        n_out = len(self._time)
+        x = self._tail[..., n_pad - n_out:n_pad]
+
+        fdata = self._template._copy(axis=True)
+        fdata.data = fdata.data[:1]
+        for axis_name in fdata.axis:
+            fdata.axis[axis_name] = fdata.axis[axis_name][:1]
+        fdata.axis[self.axis][0] = self._time
+        fdata.data[0] = moveaxis(x, -1, idx_axis)
+
+        self.reset()
+        return fdata
+
+    def _causal(self, x):
+        """Apply the filter forward, continuing from the previous state."""
+        if self._zi is None:
+            zi = sosfilt_zi(self.sos)
+            zi = zi.reshape((zi.shape[0], ) + (1, ) * (x.ndim - 1) + (2, ))
+            self._zi = zi * x[None, ..., :1]
+
+        if self._zi.shape[1:-1] != x.shape[:-1]:
+            raise ValueError('All the chunks should have the same channels')
+
+        y, self._zi = sosfilt(self.sos, x, axis=-1, zi=self._zi)
+        self.n_samples += x.shape[-1]
+        return y
+
+    def _overlap_add(self, x, time):
+        """Convolve the chunk with the impulse response of the
+        forward-backward filter, and add the tail of the previous chunks."""
+        n_pad = self._n_pad
+        n_smp = x.shape[-1]
+
+        if self._tail is None:
+            self._tail = zeros(x.shape[:-1] + (2 * n_pad, ))
+            self._time = time[:0]
+        if self._tail.shape[:-1] != x.shape[:-1]:
+            raise ValueError('All the chunks should have the same channels')
+
+        kernel = self._kernel.reshape((1, ) * (x.ndim - 1) + (-1, ))
+        y = fftconvolve(x, kernel, axes=-1) if n_smp else self._tail[..., :0]
+        y = concatenate((y, zeros(x.shape[:-1] + (2 * n_pad + n_smp
+                                                  - y.shape[-1], ))),
+                        axis=-1)
+        y[..., :2 * n_pad] += self._tail
+
+        # y[j] corresponds to the sample (n_samples + j - n_pad)
+        n_skip = max(n_pad - self.n_samples, 0)
+        self._tail = y[..., n_smp:]
+        y = y[..., min(n_skip, n_smp):n_smp]
+        self.n_samples += n_smp
+
+        time = concatenate((self._time, time))
+        self._time = time[y.shape[-1]:]
+        return y, time[:y.shape[-1]]
+
+
+def _unit_impulse(n_smp):
+    x = zeros(n_smp)
+    x[0] = 1
+    return x
+
+
+def _impulse_length(sos, s_freq, tol=1e-6, max_dur=60):
+    """Number of samples of the impulse response, until it decays below tol of
+    its peak (in blocks of 1 s, up to max_dur s)."""
+    n_block = max(int(s_freq), 1)
+    zi = zeros((sos.shape[0], 2))
+    x = _unit_impulse(n_block)
+
+    h = []
+    peak = 0
+    while len(h) * n_block < max_dur * s_freq:
+        y, zi = sosfilt(sos, x, zi=zi)
+        h.append(y)
+        peak = max([peak, abs(y).max()])
+        if len(h) > 1 and abs(y).max() < tol * peak:
+            break
+        x = zeros(n_block)
+
+    h = abs(concatenate(h))
+    return int(nonzero(h >= tol * peak)[0][-1]) + 1
 
 
 def convolve(data, window, axis='time', length=1):
@@ -1,20 +1,23 @@
 """Module to compute frequency representation.
 """
 from copy import deepcopy
-from logging import getLogger
 from functools import partial
-from multiprocessing import Pool
+from logging import getLogger
 
 from numpy import (arange, array, asarray, copy, empty, exp, isnan, log, max, mean,
-                   median, moveaxis, nan, pi, real, reshape, sqrt, swapaxes, zeros)
+                   median, moveaxis, nan, pi, real, roll, sqrt,
+                   swapaxes, zeros)
 from numpy.linalg import norm
 import numpy.fft as np_fft
 from scipy import fftpack
-from scipy.signal import windows, get_window, fftconvolve
+import scipy.fft as sp_fft
+from scipy.fft import next_fast_len
+from scipy.signal import windows, get_window
 from scipy.signal import detrend as detrend_func
 
+from .cache import TAPERS
 from .extern.dpss import dpss_windows  # this will be in scipy v1.1
-from ..datatype import ChanFreq, ChanTimeFreq, ChanTime
+from ..datatype import ChanFreq, ChanTimeFreq, ChanTime, _stack_trials
 from .select import _create_subepochs
 
 lg = getLogger(__name__)
@@ -23,7 +26,7 @@ lg = getLogger(__name__)
 def frequency(data, output='spectraldensity', scaling='power', sides='one',
               taper=None, halfbandwidth=3, NW=None, duration=None,
               overlap=0.5, step=None, detrend='linear', n_fft=None,
-              log_trans=False, centend='mean'):
+              log_trans=False, centend='mean', n_jobs=1):
     """Compute the
     power spectral density (PSD, output='spectraldensity', scaling='power'), or
     energy spectral density (ESD, output='spectraldensity', scaling='energy') or
@@ -74,6 +77,8 @@ def frequency(data, output='spectraldensity', scaling='power', sides='one',
     centend : str
         (only if duration is not None). Central tendency measure to use, either
         mean (arithmetic) or median.
+    n_jobs : int or None
+        number of threads for the FFTs (None means all the CPUs)
 
     Returns
     -------
@@ -100,6 +105,12 @@ def frequency(data, output='spectraldensity', scaling='power', sides='one',
 
     Use of log or median for Welch's method is included based on
     recommendations from Izhikevich et al., bioRxiv, 2018.
+
+    Trials with the same shape are computed together (the tapers are computed
+    once and the FFTs are run on batches of trials). The output of these
+    trials are views of one contiguous array (trial x chan x freq). If all the
+    trials have the same shape, freq.trials_array() returns this array without
+    copying it.
     """
     if output not in ('spectraldensity', 'complex', 'csd'):
         raise TypeError('output can be "spectraldensity", "complex" or "csd",'
@@ -132,41 +143,65 @@ def frequency(data, output='spectraldensity', scaling='power', sides='one',
         freq.axis['taper'] = empty(data.number_of('trial'), dtype='O')
     freq.data = empty(data.number_of('trial'), dtype='O')
 
-    for i in range(data.number_of('trial')):
-        x = data(trial=i)
-        if duration is not None:
-            x = _create_subepochs(x, nperseg, nstep)
-
-        f, Sxx = _fft(x,
-                      s_freq=data.s_freq,
-                      detrend=detrend,
-                      taper=taper,
-                      output=output,
-                      sides=sides,
-                      scaling=scaling,
-                      halfbandwidth=halfbandwidth,
-                      NW=NW,
-                      n_fft=n_fft)
-
-        if log_trans:
-            Sxx = log(Sxx)
+    workers = -1 if n_jobs is None else n_jobs
+    stack_axis = min(1, data.data[0].ndim - 1)  # chan should remain first
 
+    for trials, batches in _group_trials(data):
         if duration is not None:
-            if centend == 'mean':
-                Sxx = Sxx.mean(axis=-2)
-            elif centend == 'median':
-                Sxx = median(Sxx, axis=-2)
-            else:
-                raise ValueError('Invalid central tendency measure. '
-                                 'Use mean or median.')
+            n_smp = nperseg
+        else:
+            n_smp = data.data[trials[0]].shape[-1]
+        tapers = _create_tapers(taper, n_smp, data.s_freq, scaling,
+                                halfbandwidth, NW)
+
+        stacked = None
+        cnt = 0
+        for batch in batches:
+            x = _stack_trials([data.data[i] for i in batch],
+                              axis=stack_axis)
+            if duration is not None:
+                x = _create_subepochs(x, nperseg, nstep)
 
-        freq.axis['freq'][i] = f
-        if output == 'complex':
-            freq.axis['taper'][i] = arange(Sxx.shape[-1])
-        if output == 'csd':
-            newchan = ' * '.join(freq.axis['chan'][i])
-            freq.axis['chan'][i] = asarray([newchan], dtype='U')
-        freq.data[i] = Sxx
+            f, Sxx = _fft(x,
+                          s_freq=data.s_freq,
+                          detrend=detrend,
+                          taper=taper,
+                          output=output,
+                          sides=sides,
+                          scaling=scaling,
+                          halfbandwidth=halfbandwidth,
+                          NW=NW,
+                          n_fft=n_fft,
+                          workers=workers,
+                          tapers=tapers)
+
+            if log_trans:
+                Sxx = log(Sxx)
+
+            if duration is not None:
+                if centend == 'mean':
+                    Sxx = Sxx.mean(axis=-2)
+                elif centend == 'median':
+                    Sxx = median(Sxx, axis=-2)
+                else:
+                    raise ValueError('Invalid central tendency measure. '
+                                     'Use mean or median.')
+
+            Sxx = moveaxis(Sxx, stack_axis, 0)
+            if stacked is None:
+                stacked = empty((len(trials), ) + Sxx.shape[1:], 
+                                dtype=Sxx.dtype)
+            stacked[cnt:cnt + len(batch)] = Sxx
+            cnt += len(batch)
+
+        for i, one_trial in zip(trials, stacked):
+            freq.axis['freq'][i] = f.copy()
+            if output == 'complex':
+                freq.axis['taper'][i] = arange(one_trial.shape[-1])
+            if output == 'csd':
+                newchan = ' * '.join(freq.axis['chan'][i])
+                freq.axis['chan'][i] = asarray([newchan], dtype='U')
+            freq.data[i] = one_trial
 
     return freq
 
@@ -231,6 +266,12 @@ def timefrequency(data, method='morlet', **options):
         zero_mean : bool
             make sure that the wavelet has zero mean (only relevant if ratio
             < 5)
+        output : str
+            'complex' (default) returns the complex output of the convolution,
+            'power' returns its squared magnitude, without storing the complex
+            values (half the memory)
+        n_jobs : int or None
+            number of threads for the FFTs (None means all the CPUs)
 
     For method 'spectrogram' or 'stft', the following options should be specified:
         duraton : int
@@ -255,6 +296,8 @@ def timefrequency(data, method='morlet', **options):
                            'dur_in_s': None,
                            'normalization': 'area',
                            'zero_mean': False,
+                           'output': 'complex',
+                           'n_jobs': None,
                            }
     elif method in ('spectrogram', 'stft'):
         default_options = {'duration': 1,
@@ -288,29 +331,20 @@ def timefrequency(data, method='morlet', **options):
         assert data.index_of('chan') == 0
         assert data.index_of('time') == 1
 
-        wavelets = _create_morlet(deepcopy(options), data.s_freq)
+        morlet_options = {k: v for k, v in options.items() 
+                          if k not in ('output', 'n_jobs')}
+        wavelets = _create_morlet(morlet_options, data.s_freq)
+        spectra = {}
 
         for i in range(data.number_of('trial')):
             lg.info('Processing trial # {0: 6}'.format(i))
             timefreq.axis['freq'][i] = array(options['foi'])
             timefreq.axis['time'][i] = data.axis['time'][i]
-
-            timefreq.data[i] = empty((data.number_of('chan')[i],
-                                      data.number_of('time')[i],
-                                      len(options['foi'])),
-                                     dtype='complex')
-
-            data_i = data(trial=i)
-            args = []
-            for i_chan in range(data.number_of('chan')[i]):
-                for wavelet in wavelets:
-                    args.append((i_chan, wavelet))
-
-            with Pool() as p:
-                result = p.starmap(partial(_convolve, dat=data_i), args)
-
-            tf = reshape(array(result), (data.number_of('chan')[i], len(wavelets), -1))
-            timefreq.data[i] = moveaxis(tf, 2, 1)
+            timefreq.data[i] = _morlet_transform(data(trial=i, copy=False),
+                                                 wavelets,
+                                                 output=options['output'],
+                                                 n_jobs=options['n_jobs'],
+                                                 spectra=spectra)
 
     elif method in ('spectrogram', 'stft'):  # TODO: add timeskip
         nperseg = int(options['duration'] * data.s_freq)
@@ -326,7 +360,8 @@ def timefrequency(data, method='morlet', **options):
 
         for i in range(data.number_of('trial')):
             t = _create_subepochs(data.time[i], nperseg, nstep).mean(axis=1)
-            x = _create_subepochs(data(trial=i), nperseg, nstep)
+            x = _create_subepochs(data(trial=i, copy=False), nperseg,
+                                  nstep)
 
             f, Sxx = _fft(x,
                           s_freq=data.s_freq,
@@ -412,7 +447,7 @@ def band_power(data, freq, scaling='power', n_fft=None, detrend=None,
         idx_f2 = len(sf) - 1
 
     for i, chan in enumerate(Sxx.axis['chan'][0]):
-        s = Sxx(chan=chan)[0]
+        s = Sxx(chan=chan, copy=False)[0]
         pw = sum(s[idx_f1:idx_f2]) * f_res
 
         idx_peak = s[idx_f1:idx_f2].argmax()
@@ -542,7 +577,8 @@ def morlet(freq, s_freq, ratio=5, sigma_f=None, dur_in_sd=4, dur_in_s=None,
 
 
 def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
-         sides='one', scaling='power', halfbandwidth=4, NW=None, n_fft=None):
+         sides='one', scaling='power', halfbandwidth=4, NW=None, n_fft=None,
+         workers=1, tapers=None):
     """
     Core function taking care of computing the power spectrum / power spectral
     density or the complex representation.
@@ -578,6 +614,11 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
         Length of FFT, in samples. If less than input axis, input is cropped.
         If longer than input axis, input is padded with zeros. If None, FFT
         length set to axis length.
+    workers : int
+        number of threads for the FFT (-1 means all the CPUs)
+    tapers : 2d ndarray, optional
+        tapers X samples, if they were already created with _create_tapers
+        (taper, scaling, halfbandwidth and NW are then ignored)
 
     Returns
     -------
@@ -644,29 +685,9 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
     elif sides == 'two':
         freqs = fftpack.fftfreq(n_fft, 1 / s_freq)
 
-    if taper is None:
-        taper = 'boxcar'
-
-    if taper == 'dpss':
-        if NW is None:
-            NW = halfbandwidth * n_smp / s_freq
-        tapers, eig = dpss_windows(n_smp, NW, 2 * NW - 1)
-        if scaling == 'chronux':
-            tapers *= sqrt(s_freq)
-
-    else:
-        if taper == 'hann':
-            tapers = windows.hann(n_smp, sym=False)[None, :]
-        else:
-            # TODO: it'd be nice to use sym=False if possible, but the difference is very small
-            tapers = get_window(taper, n_smp)[None, :]
-
-        if scaling == 'energy':
-            rms = sqrt(mean(tapers ** 2))
-            tapers /= rms * sqrt(n_smp)
-        elif scaling != 'chronux':
-            # idk how chronux treats other windows apart from dpss
-            tapers /= norm(tapers)
+    if tapers is None:
+        tapers = _create_tapers(taper, n_smp, s_freq, scaling, halfbandwidth,
+                                NW)
 
     if detrend is not None:
         has_nan = isnan(x).any(axis=axis)
@@ -682,9 +703,9 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
     tapered = tapers * x[..., None, :]
 
     if sides == 'one':
-        result = np_fft.rfft(tapered, n=n_fft)
+        result = sp_fft.rfft(tapered, n=n_fft, workers=workers)
     elif sides == 'two':
-        result = fftpack.fft(tapered, n=n_fft)
+        result = sp_fft.fft(tapered, n=n_fft, workers=workers)
 
     if scaling == 'chronux':
         result /= s_freq
@@ -692,7 +713,7 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
         result *= sqrt(2 / n_smp)
 
     if output == 'spectraldensity':
-        result = (result.conj() * result)
+        result = result.real ** 2 + result.imag ** 2  # = result.conj() * result
     elif output == 'csd':
         result = (result[None, 0, ...].conj() * result[None, 1, ...])
 
@@ -719,8 +740,6 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
         result /= 2
 
     if output in ('spectraldensity', 'csd'):
-        if output == 'spectraldensity':
-            result = result.real
         result = mean(result, axis=axis)
     elif output == 'complex':
         # dpss should be last dimension in complex, no mean
@@ -729,6 +748,176 @@ def _fft(x, s_freq, detrend='linear', taper=None, output='spectraldensity',
     return freqs, result
 
 
-def _convolve(i_chan, wavelet, dat):
-    tf = fftconvolve(dat[i_chan, :], wavelet, 'same')
+def _create_tapers(taper, n_smp, s_freq, scaling, halfbandwidth=4, NW=None):
+    """Create the tapers, normalized according to the scaling.
+
+    Parameters
+    ----------
+    taper : str
+        'boxcar', 'hann', 'dpss' or any window in scipy.signal.get_window
+        (None means 'boxcar')
+    n_smp : int
+        number of samples
+    s_freq, scaling, halfbandwidth, NW
+        see _fft
+
+    Returns
+    -------
+    2d ndarray
+        tapers X samples (read-only)
+
+    Notes
+    -----
+    The tapers are kept in the cache wonambi.trans.cache.TAPERS, so they are
+    computed only once for each combination of parameters. DPSS tapers can 
+    also be stored on disk, by setting TAPERS.directory.
+    """
+    if taper is None:
+        taper = 'boxcar'
+
+    if taper == 'dpss':
+        if NW is None:
+            NW = halfbandwidth * n_smp / s_freq
+        key = ('dpss', n_smp, NW, scaling, 
+               s_freq if scaling == 'chronux' else None)
+    else:
+        key = ('window', taper, n_smp, scaling)
+
+    return TAPERS(key, partial(_compute_tapers, taper, n_smp, s_freq, scaling,
+                               NW))
+
+
+def _compute_tapers(taper, n_smp, s_freq, scaling, NW):
+    """Compute the tapers (see _create_tapers)."""
+    if taper == 'dpss':
+        key = ('dpss', n_smp, NW, 2 * NW - 1)
+        tapers = TAPERS(key, partial(_dpss, n_smp, NW), disk=True).copy()
+        if scaling == 'chronux':
+            tapers *= sqrt(s_freq)
+
+    else:
+        if taper == 'hann':
+            tapers = windows.hann(n_smp, sym=False)[None, :]
+        else:
+            # TODO: it'd be nice to use sym=False if possible, but the difference is very small
+            tapers = get_window(taper, n_smp)[None, :]
+
+        if scaling == 'energy':
+            rms = sqrt(mean(tapers ** 2))
+            tapers /= rms * sqrt(n_smp)
+        elif scaling != 'chronux':
+            # idk how chronux treats other windows apart from dpss
+            tapers /= norm(tapers)
+
+    return tapers
+
+
+def _dpss(n_smp, NW):
+    """DPSS tapers, without the eigenvalues."""
+    tapers, eig = dpss_windows(n_smp, NW, 2 * NW - 1)
+    return tapers
+
+
+def _group_trials(data, max_trials=16):
+    """Group the trials with the same shape.
+
+    Parameters
+    ----------
+    data : instance of Data
+        data with one or more trials
+    max_trials : int
+        maximum number of trials in each batch
+
+    Returns
+    -------
+    list of tuple
+        for each group, the list of trials and the list of batches (the trials
+        which are processed together)
+    """
+    groups = {}
+    for i, one_trial in enumerate(data.data):
+        groups.setdefault(one_trial.shape, []).append(i)
+
+    out = []
+    for trials in groups.values():
+        out.append((trials, [trials[i:i + max_trials]
+                             for i in range(0, len(trials), max_trials)]))
+    return out
+
+
+def _morlet_transform(dat, wavelets, output='complex', n_jobs=None, 
+                      spectra=None, max_size=2 ** 22):
+    """Convolve each channel with each wavelet (like fftconvolve with 'same'),
+    in the frequency domain.
+
+    Parameters
+    ----------
+    dat : ndarray
+        2D array, chan X time
+    wavelets : list of ndarray
+        complex morlet wavelets, one for each frequency
+    output : str
+        'complex' or 'power' (squared magnitude of the complex values)
+    n_jobs : int or None
+        number of threads for the FFTs (None means all the CPUs)
+    spectra : dict, optional
+        spectra of the wavelets, which are reused for the trials with the same
+        length (only if they take less than max_size)
+    max_size : int
+        maximum number of complex values (one for each frequency and time 
+        point) which are transformed back to the time domain at the same time
+
+    Returns
+    -------
+    ndarray
+        3D array, chan X time X freq (complex or float)
+
+    Notes
+    -----
+    Each channel is transformed once. The wavelets are shifted by half of
+    their length before their FFT, so that the first samples of the inverse
+    FFT are the central part of the convolution, as in mode 'same'.
+    """
+    workers = -1 if n_jobs is None else n_jobs
+    n_chan, n_smp = dat.shape
+    n_freq = len(wavelets)
+    n_fft = next_fast_len(n_smp + max([len(w) for w in wavelets]) - 1)
+    n_block = max([1, max_size // n_fft])
+
+    if output == 'complex':
+        tf = empty((n_chan, n_smp, n_freq), dtype='complex')
+    elif output == 'power':
+        tf = empty((n_chan, n_smp, n_freq))
+    else:
+        raise ValueError('output can be "complex" or "power", not ' + output)
+
+    x = sp_fft.fft(dat, n_fft, axis=-1, workers=workers)
+
+    if spectra is None:
+        spectra = {}
+    for f0 in range(0, n_freq, n_block):
+        f1 = f0 + n_block
+        w = spectra.get((n_fft, f0))
+        if w is None:
+            w = _wavelet_spectra(wavelets[f0:f1], n_fft, workers)
+            if n_freq <= n_block:
+                spectra[n_fft, f0] = w
+
+        for i_chan in range(n_chan):
+            conv = sp_fft.ifft(x[i_chan] * w, axis=-1, workers=workers,
+                               overwrite_x=True)[:, :n_smp]
+            if output == 'complex':
+                tf[i_chan, :, f0:f1] = conv.T
+            else:
+                tf[i_chan, :, f0:f1] = (conv.real ** 2 + conv.imag ** 2).T
+
     return tf
+
+
+def _wavelet_spectra(wavelets, n_fft, workers):
+    """FFT of the wavelets, rolled so that the convolution is centered."""
+    padded = zeros((len(wavelets), n_fft), dtype='complex')
+    for i, w in enumerate(wavelets):
+        padded[i, :len(w)] = w
+        padded[i] = roll(padded[i], -((len(w) - 1) // 2))
+    return sp_fft.fft(padded, axis=-1, workers=workers, overwrite_x=True)
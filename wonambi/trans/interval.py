@@ -0,0 +1,136 @@
+"""Module to work on sets of intervals (start and end times), stored as arrays.
+
+The intervals are stored as 2d arrays (interval x 2), with the start times in
+the first column and the end times in the second column. The operations are
+vectorized, so that they can be used on thousands of epochs, events and
+artefacts at once.
+"""
+from numpy import (abs, arange, argsort, asarray, cumsum, empty, flatnonzero,
+                   hstack, maximum, nan, ones, repeat, searchsorted, vstack,
+                   where)
+
+
+def as_intervals(times):
+    """Convert a list of (start, end) into an array of intervals.
+
+    Parameters
+    ----------
+    times : list of tuple of float
+        start and end time of each interval
+
+    Returns
+    -------
+    2d ndarray
+        intervals (interval x 2)
+    """
+    intervals = asarray(times, dtype=float)
+    return intervals.reshape(-1, 2)
+
+
+def union(intervals):
+    """Merge the intervals which overlap or touch each other.
+
+    Parameters
+    ----------
+    intervals : 2d ndarray
+        intervals (interval x 2), in any order
+
+    Returns
+    -------
+    2d ndarray
+        sorted intervals which do not overlap or touch each other
+    """
+    if len(intervals) == 0:
+        return empty((0, 2))
+
+    order = argsort(intervals[:, 0], kind='stable')
+    starts = intervals[order, 0]
+    ends = intervals[order, 1]
+
+    # new interval when it starts after the end of all the previous ones
+    latest_end = maximum.accumulate(ends)
+    first = hstack((0, flatnonzero(starts[1:] > latest_end[:-1]) + 1))
+
+    output = empty((len(first), 2))
+    output[:, 0] = starts[first]
+    output[:, 1] = maximum.reduceat(ends, first)
+    return output
+
+
+def difference(intervals, to_remove, min_dur=0):
+    """Remove some intervals from each interval.
+
+    Parameters
+    ----------
+    intervals : 2d ndarray
+        intervals (interval x 2)
+    to_remove : 2d ndarray
+        intervals to remove (interval x 2), in any order. Start and end times
+        are removed as well (the intervals are closed).
+    min_dur : float
+        only return the parts which are at least this long
+
+    Returns
+    -------
+    2d ndarray
+        parts of the intervals which are left (interval x 2), in the same
+        order as the input intervals
+    1d ndarray
+        index of the input interval of each part
+    """
+    removed = union(to_remove)
+    starts = intervals[:, 0]
+    ends = intervals[:, 1]
+
+    # removed intervals which overlap with each interval
+    i_first = searchsorted(removed[:, 1], starts, side='left')
+    i_last = searchsorted(removed[:, 0], ends, side='right')
+    n_parts = maximum(i_last - i_first + 1, 0)  # none if end < start
+
+    idx = repeat(arange(len(intervals)), n_parts)
+    i_part = arange(n_parts.sum()) - repeat(cumsum(n_parts) - n_parts,
+                                            n_parts)
+    i_removed = i_first[idx] + i_part
+    is_first = i_part == 0
+    is_last = i_part == n_parts[idx] - 1
+
+    # extra row, for the parts which do not touch any removed interval
+    removed = vstack((removed, (nan, nan)))
+    removed_ends = removed[i_removed - 1, 1]
+    removed_starts = removed[i_removed, 0]
+
+    parts = empty((len(idx), 2))
+    parts[:, 0] = where(is_first, starts[idx], removed_ends)
+    parts[:, 1] = where(is_last, ends[idx], removed_starts)
+
+    dur = parts[:, 1] - parts[:, 0]
+    keep = (dur > 0) & (dur >= min_dur)
+
+    return parts[keep], idx[keep]
+
+
+def find_gaps(intervals, abs_tol=0.01, rel_tol=1e-9):
+    """Find where consecutive intervals are not continuous.
+
+    Parameters
+    ----------
+    intervals : 2d ndarray
+        intervals (interval x 2)
+    abs_tol, rel_tol : float
+        tolerance to consider the end of one interval and the start of the
+        next one as the same time, as in math.isclose
+
+    Returns
+    -------
+    1d ndarray of bool
+        for each interval, if it does not start where the previous one ends
+        (always True for the first interval)
+    """
+    gaps = ones(len(intervals), dtype=bool)
+    if len(intervals) > 1:
+        starts = intervals[1:, 0]
+        prev_ends = intervals[:-1, 1]
+        tol = maximum(rel_tol * maximum(abs(starts), abs(prev_ends)), abs_tol)
+        gaps[1:] = abs(starts - prev_ends) > tol
+
+    return gaps
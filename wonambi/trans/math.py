@@ -36,11 +36,14 @@ from numpy import (absolute,
                    sum,
                    std,
                    where,
+                   ufunc,
                    unwrap)
 from scipy.signal import detrend, hilbert, fftconvolve
 from scipy.stats import mode
 from scipy.stats.mstats import gmean
 
+from ..datatype import _trials_buffer
+
 lg = getLogger(__name__)
 
 NOKEEPDIM = (median, mode)
@@ -178,31 +181,54 @@ def math(data, operator=None, operator_name=None, axis=None):
         if func == mode:
             func = lambda x, axis: mode(x, axis=axis)[0]
 
-        for i in range(output.number_of('trial')):
-
-            # don't copy original data, but use data if it's the first operation
-            if first_op:
-                x = data(trial=i)
-            else:
-                x = output(trial=i)
+        # all the trials at once, if they are stored in one buffer
+        x_all = None
+        if op['on_axis'] or _on_all_trials(func):
+            x_all = _trials_buffer(data.data if first_op else output.data)
 
+        if x_all is not None:
+            lg.debug('running ' + op['name'] + ' on all the trials')
             if op['on_axis']:
-                lg.debug('running ' + op['name'] + ' on ' + str(idx_axis))
-
                 try:
                     if func == diff:
-                        lg.debug('Diff has one-point of zero padding')
-                        x = _pad_one_axis_one_value(x, idx_axis)
-                    output.data[i] = func(x, axis=idx_axis)
+                        x_all = _pad_one_axis_one_value(x_all, idx_axis + 1)
+                    x_all = func(x_all, axis=idx_axis + 1)
 
                 except IndexError:
-                    raise ValueError('The axis ' + axis + ' does not '
-                                     'exist in [' +
-                                     ', '.join(list(data.axis.keys())) + ']')
+                    raise _missing_axis(axis, data)
 
             else:
-                lg.debug('running ' + op['name'] + ' on each datapoint')
-                output.data[i] = func(x)
+                x_all = func(x_all)
+
+            output.data = empty(len(x_all), dtype='O')
+            for i, one_trial in enumerate(x_all):
+                output.data[i] = one_trial
+
+        else:
+            for i in range(output.number_of('trial')):
+
+                # don't copy original data, but use data if it's the first
+                # operation
+                if first_op:
+                    x = data(trial=i)
+                else:
+                    x = output(trial=i)
+
+                if op['on_axis']:
+                    lg.debug('running ' + op['name'] + ' on ' + str(idx_axis))
+
+                    try:
+                        if func == diff:
+                            lg.debug('Diff has one-point of zero padding')
+                            x = _pad_one_axis_one_value(x, idx_axis)
+                        output.data[i] = func(x, axis=idx_axis)
+
+                    except IndexError:
+                        raise _missing_axis(axis, data)
+
+                else:
+                    lg.debug('running ' + op['name'] + ' on each datapoint')
+                    output.data[i] = func(x)
 
         first_op = False
 
@@ -211,6 +237,19 @@ def math(data, operator=None, operator_name=None, axis=None):
 
     return output
 
+def _on_all_trials(func):
+    """Point-wise functions (ufuncs and the operators of this module which do
+    not depend on the shape) also work on all the trials at once, with trial as
+    first dimension. Functions with 'axis' are run on all the trials as well.
+    Other functions get one trial at the time."""
+    return isinstance(func, ufunc) or func in POINTWISE
+
+
+def _missing_axis(axis, data):
+    return ValueError('The axis ' + axis + ' does not exist in [' +
+                      ', '.join(list(data.axis.keys())) + ']')
+
+
 def get_descriptives(data):
     """Get mean, SD, and mean and SD of log values.
 
@@ -242,3 +281,7 @@ def _pad_one_axis_one_value(x, idx_axis):
 # additional operators
 def dB(x):
     return 10 * log10(x)
+
+
+# operators without axis which can run on all the trials at once
+POINTWISE = (angle, dB)
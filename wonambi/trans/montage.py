@@ -79,20 +79,21 @@ def montage(data, ref_chan=None, ref_to_avg=False, bipolar=None,
                 if ref_to_avg:
                     ref_chan = data.axis['chan'][i]
 
-                ref_data = data(trial=i, chan=ref_chan)
+                ref_data = data(trial=i, chan=ref_chan, copy=False)
                 if method == 'average':
-                    mdata.data[i] = (data(trial=i) - nanmean(ref_data, axis=idx_chan))
+                    mdata.data[i] = (data(trial=i, copy=False) - nanmean(ref_data, axis=idx_chan))
                 if method == 'median':
-                    mdata.data[i] = (data(trial=i) - nanmedian(ref_data, axis=idx_chan))
+                    mdata.data[i] = (data(trial=i, copy=False) - nanmedian(ref_data, axis=idx_chan))
                 elif method == 'regression':
-                    mdata.data[i] = compute_average_regress(data(trial=i), idx_chan)
+                    mdata.data[i] = compute_average_regress(data(trial=i, copy=False),
+                                                            idx_chan)
 
             elif bipolar:
 
                 if not data.index_of('chan') == 0:
                     raise ValueError('For matrix multiplication to work, '
                                      'the first dimension should be chan')
-                mdata.data[i] = dot(trans, data(trial=i))
+                mdata.data[i] = dot(trans, data(trial=i, copy=False))
                 mdata.axis['chan'][i] = asarray(chan.return_label(),
                                                 dtype='U')
 
@@ -205,6 +206,6 @@ def create_virtual_channel(data, new_chan_name='virtual', method='average'):
 
     for i in range(mdata.number_of('trial')):
         mdata.axis['chan'][i] = [new_chan_name]
-        mdata.data[i] = nanmean(data(trial=i), axis=0)
+        mdata.data[i] = nanmean(data(trial=i, copy=False), axis=0)
 
     return mdata
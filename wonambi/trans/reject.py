@@ -1,7 +1,12 @@
 """Module to reject bad channels and bad epochs.
 """
+from itertools import compress
 from logging import getLogger
 
+from numpy import arange, searchsorted, sort
+
+from .interval import as_intervals, difference
+
 lg = getLogger(__name__)
 
 
@@ -59,42 +64,103 @@ def remove_artf_evts(times, annot, chan=None, name=None, min_dur=0.1):
 
     if artefact:
         artefact = sorted(artefact, key=lambda x: x['start'])
+        if min_dur <= 0:
+            return _remove_artf_sequential(times, artefact, min_dur)
+        artf_times = as_intervals([(x['start'], x['end']) for x in artefact])
+
+        # artefacts without duration are removed in a way that depends on the
+        # order of the artefacts, so the segments with these artefacts are
+        # processed one artefact at the time
+        seg_times = as_intervals(times)
+        no_dur = artf_times[:, 1] <= artf_times[:, 0]
+        points = sort(artf_times[no_dur].ravel())
+        sequential = (searchsorted(points, seg_times[:, 1], side='right') >
+                      searchsorted(points, seg_times[:, 0], side='left'))
+
+        parts, idx = difference(seg_times, artf_times[~no_dur],
+                                min_dur=min_dur)
+        parts = parts.tolist()
+        edges = searchsorted(idx, arange(len(times) + 1))
+
+        # where a segment is cut, use the values of the artefact (of the first
+        # artefact with that value, as in the sequential loop)
+        artf_start = {}
+        artf_end = {}
+        for x in reversed(artefact):
+            artf_start[x['start']] = x['start']
+            artf_end[x['end']] = x['end']
+
         new_times = []
-        
-        for seg in times:
-            reject = False
-            new_seg = True
-            
-            while new_seg is not False:
-                if type(new_seg) is tuple:
-                    seg = new_seg
-                end = seg[1]
-            
-                for artf in artefact:
-                    
-                    if artf['start'] <= seg[0] and seg[1] <= artf['end']:
-                        reject = True
-                        new_seg = False
-                        break
-                    
-                    a_starts_in_s = seg[0] <= artf['start'] < seg[1]
-                    a_ends_in_s = seg[0] < artf['end'] <= seg[1]
-                    
-                    if a_ends_in_s and not a_starts_in_s:
-                        seg = artf['end'], seg[1]
-                        
-                    elif a_starts_in_s:
-                        seg = seg[0], artf['start']
-    
-                        if a_ends_in_s:
-                            new_seg = artf['end'], end
-                        else:
-                            new_seg = False
-                        break
-                    
+        for i, seg in enumerate(times):
+            if sequential[i]:
+                near = ((artf_times.min(axis=1) <= seg[1]) &
+                        (artf_times.max(axis=1) >= seg[0]))
+                new_times.extend(_remove_artf_sequential(
+                    [seg], list(compress(artefact, near)), min_dur))
+                continue
+
+            for t0, t1 in parts[edges[i]:edges[i + 1]]:
+                # keep the original values, where the segment was not cut
+                t0 = seg[0] if t0 == seg[0] else artf_end.get(t0, t0)
+                t1 = seg[1] if t1 == seg[1] else artf_start.get(t1, t1)
+                new_times.append((t0, t1))
+
+    return new_times
+
+
+def _remove_artf_sequential(times, artefact, min_dur):
+    """Remove the artefacts from each segment, one artefact at the time.
+
+    Parameters
+    ----------
+    times : list of tuple of float
+        the start and end times of each segment
+    artefact : list of dict
+        artefacts, sorted by start time
+    min_dur : float
+        resulting segments are rejected if shorter than this duration
+
+    Returns
+    -------
+    list of tuple of float
+        the new start and end times of each segment
+    """
+    new_times = []
+
+    for seg in times:
+        reject = False
+        new_seg = True
+
+        while new_seg is not False:
+            if type(new_seg) is tuple:
+                seg = new_seg
+            end = seg[1]
+
+            for artf in artefact:
+
+                if artf['start'] <= seg[0] and seg[1] <= artf['end']:
+                    reject = True
                     new_seg = False
-            
-                if reject is False and seg[1] - seg[0] >= min_dur:
-                    new_times.append(seg)
-        
+                    break
+
+                a_starts_in_s = seg[0] <= artf['start'] < seg[1]
+                a_ends_in_s = seg[0] < artf['end'] <= seg[1]
+
+                if a_ends_in_s and not a_starts_in_s:
+                    seg = artf['end'], seg[1]
+
+                elif a_starts_in_s:
+                    seg = seg[0], artf['start']
+
+                    if a_ends_in_s:
+                        new_seg = artf['end'], end
+                    else:
+                        new_seg = False
+                    break
+
+                new_seg = False
+
+            if reject is False and seg[1] - seg[0] >= min_dur:
+                new_times.append(seg)
+
     return new_times
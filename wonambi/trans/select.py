@@ -10,14 +10,18 @@ Select should be as flexible as possible. There are quite a few cases, which
 will be added as we need them.
 """
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from itertools import product
 from logging import getLogger
+from os import cpu_count
 
-from numpy import (arange, array, asarray, diff, empty, hstack, inf,
-                   linspace, nan_to_num, ndarray, ones, ravel,
-                   setdiff1d, floor)
+from numpy import (arange, array, asarray, ceil, cumsum, diff, empty,
+                   flatnonzero, float32, hstack, linspace, nan_to_num, ndarray,
+                   ones, ravel, result_type, searchsorted, setdiff1d, floor)
 from numpy.lib.stride_tricks import as_strided
 from math import isclose
-from scipy.signal import resample as sci_resample
+from scipy.signal import resample as sci_resample, resample_poly
 
 try:
     from PyQt5.QtCore import Qt
@@ -27,6 +31,8 @@ except ImportError:
     QProgressDialog = None
 
 from .. import ChanTime
+from ..datatype import _as_slice, _get_indices
+from .interval import as_intervals, find_gaps
 from .montage import montage
 from .reject import remove_artf_evts
 
@@ -62,7 +68,8 @@ class Segments():
         return self.segments[index]
 
     def read_data(self, chan=[], ref_chan=[], grp_name=None, concat_chan=False,
-                  average_channels=False, max_s_freq=30000, parent=None):
+                  average_channels=False, max_s_freq=30000, parent=None,
+                  n_jobs=1, max_size=2 ** 24):
         """Read data for analysis. Adds data as 'data' in each dict.
 
         Parameters
@@ -85,73 +92,109 @@ class Segments():
         parent : QWidget
             for GUI only. Identifies parent widget for display of progress
             dialog.
+        n_jobs : int or None
+            number of threads reading the data (None means all the CPUs, 1
+            reads the data in this thread). Use more threads only with formats
+            whose readers can be called from several threads at the same time.
+        max_size : int
+            maximum number of values (channels x samples) read at once
+
+        Notes
+        -----
+        The sub-segments are read in chronological order. The sub-segments
+        which overlap or touch each other are read at once and the montage is
+        applied once to the whole read, then each sub-segment is copied into
+        the data of its segment.
         """
         output = []
+        n_subseg = sum([len(x['times']) for x in self.segments])
 
         # Set up Progress Bar
         if parent:
-            n_subseg = sum([len(x['times']) for x in self.segments])
             progress = QProgressDialog('Fetching signal', 'Abort', 0, n_subseg,
                                        parent)
             progress.setWindowModality(Qt.ApplicationModal)
             counter = 0
 
+        blocks = _plan_reads(self.segments, self.dataset, chan, ref_chan,
+                             max_size)
+
+        s_freq = self.dataset.header['s_freq']
+        decimate = s_freq > max_s_freq
+        if decimate:
+            q = int(s_freq / max_s_freq)
+            lg.debug('Decimate (with anti-aliasing filter) at ' + str(q))
+
+        # data of each segment, filled by the reads
+        chs = [None] * len(self.segments)
+        subseg = [[None] * len(seg['times']) for seg in self.segments]
+        buffers = [None] * len(self.segments)
+        timelines = [None] * len(self.segments)
+        offsets = [None] * len(self.segments)
+        if not decimate:
+            for one_block in blocks:
+                for begsam, endsam, i, j in one_block['subseg']:
+                    subseg[i][j] = endsam - begsam
+            for i, n_smp in enumerate(subseg):
+                offsets[i] = hstack(([0], cumsum(n_smp, dtype=int)))
+                timelines[i] = empty(offsets[i][-1])
+
+        for one_block, data in zip(blocks, _read_blocks(
+                self.dataset, blocks, ref_chan, n_jobs)):
+            active_chan = one_block['chan']
+
+            if decimate:
+                for begsam, endsam, i, j in one_block['subseg']:
+                    sub = _slice_time(data, begsam - one_block['begsam'],
+                                      endsam - one_block['begsam'])
+                    sub = resample(sub, s_freq=sub.s_freq / q, method='poly')
+                    subseg[i][j] = _create_data(sub, active_chan,
+                                                ref_chan=ref_chan,
+                                                grp_name=grp_name)
+                    chs[i] = subseg[i][j].axis['chan'][0]
+
+            else:
+                data = _create_data(data, active_chan, ref_chan=ref_chan,
+                                    grp_name=grp_name)
+                for begsam, endsam, i, j in one_block['subseg']:
+                    if buffers[i] is None:
+                        buffers[i] = empty((len(active_chan),
+                                            len(timelines[i])), dtype='f')
+                    chs[i] = data.axis['chan'][0]
+                    b = begsam - one_block['begsam']
+                    e = endsam - one_block['begsam']
+                    o = slice(offsets[i][j], offsets[i][j + 1])
+                    buffers[i][:, o] = data.data[0][:, b:e]
+                    timelines[i][o] = data.axis['time'][0][b:e]
+
+            if parent:
+                counter += len(one_block['subseg'])
+                progress.setValue(counter)
+                if progress.wasCanceled():
+                    parent.parent.statusBar().showMessage('Process canceled by'
+                                           ' user.')
+                    return
+
         # Begin bundle loop; will yield one segment per loop
         for i, seg in enumerate(self.segments):
             one_segment = ChanTime()
             one_segment.axis['chan'] = empty(1, dtype='O')
             one_segment.axis['time'] = empty(1, dtype='O')
             one_segment.data = empty(1, dtype='O')
-            subseg = []
-
-            # Subsegment loop; subsegments will be concatenated
-            for t0, t1 in seg['times']:
-                if parent:
-                    progress.setValue(counter)
-                    counter += 1
-
-                # if channel not specified, use segment channel
-                if chan:
-                    active_chan = chan
-                elif seg['chan']:
-                    active_chan = [seg['chan'].split(' (')[0]]
-                else:
-                    raise ValueError('No channel was specified and the '
-                                     'segment at {}-{} has no channel.'.format(
-                                             t0, t1))
-                active_chan = chan if chan else [seg['chan'].split(' (')[0]]
-                if isinstance(active_chan, str):
-                    active_chan = [active_chan]
-                chan_to_read = active_chan + ref_chan
-
-                data = self.dataset.read_data(chan=chan_to_read, begtime=t0,
-                                         endtime=t1)
-
-                # Downsample if necessary
-                if data.s_freq > max_s_freq:
-                    q = int(data.s_freq / max_s_freq)
-                    lg.debug('Decimate (no low-pass filter) at ' + str(q))
-
-                    data.data[0] = data.data[0][:, slice(None, None, q)]
-                    data.axis['time'][0] = data.axis['time'][0][slice(
-                            None, None, q)]
-                    data.s_freq = int(data.s_freq / q)
-
-                # read data from disk
-                subseg.append(_create_data(
-                    data, active_chan, ref_chan=ref_chan, grp_name=grp_name))
-
-            one_segment.s_freq = s_freq = data.s_freq
-            one_segment.axis['chan'][0] = chs = subseg[0].axis['chan'][0]
-            one_segment.axis['time'][0] = timeline = hstack(
-                    [x.axis['time'][0] for x in subseg])
-            one_segment.data[0] = empty((len(active_chan), len(timeline)),
-                                        dtype='f')
-            n_stitch = sum(asarray(diff(timeline) > 2/s_freq, dtype=bool))
+            active_chan = _active_chan(seg, chan)
 
-            for i, ch in enumerate(subseg[0].axis['chan'][0]):
-                    one_segment.data[0][i, :] = hstack(
-                            [x(chan=ch)[0] for x in subseg])
+            if decimate:
+                one_segment.s_freq = s_freq = subseg[i][0].s_freq
+                timeline = hstack([x.axis['time'][0] for x in subseg[i]])
+                one_segment.data[0] = hstack([x.data[0] for x in subseg[i]])
+            else:
+                one_segment.s_freq = s_freq
+                timeline = timelines[i]
+                one_segment.data[0] = buffers[i]
+
+            one_segment.axis['chan'][0] = chs[i]
+            one_segment.axis['time'][0] = timeline
+            n_stitch = sum(asarray(diff(timeline) > 2/s_freq, dtype=bool))
 
             if average_channels:
                 one_segment.data[0] = one_segment.data[0].mean(0,
@@ -160,9 +203,9 @@ class Segments():
                 active_chan = ['avg_chan']
 
             # For channel concatenation
-            elif concat_chan and len(chs) > 1:
+            elif concat_chan and len(chs[i]) > 1:
                 one_segment.data[0] = ravel(one_segment.data[0])
-                one_segment.axis['chan'][0] = asarray([(', ').join(chs)],
+                one_segment.axis['chan'][0] = asarray([(', ').join(chs[i])],
                                 dtype='U')
                 # axis['time'] should not be used in this case
 
@@ -174,12 +217,6 @@ class Segments():
                            'n_stitch': n_stitch
                            })
 
-            if parent:
-                if progress.wasCanceled():
-                    parent.parent.statusBar().showMessage('Process canceled by'
-                                           ' user.')
-                    return
-
         if parent:
             progress.setValue(counter)
 
@@ -188,7 +225,7 @@ class Segments():
         return 1 # for GUI
 
 
-def select(data, trial=None, invert=False, **axes_to_select):
+def select(data, trial=None, invert=False, copy=True, **axes_to_select):
     """Define the selection of trials, using ranges or actual values.
 
     Parameters
@@ -205,11 +242,21 @@ def select(data, trial=None, invert=False, **axes_to_select):
         values, you can pass a numpy array with dtype bool
     invert : bool
         take the opposite selection
+    copy : bool
+        if False, it returns a view of the data when possible (when the
+        selected values are contiguous in each axis), which is much faster.
+        Do not modify the output in that case, because it modifies the data
+        as well.
 
     Returns
     -------
     instance, same class as input
         data where selection has been applied.
+
+    Notes
+    -----
+    The data is sliced when the selected values are contiguous (f.e. a time
+    interval or a list of neighboring channels), and copied if copy=True.
     """
     if trial is not None and not isinstance(trial, Iterable):
         raise TypeError('Trial needs to be iterable.')
@@ -232,38 +279,17 @@ def select(data, trial=None, invert=False, **axes_to_select):
         output.axis[one_axis] = empty(len(trial), dtype='O')
     output.data = empty(len(trial), dtype='O')
 
-    to_select = {}
     for cnt, i in enumerate(trial):
         lg.debug('Selection on trial {0: 6}'.format(i))
+        index = []
+        to_select = {}
         for one_axis in output.axis:
             values = data.axis[one_axis][i]
 
             if one_axis in axes_to_select.keys():
-                values_to_select = axes_to_select[one_axis]
-
-                if len(values_to_select) == 0:
-                    selected_values = ()
-
-                elif isinstance(values_to_select[0], str):
-                    selected_values = asarray(values_to_select, dtype='U')
-
-                else:
-                    if isinstance(values_to_select, ndarray) and issubclass(values_to_select.dtype, bool):
-                        bool_values = values_to_select
-                    elif (values_to_select[0] is None and
-                       values_to_select[1] is None):
-                        bool_values = ones(len(values), dtype=bool)
-                    elif values_to_select[0] is None:
-                        bool_values = values < values_to_select[1]
-                    elif values_to_select[1] is None:
-                        bool_values = values_to_select[0] <= values
-                    else:
-                        bool_values = ((values_to_select[0] <= values) &
-                                       (values < values_to_select[1]))
-                    selected_values = values[bool_values]
-
-                if invert:
-                    selected_values = setdiff1d(values, selected_values)
+                idx, selected_values = _select_axis(values,
+                                                    axes_to_select[one_axis],
+                                                    invert)
 
                 lg.debug('In axis {0}, selecting {1: 6} '
                          'values'.format(one_axis,
@@ -272,16 +298,130 @@ def select(data, trial=None, invert=False, **axes_to_select):
             else:
                 lg.debug('In axis ' + one_axis + ', selecting all the '
                          'values')
+                idx = slice(None)
                 selected_values = data.axis[one_axis][i]
 
+            index.append(idx)
+            if copy and isinstance(idx, slice):
+                selected_values = selected_values.copy()
             output.axis[one_axis][cnt] = selected_values
 
-        output.data[cnt] = data(trial=i, **to_select)
+        if any(idx is None for idx in index):  # some values are not in data
+            output.data[cnt] = data(trial=i, **to_select)
+        else:
+            output.data[cnt] = _index_axes(data.data[i], index)
+            if copy and output.data[cnt].base is not None:
+                output.data[cnt] = output.data[cnt].copy()
 
     return output
 
 
-def resample(data, s_freq, axis='time'):
+def _select_axis(values, values_to_select, invert=False):
+    """Find the indices of the selected values in one axis.
+
+    Parameters
+    ----------
+    values : ndarray
+        values of the axis
+    values_to_select : tuple or list or ndarray
+        see select
+    invert : bool
+        take the opposite selection
+
+    Returns
+    -------
+    slice or ndarray of int or None
+        indices of the selected values (None if some of the selected values
+        are not in the axis)
+    ndarray
+        selected values
+
+    Notes
+    -----
+    If the values of the axis are increasing (like time or freq), the range
+    is found with searchsorted and the data is sliced, without comparing each
+    value.
+    """
+    increasing = values.dtype.kind in 'iuf' and (diff(values) > 0).all()
+
+    if len(values_to_select) == 0:
+        if not invert:
+            return arange(0), values[:0]
+        selected_values = setdiff1d(values, values[:0])
+
+    elif isinstance(values_to_select[0], str):
+        selected_values = asarray(values_to_select, dtype='U')
+        if invert:
+            selected_values = setdiff1d(values, selected_values)
+
+    elif (isinstance(values_to_select, ndarray) and
+          values_to_select.dtype.kind == 'b'):
+        idx = flatnonzero(values_to_select != invert)
+        if increasing:
+            return idx, values[idx]
+        selected_values = values[values_to_select]
+        if invert:
+            selected_values = setdiff1d(values, selected_values)
+
+    elif increasing:
+        beg, end = 0, len(values)
+        if values_to_select[0] is not None:
+            beg = searchsorted(values, values_to_select[0], 'left')
+        if values_to_select[1] is not None:
+            end = max(searchsorted(values, values_to_select[1], 'left'), beg)
+
+        if invert:
+            idx = hstack((arange(beg), arange(end, len(values))))
+        else:
+            idx = slice(beg, end)
+        return idx, values[idx]
+
+    else:
+        if values_to_select[0] is None and values_to_select[1] is None:
+            bool_values = ones(len(values), dtype=bool)
+        elif values_to_select[0] is None:
+            bool_values = values < values_to_select[1]
+        elif values_to_select[1] is None:
+            bool_values = values_to_select[0] <= values
+        else:
+            bool_values = ((values_to_select[0] <= values) &
+                           (values < values_to_select[1]))
+        selected_values = values[bool_values]
+        if invert:
+            selected_values = setdiff1d(values, selected_values)
+
+    idx_data, idx_output = _get_indices(values, selected_values, None)
+    if len(idx_output) < len(selected_values):
+        return None, selected_values
+    return idx_data, selected_values
+
+
+def _index_axes(x, index):
+    """Select the indices on each axis, as a view if they are slices.
+
+    Parameters
+    ----------
+    x : ndarray
+        data of one trial
+    index : list of slice or ndarray of int
+        indices for each axis
+
+    Returns
+    -------
+    ndarray
+        selected data (a view of x if all the indices are contiguous)
+    """
+    index = [_as_slice(idx, len(idx)) or idx if isinstance(idx, ndarray)
+             else idx for idx in index]
+    x = x[tuple(idx if isinstance(idx, slice) else slice(None)
+                for idx in index)]
+    for i_axis, idx in enumerate(index):
+        if not isinstance(idx, slice):
+            x = x.take(idx, axis=i_axis)
+    return x
+
+
+def resample(data, s_freq, axis='time', method='fft', max_size=2**22):
     """Downsample the data after applying a filter.
 
     Parameters
@@ -292,39 +432,151 @@ def resample(data, s_freq, axis='time'):
         desired sampling frequency
     axis : str
         axis you want to apply downsample on (most likely 'time')
+    method : str
+        'fft' (scipy.signal.resample, on the whole signal) or 'poly'
+        (polyphase filter, scipy.signal.resample_poly), which is faster and
+        uses less memory for long signals
+    max_size : int
+        (only for 'poly') maximum number of values of the output which are
+        computed at once. Longer signals are resampled in chunks.
 
     Returns
     -------
     instance of Data
         downsampled data
+
+    Notes
+    -----
+    'poly' needs the ratio between the sampling frequencies as a fraction
+    (such as 256 / 1000 = 32 / 125). If there is no such fraction with a
+    denominator up to 1000, it uses 'fft'. When the original sampling
+    frequency is a multiple of the new one, the polyphase filter only computes
+    the samples which are kept, so it's an anti-aliasing filter followed by
+    decimation.
+
+    The chunks of 'poly' overlap by the length of the filter, so that the
+    output is the same as resampling the whole signal at once. 'fft' needs
+    several copies of the whole signal in memory, and it's slow when the
+    number of samples is not a product of small primes.
     """
+    up_down = _rational_ratio(data.s_freq, s_freq)
+    if method == 'poly' and up_down is None:
+        lg.debug('No fraction for ratio ' + str(s_freq / data.s_freq) +
+                 ', using fft')
+        method = 'fft'
+
     output = data._copy()
+    idx_axis = data.index_of(axis)
 
     for i in range(data.number_of('trial')):
-        # check if the ratio between old and new data is not an integer
-        out_samples = int(floor(data.number_of('time')[i] / data.s_freq * s_freq))
-        orig_samples = int(out_samples / s_freq * data.s_freq)
+        if method == 'poly':
+            output.data[i] = _resample_poly(data.data[i], *up_down,
+                                            axis=idx_axis, max_size=max_size)
+            n_samples = output.data[i].shape[idx_axis]
+            output.axis[axis][i] = (data.axis[axis][i][0] +
+                                    arange(n_samples) / s_freq)
 
-        # if so, then skip the last data points
-        interval = (data.axis[axis][i][0], data.axis[axis][i][orig_samples - 1])
-        x = data(trial=i, axis=interval)
-
-        output.data[i] = sci_resample(
-            data.data[i],
-            out_samples,
-            axis=data.index_of(axis))
+        else:
+            out_samples = int(floor(data.number_of('time')[i] / data.s_freq *
+                                    s_freq))
+            output.data[i] = sci_resample(data.data[i], out_samples,
+                                          axis=idx_axis)
 
-        n_samples = output.data[i].shape[data.index_of(axis)]
-        output.axis[axis][i] = linspace(data.axis[axis][i][0],
-                                        data.axis[axis][i][-1]
-                                        + 1 / data.s_freq,
-                                        n_samples)
+            n_samples = output.data[i].shape[idx_axis]
+            output.axis[axis][i] = linspace(data.axis[axis][i][0],
+                                            data.axis[axis][i][-1]
+                                            + 1 / data.s_freq,
+                                            n_samples)
 
     output.s_freq = s_freq
 
     return output
 
 
+def _rational_ratio(s_freq, new_s_freq, max_denominator=1000):
+    """Approximate the ratio between the sampling frequencies with a fraction.
+
+    Returns
+    -------
+    tuple of int or None
+        up and down factors, or None if there is no fraction close enough to
+        the ratio
+    """
+    ratio = new_s_freq / s_freq
+    fract = Fraction(ratio).limit_denominator(max_denominator)
+    if not isclose(fract.numerator / fract.denominator, ratio, rel_tol=1e-9):
+        return None
+    return fract.numerator, fract.denominator
+
+
+def _resample_poly(x, up, down, axis=-1, max_size=2**22):
+    """Resample with a polyphase filter, in chunks for long signals.
+
+    Parameters
+    ----------
+    x : ndarray
+        data to resample
+    up : int
+        upsampling factor
+    down : int
+        downsampling factor
+    axis : int
+        axis to resample
+    max_size : int
+        maximum number of values of the output which are computed at once
+
+    Returns
+    -------
+    ndarray
+        resampled data, the same as resample_poly(x, up, down, axis=axis,
+        padtype='edge')
+
+    Notes
+    -----
+    Each chunk starts at a multiple of down in the input (so that the output
+    samples are on the same grid as the whole signal) and it contains the
+    samples around the chunk which are needed by the filter (the default
+    filter of resample_poly has 10 * max(up, down) taps on each side, at the
+    upsampled frequency).
+
+    The signal is extended with its first and last values, instead of zeros,
+    so that the amplitude does not drop at the edges.
+    """
+    n_in = x.shape[axis]
+    n_out = -(-n_in * up // down)
+    n_other = max(x.size // max(n_in, 1), 1)
+
+    n_block = max(max_size // n_other // up, 1) * up  # output samples
+    if n_out <= n_block:
+        return resample_poly(x, up, down, axis=axis, padtype='edge')
+
+    half_len = 10 * max(up, down) / up  # in input samples
+    margin = int(ceil((half_len + 1) / down)) * down
+
+    out_shape = list(x.shape)
+    out_shape[axis] = n_out
+    output = empty(out_shape, dtype=result_type(x.dtype, float32))
+
+    idx_in = [slice(None)] * x.ndim
+    idx_out = [slice(None)] * x.ndim
+    for beg_out in range(0, n_out, n_block):
+        end_out = min(beg_out + n_block, n_out)
+        beg_in = beg_out // up * down
+        beg_seg = max(beg_in - margin, 0)
+        end_seg = min(beg_in + n_block // up * down + margin, n_in)
+
+        idx_in[axis] = slice(beg_seg, end_seg)
+        y = resample_poly(x[tuple(idx_in)], up, down, axis=axis,
+                          padtype='edge')
+
+        offset = (beg_in - beg_seg) // down * up
+        idx_in[axis] = slice(offset, offset + end_out - beg_out)
+        idx_out[axis] = slice(beg_out, end_out)
+        output[tuple(idx_out)] = y[tuple(idx_in)]
+
+    return output
+
+
 def smart_chan(dataset, simple_chan_name, test_chan=None):
     """From a list of simple channel names, attempts to find the corresponding
     channel names in the dataset and returns a list (with same order).
@@ -551,7 +803,7 @@ def get_times(annot, evt_type=None, stage=None, cycle=None, chan=None,
     find a use case for rejecting events based on the quality of the epoch
     signal.
     """
-    getter = annot.get_epochs
+    is_event = False
     last = annot.last_second
 
     if stage is None:
@@ -563,7 +815,7 @@ def get_times(annot, evt_type=None, stage=None, cycle=None, chan=None,
     if evt_type is None:
         evt_type = (None,)
     elif isinstance(evt_type[0], str):
-        getter = annot.get_events
+        is_event = True
         if chan != (None,):
             chan.append('') # also retrieve events marked on all channels
     else:
@@ -573,6 +825,24 @@ def get_times(annot, evt_type=None, stage=None, cycle=None, chan=None,
     if exclude:
         qual = 'Good'
 
+    if is_event:
+        cols = _event_table(annot, stage != (None,), qual)
+    else:
+        cols = _epoch_table(annot)
+
+    # the same selection is used for many bundles
+    masks = {}
+    def select_by(column, value, func):
+        if value is None:
+            return True
+        key = (column, value)
+        if key not in masks:
+            masks[key] = func(value)
+        return masks[key]
+
+    start = cols['start'].tolist()
+    end = cols['end'].tolist()
+
     bundles = []
     for et in evt_type:
 
@@ -581,17 +851,29 @@ def get_times(annot, evt_type=None, stage=None, cycle=None, chan=None,
             for cyc in cycle:
 
                 for ss in stage:
-
-                    st_input = ss
-                    if ss is not None:
-                        st_input = (ss,)
-
-                    evochs = getter(name=et, time=cyc, chan=(ch,),
-                                    stage=st_input, qual=qual)
-                    if evochs:
+                    good = ones(len(start), dtype=bool)
+                    if is_event:
+                        good &= select_by('name', et,
+                                          lambda x: cols['name'] == x)
+                        good &= select_by('chan', ch,
+                                          lambda x: cols['chan'] == x)
+                        good &= select_by('cycle', cyc,
+                            lambda x: ((x[0] <= cols['end']) &
+                                       (x[1] >= cols['start'])))
+                    else:
+                        good &= select_by('cycle', cyc,
+                            lambda x: ((x[0] <= cols['start']) &
+                                       (x[1] >= cols['end'])))
+                    good &= select_by('stage', ss,
+                                      lambda x: cols['stage'] == x)
+                    good &= select_by('quality', qual,
+                                      lambda x: cols['quality'] == x)
+
+                    if good.any():
                         times = [(
-                                max(e['start'] - buffer, 0),
-                                min(e['end'] + buffer, last)) for e in evochs]
+                                max(start[i] - buffer, 0),
+                                min(end[i] + buffer, last))
+                                for i in flatnonzero(good)]
                         times = sorted(times, key=lambda x: x[0])
                         one_bundle = {'times': times,
                                       'stage': ss,
@@ -603,6 +885,49 @@ def get_times(annot, evt_type=None, stage=None, cycle=None, chan=None,
     return bundles
 
 
+def _epoch_table(annot):
+    """Epochs as columns, for the selection done by Annotations.get_epochs."""
+    if annot.rater is None:
+        raise IndexError('You need to have at least one rater')
+    return annot._epoch_columns()
+
+
+def _event_table(annot, with_stage, qual):
+    """Events as columns, for the selection done by Annotations.get_events.
+
+    Parameters
+    ----------
+    annot : instance of Annotations
+        annotations with the events
+    with_stage : bool
+        if the stage of each event is needed
+    qual : str or None
+        if not None, also the quality of the epoch of each event is needed
+
+    Returns
+    -------
+    dict of ndarray
+        with 'name', 'start', 'end', 'chan' and, if needed, 'stage' (stage of
+        the epoch where each event starts) and 'quality' (quality of that
+        epoch, instead of the quality of the event)
+    """
+    if annot.rater is None:
+        raise IndexError('You need to have at least one rater')
+    cols = dict(annot._event_columns())
+
+    if with_stage or qual is not None:
+        epochs = annot._epoch_columns()
+        # epoch where each event starts (the last one, if it starts before
+        # the first epoch)
+        pos = searchsorted(epochs['start'], cols['start'], side='right') - 1
+        if with_stage:
+            cols['stage'] = epochs['stage'][pos]
+        if qual is not None:
+            cols['quality'] = epochs['quality'][pos]
+
+    return cols
+
+
 def _longer_than(segments, min_dur):
     """Remove segments longer than min_dur."""
     if min_dur <= 0.:
@@ -644,53 +969,46 @@ def _concat(bundles, cat=(0, 0, 0, 0), concat_continuous=True):
     if cat[3]:
         evt_type = [all_evt_type]
 
-    to_concat = []
-    for ch in chan:
-
-        for cyc in cycle:
-
-            for st in stage:
-
-                for et in evt_type:
-                    new_times = []
-
-                    for bund in bundles:
-                        chan_cond = ch == bund['chan']
-                        cyc_cond = cyc in (bund['cycle'], all_cycle)
-                        st_cond = st in (bund['stage'], all_stage)
-                        et_cond = et in (bund['name'], all_evt_type)
-
-                        if chan_cond and cyc_cond and st_cond and et_cond:
-                            new_times.extend(bund['times'])
+    # group the bundles by channel, cycle, stage and event type
+    index = [{v: i for i, v in enumerate(x)}
+             for x in (chan, cycle, stage, evt_type)]
+    groups = {}
+    for i, bund in enumerate(bundles):
+        for key in product(_matching(index[0], bund['chan']),
+                           _matching(index[1], bund['cycle'], all_cycle),
+                           _matching(index[2], bund['stage'], all_stage),
+                           _matching(index[3], bund['name'], all_evt_type)):
+            groups.setdefault(key, []).append(i)
 
-                    new_times = sorted(new_times, key=lambda x: x[0])
-                    new_bund = {'times': new_times,
-                              'chan': ch,
-                              'cycle': cyc,
-                              'stage': st,
-                              'name': et
-                              }
-                    to_concat.append(new_bund)
+    to_concat = []
+    for key in sorted(groups):
+        new_times = []
+        for i in groups[key]:
+            new_times.extend(bundles[i]['times'])
+
+        new_times = sorted(new_times, key=lambda x: x[0])
+        new_bund = {'times': new_times,
+                  'chan': chan[key[0]],
+                  'cycle': cycle[key[1]],
+                  'stage': stage[key[2]],
+                  'name': evt_type[key[3]]
+                  }
+        to_concat.append(new_bund)
 
     if not cat[2]:
         to_concat_new = []
 
         for bund in to_concat:
-            last = None
-            bund['times'].append((inf,inf))
-            start = 0
-
-            for i, j in enumerate(bund['times']):
-
-                if last is not None:
-                    if not isclose(j[0], last, abs_tol=0.01) \
-                        or not concat_continuous:
-                        new_times = bund['times'][start:i]
-                        new_bund = bund.copy()
-                        new_bund['times'] = new_times
-                        to_concat_new.append(new_bund)
-                        start = i
-                last = j[1]
+            if concat_continuous:
+                gaps = find_gaps(as_intervals(bund['times']))
+            else:
+                gaps = ones(len(bund['times']), dtype=bool)
+            edges = hstack((flatnonzero(gaps), len(gaps)))
+
+            for i0, i1 in zip(edges[:-1], edges[1:]):
+                new_bund = bund.copy()
+                new_bund['times'] = bund['times'][i0:i1]
+                to_concat_new.append(new_bund)
 
         to_concat = to_concat_new
 
@@ -699,6 +1017,12 @@ def _concat(bundles, cat=(0, 0, 0, 0), concat_continuous=True):
     return to_concat
 
 
+def _matching(index, *values):
+    """Position of the values among the conditions (index is a dict with the
+    position of each condition)."""
+    return sorted(set(index[v] for v in values if v in index))
+
+
 def _divide_bundles(bundles):
     """Take each subsegment inside a bundle and put it in its own bundle,
     copying the bundle metadata."""
@@ -771,7 +1095,7 @@ def _create_data(data, active_chan, ref_chan=[], grp_name=None):
             chan_grp_name = chan + ' (' + grp_name + ')'
         all_chan_grp_name.append(chan_grp_name)
 
-        dat = data1(chan=chan, trial=0)
+        dat = data1(chan=chan, trial=0, copy=False)
         output.data[0][i, :] = dat
 
     output.axis['chan'][0] = asarray(all_chan_grp_name, dtype='U')
@@ -779,6 +1103,113 @@ def _create_data(data, active_chan, ref_chan=[], grp_name=None):
     return output
 
 
+def _active_chan(seg, chan):
+    """Channels of interest of one segment (chan or the segment channel)."""
+    if chan:
+        active_chan = chan
+    elif seg['chan']:
+        active_chan = [seg['chan'].split(' (')[0]]
+    else:
+        t0, t1 = seg['times'][0]
+        raise ValueError('No channel was specified and the '
+                         'segment at {}-{} has no channel.'.format(t0, t1))
+    if isinstance(active_chan, str):
+        active_chan = [active_chan]
+    return active_chan
+
+
+def _plan_reads(segments, dataset, chan, ref_chan, max_size):
+    """Group the sub-segments in reads of contiguous data.
+
+    Parameters
+    ----------
+    segments : list of dict
+        segments, with 'times' and 'chan'
+    dataset : instance of wonambi.Dataset
+        dataset used to convert the times into samples
+    chan : list of str
+        active channel names (if empty, the channel of each segment is used)
+    ref_chan : list of str
+        reference channel names
+    max_size : int
+        maximum number of values (channels x samples) of one read
+
+    Returns
+    -------
+    list of dict
+        reads in chronological order, with 'chan' (active channels), 'begsam',
+        'endsam' and 'subseg' (list of begsam, endsam, index of the segment
+        and index of the sub-segment)
+    """
+    reads = {}
+    for i, seg in enumerate(segments):
+        if not seg['times']:
+            continue
+        active_chan = _active_chan(seg, chan)
+        for j, (t0, t1) in enumerate(seg['times']):
+            begsam, endsam = dataset._convert_to_list_with_samples([t0, t1])
+            reads.setdefault(tuple(active_chan), []).append(
+                (begsam, endsam, i, j))
+
+    blocks = []
+    for active_chan, subseg in reads.items():
+        max_smp = max(max_size // (len(active_chan) + len(ref_chan)), 1)
+        block = None
+        for one_subseg in sorted(subseg):
+            begsam, endsam = one_subseg[:2]
+            if (block is not None and begsam <= block['endsam'] and
+                    max(endsam, block['endsam']) - block['begsam'] <= max_smp):
+                block['endsam'] = max(endsam, block['endsam'])
+                block['subseg'].append(one_subseg)
+            else:
+                block = {'chan': list(active_chan),
+                         'begsam': begsam,
+                         'endsam': endsam,
+                         'subseg': [one_subseg],
+                         }
+                blocks.append(block)
+
+    return sorted(blocks, key=lambda x: x['begsam'])
+
+
+def _read_blocks(dataset, blocks, ref_chan, n_jobs=1):
+    """Read the blocks, one after the other or with a pool of threads.
+
+    Yields
+    ------
+    instance of ChanTime
+        data of each block, in the same order as blocks
+    """
+    def read_one(block):
+        return dataset.read_data(chan=block['chan'] + ref_chan,
+                                 begsam=block['begsam'],
+                                 endsam=block['endsam'])
+
+    if n_jobs == 1 or len(blocks) < 2:
+        for one_block in blocks:
+            yield read_one(one_block)
+        return
+
+    n_workers = n_jobs if n_jobs else cpu_count()
+    with ThreadPoolExecutor(n_workers) as pool:
+        # do not read too far ahead, to limit the memory
+        for i in range(0, len(blocks), n_workers):
+            yield from pool.map(read_one, blocks[i:i + n_workers])
+
+
+def _slice_time(data, begsam, endsam):
+    """Select some samples of ChanTime with one trial, without copying."""
+    output = ChanTime()
+    output.s_freq = data.s_freq
+    output.start_time = data.start_time
+    output.axis['chan'] = data.axis['chan']
+    output.axis['time'] = empty(1, dtype='O')
+    output.axis['time'][0] = data.axis['time'][0][begsam:endsam]
+    output.data = empty(1, dtype='O')
+    output.data[0] = data.data[0][:, begsam:endsam]
+    return output
+
+
 def _create_subepochs(x, nperseg, step):
     """Transform the data into a matrix for easy manipulation
 
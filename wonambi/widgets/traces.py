@@ -473,7 +473,7 @@ class Traces(QGraphicsView):
                 chan_name = one_chan + ' (' + one_grp['name'] + ')'
 
                 # trace
-                dat = (self.data(trial=0, chan=chan_name) *
+                dat = (self.data(trial=0, chan=chan_name, copy=False) *
                        self.parent.value('y_scale'))
                 dat *= -1  # flip data, upside down (because y grows downward)
                 path = self.scene.addPath(Path(self.data.axis['time'][0],